@@ -0,0 +1,72 @@
+import lzma
+import os
+import sqlite3
+
+from PySide6.QtCore import QThread
+from PySide6.QtCore import Signal as pyqtSignal
+
+
+class BackupThread(QThread):
+    """Makes a consistent copy of live collection with SQLite online backup
+    API and optionally compresses it to xz archive"""
+    progress = pyqtSignal(int)
+
+    PAGES_PER_STEP = 1024
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, srcFileName, dstFileName, compress=False, parent=None):
+        super().__init__(parent)
+
+        self.srcFileName = srcFileName
+        self.dstFileName = dstFileName
+        self.compress = compress
+        self.result = False
+        self.error = ''
+
+    def run(self):
+        if self.compress:
+            dbFileName = self.dstFileName + '.tmp'
+        else:
+            dbFileName = self.dstFileName
+
+        try:
+            self._backup(dbFileName)
+            if self.compress:
+                self._compress(dbFileName)
+                os.remove(dbFileName)
+
+            self.result = True
+        except (sqlite3.Error, OSError, lzma.LZMAError) as error:
+            self.error = str(error)
+            for fileName in (dbFileName, self.dstFileName):
+                if os.path.exists(fileName):
+                    os.remove(fileName)
+
+    def _backup(self, dbFileName):
+        maximum = 50 if self.compress else 100
+
+        def progress(_status, remaining, total):
+            if total:
+                self.progress.emit((total - remaining) * maximum // total)
+
+        src = sqlite3.connect(self.srcFileName)
+        dst = sqlite3.connect(dbFileName)
+        try:
+            src.backup(dst, pages=self.PAGES_PER_STEP, progress=progress)
+        finally:
+            dst.close()
+            src.close()
+
+    def _compress(self, dbFileName):
+        total = os.path.getsize(dbFileName) or 1
+        done = 0
+        with open(dbFileName, 'rb') as src, \
+                lzma.open(self.dstFileName, 'wb', preset=1) as dst:
+            while True:
+                data = src.read(self.CHUNK_SIZE)
+                if not data:
+                    break
+                dst.write(data)
+
+                done += len(data)
+                self.progress.emit(50 + done * 50 // total)
@@ -5,6 +5,8 @@ import json
 import math
 import os
 import shutil
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from PySide6.QtCore import (
     Qt,
@@ -15,6 +17,7 @@ from PySide6.QtCore import (
     QDateTime,
     QDir,
     QDirIterator,
+    QEventLoop,
     QFile,
     QFileInfo,
     QIODevice,
@@ -26,7 +29,7 @@ from PySide6.QtCore import (
 )
 from PySide6.QtCore import Signal as pyqtSignal
 from PySide6.QtGui import QImage, QPainter, QAction
-from PySide6.QtSql import QSqlTableModel, QSqlDatabase, QSqlQuery, QSqlField
+from PySide6.QtSql import QSqlTableModel, QSqlDatabase, QSqlQuery, QSqlField, QSqlRecord
 from PySide6.QtWidgets import (
     QApplication,
     QDialog,
@@ -41,6 +44,9 @@ from OpenNumismat.Collection.CollectionFields import CollectionFields
 from OpenNumismat.Collection.CollectionFields import ImageFields
 from OpenNumismat.Collection.CollectionPages import CollectionPages
 from OpenNumismat.Collection.Password import cryptPassword, PasswordDialog
+from OpenNumismat.Collection.Backup import BackupThread
+from OpenNumismat.Collection.QueryService import QueryService, InterruptibleQueryService
+from OpenNumismat.Collection.FilterCompiler import In, Match, compileFilter
 from OpenNumismat.Collection.Description import CollectionDescription
 from OpenNumismat.Reference.Reference import Reference
 from OpenNumismat.Reference.Reference import CrossReferenceSection
@@ -48,7 +54,9 @@ from OpenNumismat.Reference.ReferenceDialog import AllReferenceDialog
 from OpenNumismat.EditCoinDialog.EditCoinDialog import EditCoinDialog
 from OpenNumismat.Collection.CollectionFields import Status, Statuses
 from OpenNumismat.Collection.VersionUpdater import updateCollection
+from OpenNumismat.TagsDialog import updateTagsClosure
 from OpenNumismat.Tools.CursorDecorators import waitCursorDecorator
+from OpenNumismat.Tools.ImageProcessing import imageDigest, previewImage, processImages
 from OpenNumismat.Tools import Gui
 from OpenNumismat.Tools.Gui import infoMessageBox
 from OpenNumismat.Settings import Settings, BaseSettings
@@ -57,6 +65,112 @@ from OpenNumismat.Collection.Export import ExportDialog
 from OpenNumismat.Tools.Converters import numberWithFraction, htmlToPlainText
 
 
+class CoinRecord(QSqlRecord):
+    """Record of coin with images and tags loaded from database on first
+    access. Until then image fields keep only photo id"""
+
+    def __init__(self, model, record):
+        super().__init__(record)
+
+        self._model = model
+        # Not loaded fields: image field -> photo id, 'image' -> preview id
+        # and 'tags' -> coin id
+        self._pending = {}
+        # Loaded photos: image field -> (title, digest)
+        self._originals = {}
+
+    def defer(self, field, value):
+        super().setNull(field)
+        self._pending[field] = value
+
+    def isLoaded(self, field):
+        return field not in self._pending
+
+    def isImageChanged(self, field, withTitle=True):
+        if field in self._pending:
+            return False
+
+        value = super().value(field)
+        original = self._originals.get(field)
+        if original is None:
+            return bool(value)
+        if not isinstance(value, QByteArray):
+            return True
+
+        title, digest = original
+        if withTitle and (super().value(field + '_title') or '') != (title or ''):
+            return True
+        return imageDigest(value) != digest
+
+    def materialize(self):
+        self._load(tuple(self._pending))
+
+    def _load(self, fields):
+        photo_ids = {}
+        for field in fields:
+            value = self._pending.pop(field, None)
+            if value is None:
+                continue
+
+            if field == 'image':
+                super().setValue(field, self._model.getPreviewImage(value))
+            elif field == 'tags':
+                super().setValue(field, self._model.getTags(value))
+            else:
+                photo_ids[field] = value
+
+        # All requested photos are loaded with one query
+        if photo_ids:
+            photos = self._model.getImages(photo_ids.values())
+            for field, img_id in photo_ids.items():
+                title, image, digest = photos.get(img_id, (None, None, None))
+                super().setValue(field, image)
+                super().setValue(field + '_title', title)
+                if digest:
+                    self._originals[field] = (title, digest)
+
+    def _resolve(self, field, overwrite=False):
+        if isinstance(field, int):
+            field = self.fieldName(field)
+        if field.endswith('_title'):
+            field = field[:-len('_title')]
+
+        if field in self._pending:
+            if overwrite and not self.contains(field + '_title'):
+                # Value is replaced entirely, so there is nothing to load
+                del self._pending[field]
+            else:
+                self._load((field,))
+
+    def value(self, field):
+        self._resolve(field)
+        return super().value(field)
+
+    def isNull(self, field):
+        self._resolve(field)
+        return super().isNull(field)
+
+    def field(self, field):
+        self._resolve(field)
+        return super().field(field)
+
+    def setValue(self, field, value):
+        self._resolve(field, True)
+        super().setValue(field, value)
+
+    def setNull(self, field):
+        self._resolve(field, True)
+        super().setNull(field)
+
+    def remove(self, pos):
+        self._pending.pop(self.fieldName(pos), None)
+        super().remove(pos)
+
+    def clearValues(self):
+        self._pending.clear()
+        super().clearValues()
+
+
 class CollectionModel(QSqlTableModel):
     rowInserted = pyqtSignal(object)
     modelChanged = pyqtSignal()
@@ -64,25 +178,89 @@ class CollectionModel(QSqlTableModel):
     IMAGE_FORMAT = 'webp'
     IMAGE_QUALITY = 80
     SQLITE_READONLY = '8'
+    BULK_CHUNK_SIZE = 1000
 
     def __init__(self, collection, parent=None):
         super().__init__(parent, collection.db)
 
         self.intFilter = ''
+        self.intParams = ()
         self.extFilter = ''
+        self.extParams = ()
         self.searchFilter = ''
-
+        # Combined filter and its bind values, data generation, count and
+        # JSON array of ids of coins found by background search
+        self.__found = None
+        self.__emptySelect = False
+        # Errors of statements executed by _exec while they are collected
+        self._execErrors = None
+
+        self.collection = collection
         self.reference = collection.reference
         self.fields = collection.fields
         self.description = collection.description
         self.settings = collection.settings
         self.proxy = None
 
+        self.sortColumn = -1
+        self.sortOrder = Qt.AscendingOrder
+
         self.rowsInserted.connect(self.rowsInsertedEvent)
 
     def supportedDropActions(self):
         return Qt.MoveAction
 
+    def dataGeneration(self):
+        return self.collection.dataGeneration
+
+    # All row writes of QSqlTableModel go through these methods. Old and
+    # new values of written coin allow views to patch their caches
+    def insertRowIntoTable(self, values):
+        ret = super().insertRowIntoTable(values)
+        if ret:
+            query = QSqlQuery("SELECT last_insert_rowid()", self.database())
+            query.first()
+            new = self._coinValues(query.value(0))
+            self.collection.bumpDataGeneration(None, new)
+        return ret
+
+    def updateRowInTable(self, row, values):
+        # Position of coin doesn't affect cached aggregates
+        changed = [values.fieldName(i) for i in range(values.count())
+                   if values.isGenerated(i)]
+        if set(changed) <= {'sort_id'}:
+            return super().updateRowInTable(row, values)
+
+        coin_id = super().record(row).value('id')
+        old = self._coinValues(coin_id)
+        ret = super().updateRowInTable(row, values)
+        if ret:
+            new = self._coinValues(coin_id)
+            self.collection.bumpDataGeneration(old, new)
+        return ret
+
+    def deleteRowFromTable(self, row):
+        coin_id = super().record(row).value('id')
+        old = self._coinValues(coin_id)
+        ret = super().deleteRowFromTable(row)
+        if ret:
+            self.collection.bumpDataGeneration(old, None)
+        return ret
+
+    def _coinValues(self, coin_id):
+        # Only columns required by listeners of coinsChanged
+        columns = ['id'] + self.collection.watchedColumns()
+        query = QSqlQuery(self.database())
+        query.prepare("SELECT %s FROM coins WHERE id=?" % ','.join(columns))
+        query.addBindValue(coin_id)
+        query.exec()
+        if query.first():
+            record = query.record()
+            return {record.fieldName(i): record.value(i)
+                    for i in range(record.count())}
+
+        return None
+
     def rowsInsertedEvent(self, parent, start, end):
         self.insertedRowIndex = self.index(end, 0)
 
@@ -238,29 +416,133 @@ class CollectionModel(QSqlTableModel):
             if self.insertedRowIndex.isValid():
                 self.rowInserted.emit(self.insertedRowIndex)
 
+    def beginBulkInsert(self):
+        db = self.database()
+
+        coinRecord = super().record()
+        self._bulkColumns = [coinRecord.fieldName(i)
+                             for i in range(coinRecord.count())
+                             if coinRecord.fieldName(i) != 'id']
+
+        sql = "INSERT INTO coins (%s) VALUES (%s)" % (
+            ', '.join(self._bulkColumns),
+            ', '.join('?' * len(self._bulkColumns)))
+        self._bulkCoinQuery = QSqlQuery(db)
+        self._bulkCoinQuery.prepare(sql)
+        self._bulkImageQuery = QSqlQuery(db)
+        self._bulkImageQuery.prepare("INSERT INTO images (image) VALUES (?)")
+        self._bulkTagQuery = QSqlQuery(db)
+        self._bulkTagQuery.prepare("INSERT INTO coins_tags(coin_id, tag_id) VALUES(?, ?)")
+
+        self._bulkCount = 0
+        self._bulkError = None
+        db.transaction()
+
+        # Images are encoded on worker threads while rows are written
+        self._bulkPreviewHeight = self._previewHeight()
+        self._bulkPool = ThreadPoolExecutor(self._imageWorkers())
+        self._bulkPending = deque()
+
+    def bulkAppendRecord(self, record):
+        images = self._prepareRecord(record)
+        record.setValue('createdat', record.value('updatedat'))
+
+        record.setValue('sort_id', self.collection.nextSortId())
+
+        future = self._bulkPool.submit(processImages, images,
+                                       self.settings['ImageSideLen'],
+                                       self._bulkPreviewHeight,
+                                       self.IMAGE_FORMAT, self.IMAGE_QUALITY)
+        self._bulkPending.append((record, future))
+
+        while len(self._bulkPending) > self._imageWorkers() * 4:
+            self._bulkWrite(*self._bulkPending.popleft())
+
+    def _bulkWrite(self, record, future):
+        self._setProcessedImages(record, future.result())
+
+        # Photos and preview of coin that failed to insert are rolled back
+        QSqlQuery("SAVEPOINT bulk_coin", self.database())
+
+        for field in ImageFields:
+            value = record.value(field)
+            if value:
+                img_id = self._acquirePhoto(record.value(field + '_title'), value)
+                record.setValue(field, img_id)
+            else:
+                record.setNull(field)
+
+        value = record.value('image')
+        if value:
+            self._bulkImageQuery.addBindValue(value)
+            self._bulkImageQuery.exec()
+
+            record.setValue('image', self._bulkImageQuery.lastInsertId())
+        else:
+            record.setNull('image')
+
+        for column in self._bulkColumns:
+            self._bulkCoinQuery.addBindValue(record.value(column))
+        if not self._bulkCoinQuery.exec():
+            self._bulkError = self._bulkCoinQuery.lastError().databaseText()
+            QSqlQuery("ROLLBACK TO bulk_coin", self.database())
+            QSqlQuery("RELEASE bulk_coin", self.database())
+            return
+
+        coin_id = self._bulkCoinQuery.lastInsertId()
+        for tag_id in record.value('tags'):
+            self._bulkTagQuery.addBindValue(coin_id)
+            self._bulkTagQuery.addBindValue(tag_id)
+            self._bulkTagQuery.exec()
+
+        QSqlQuery("RELEASE bulk_coin", self.database())
+
+        # Commit by chunks for limit size of journal
+        self._bulkCount += 1
+        if self._bulkCount % self.BULK_CHUNK_SIZE == 0:
+            self.database().commit()
+            self.database().transaction()
+
+    def endBulkInsert(self):
+        while self._bulkPending:
+            self._bulkWrite(*self._bulkPending.popleft())
+        self._bulkPool.shutdown()
+        self._bulkPool = None
+
+        self._bulkCoinQuery = None
+        self._bulkImageQuery = None
+        self._bulkTagQuery = None
+
+        self.collection.bumpDataGeneration()
+
+        db = self.database()
+        if not db.commit():
+            QMessageBox.critical(
+                self.parent(), self.tr("Saving"),
+                self.tr("Can't save data: %s") % db.lastError().databaseText())
+        elif self._bulkError:
+            # Some coins were skipped
+            QMessageBox.critical(
+                self.parent(), self.tr("Saving"),
+                self.tr("Can't save data: %s") % self._bulkError)
+
+        if self.proxy:
+            self.proxy.setDynamicSortFilter(True)
+
+        self.select()
+
     def insertRecord(self, row, record):
         self._updateRecord(record)
         record.setNull('id')  # remove ID value from record
         record.setValue('createdat', record.value('updatedat'))
 
-        query = QSqlQuery("SELECT MAX(sort_id) FROM coins", self.database())
-        query.first()
-        sort_id = query.record().value(0)
-        if not sort_id:
-            sort_id = 0
-        record.setValue('sort_id', sort_id + 1)
+        record.setValue('sort_id', self.collection.nextSortId())
 
         self.database().transaction()
         for field in ImageFields:
             value = record.value(field)
             if value:
-                query = QSqlQuery(self.database())
-                query.prepare("INSERT INTO photos (title, image) VALUES (?, ?)")
-                query.addBindValue(record.value(field + '_title'))
-                query.addBindValue(value)
-                query.exec()
-
-                img_id = query.lastInsertId()
+                img_id = self._acquirePhoto(record.value(field + '_title'), value)
             else:
                 img_id = None
 
@@ -286,17 +568,41 @@ class CollectionModel(QSqlTableModel):
         return super().insertRecord(row, record)
 
     def setRecord(self, row, record):
-        self._updateRecord(record)
+        changed = self._updateRecord(record)
 
         self.database().transaction()
-        # TODO : check that images was realy changed
+        # Unchanged images keep their photos
         for field in ImageFields:
             img_id = record.value(field + '_id')
-            value = record.value(field)
+            if field in changed:
+                value = record.value(field)
+                if not value:
+                    if img_id:
+                        self._releasePhotos((img_id,))
+
+                        img_id = None
+                else:
+                    # Acquire before releasing for keeping unchanged photo
+                    new_img_id = self._acquirePhoto(record.value(field + '_title'), value)
+                    if img_id:
+                        self._releasePhotos((img_id,))
+                    img_id = new_img_id
+
+            record.remove(record.indexOf(field + '_id'))
+            record.remove(record.indexOf(field + '_title'))
+            if img_id:
+                record.setValue(field, img_id)
+            else:
+                record.setNull(field)
+
+        img_id = record.value('image_id')
+        # Preview is rewritten only when it was composed again
+        if 'image' in changed:
+            value = record.value('image')
             if not value:
                 if img_id:
                     query = QSqlQuery(self.database())
-                    query.prepare("DELETE FROM photos WHERE id=?")
+                    query.prepare("DELETE FROM images WHERE id=?")
                     query.addBindValue(img_id)
                     query.exec()
 
@@ -304,66 +610,34 @@ class CollectionModel(QSqlTableModel):
             else:
                 if img_id:
                     query = QSqlQuery(self.database())
-                    query.prepare("UPDATE photos SET title=?, image=? WHERE id=?")
-                    query.addBindValue(record.value(field + '_title'))
-                    query.addBindValue(record.value(field))
+                    query.prepare("UPDATE images SET image=? WHERE id=?")
+                    query.addBindValue(value)
                     query.addBindValue(img_id)
                     query.exec()
                 else:
                     query = QSqlQuery(self.database())
-                    query.prepare("INSERT INTO photos (title, image) VALUES (?, ?)")
-                    query.addBindValue(record.value(field + '_title'))
-                    query.addBindValue(record.value(field))
+                    query.prepare("INSERT INTO images (image) VALUES (?)")
+                    query.addBindValue(value)
                     query.exec()
 
                     img_id = query.lastInsertId()
 
-            if img_id:
-                record.setValue(field, img_id)
-            else:
-                record.setNull(field)
-            record.remove(record.indexOf(field + '_id'))
-            record.remove(record.indexOf(field + '_title'))
-
-        img_id = record.value('image_id')
-        value = record.value('image')
-        if not value:
-            if img_id:
-                query = QSqlQuery(self.database())
-                query.prepare("DELETE FROM images WHERE id=?")
-                query.addBindValue(img_id)
-                query.exec()
-
-                img_id = None
-        else:
-            if img_id:
-                query = QSqlQuery(self.database())
-                query.prepare("UPDATE images SET image=? WHERE id=?")
-                query.addBindValue(record.value('image'))
-                query.addBindValue(img_id)
-                query.exec()
-            else:
-                query = QSqlQuery(self.database())
-                query.prepare("INSERT INTO images (image) VALUES (?)")
-                query.addBindValue(record.value('image'))
-                query.exec()
-
-                img_id = query.lastInsertId()
-
         coin_id = record.value('id')
 
-        query = QSqlQuery(self.database())
-        query.prepare("DELETE FROM coins_tags WHERE coin_id=?")
-        query.addBindValue(coin_id)
-        query.exec()
-
-        for tag_id in record.value('tags'):
+        # Tags that wasn't loaded can't be changed
+        if not isinstance(record, CoinRecord) or record.isLoaded('tags'):
             query = QSqlQuery(self.database())
-            query.prepare("INSERT INTO coins_tags(coin_id, tag_id) VALUES(?, ?)")
+            query.prepare("DELETE FROM coins_tags WHERE coin_id=?")
             query.addBindValue(coin_id)
-            query.addBindValue(tag_id)
             query.exec()
 
+            for tag_id in record.value('tags'):
+                query = QSqlQuery(self.database())
+                query.prepare("INSERT INTO coins_tags(coin_id, tag_id) VALUES(?, ?)")
+                query.addBindValue(coin_id)
+                query.addBindValue(tag_id)
+                query.exec()
+
         record.remove(record.indexOf('tags'))
         
         self.database().commit()
@@ -377,114 +651,216 @@ class CollectionModel(QSqlTableModel):
         return super().setRecord(row, record)
 
     def setMultiRecord(self, multiRecord, usedFields, rows=None, parent=None):
-        if not rows:
-            rows = range(self.rowCount())
+        # Checked fields of all coins are written by a few set-based
+        # statements instead of saving every record
+        coin_ids = self._coinIds(rows)
+        if not coin_ids:
+            return
 
-        progressDlg = Gui.ProgressDialog(self.tr("Updating records"),
-                            self.tr("Cancel"), len(rows), parent)
+        ids_sql, ids_params = compileFilter(In('id', tuple(coin_ids)))
 
-        new_tags = multiRecord.value('tags')
+        if self.proxy:
+            self.proxy.setDynamicSortFilter(False)
 
-        for i in rows:
-            progressDlg.step()
-            if progressDlg.wasCanceled():
-                break
+        values = {}
+        images = {}
+        titles = {}
+        for j in range(multiRecord.count()):
+            if usedFields[j] != Qt.Checked:
+                continue
 
-            record = self.record(i)
-            for j in range(multiRecord.count()):
-                if usedFields[j] == Qt.Checked:
-                    record.setValue(j, multiRecord.value(j))
-            cur_tags = record.value('tags')
-            for tag_id, state in new_tags.items():
-                if state == Qt.Checked:
-                    if tag_id not in cur_tags:
-                        cur_tags.append(tag_id)
-                elif state == Qt.Unchecked:
-                    if tag_id in cur_tags:
-                        cur_tags.remove(tag_id)
-            record.setValue('tags', cur_tags)
-            self.setRecord(i, record)
+            field = multiRecord.fieldName(j)
+            if field in ImageFields:
+                # Untouched common photo is already used by all coins
+                if not multiRecord.value(field + '_id') or \
+                        multiRecord.isImageChanged(field):
+                    images[field] = multiRecord.value(field)
+            elif field.endswith('_title') and field[:-6] in ImageFields:
+                titles[field[:-6]] = multiRecord.value(j)
+            elif field in self._multiEditColumns():
+                values[field] = multiRecord.value(j)
+
+        images = processImages(images, self.settings['ImageSideLen'],
+                               self._previewHeight(),
+                               self.IMAGE_FORMAT, self.IMAGE_QUALITY, False)
 
-        progressDlg.setLabelText(self.tr("Saving..."))
-        self.submitAll()
-        progressDlg.reset()
+        self.database().transaction()
+
+        for field, image in images.items():
+            img_id = None
+            if image:
+                # Acquire before releasing for keeping unchanged photo
+                img_id = self._acquirePhoto(multiRecord.value(field + '_title'), image)
+                if len(coin_ids) > 1:
+                    self._exec("UPDATE photos SET refs=refs+? WHERE id=?",
+                               (len(coin_ids) - 1, img_id))
+            self._releaseCoinPhotos(field, ids_sql, ids_params)
+
+            values[field] = img_id
+
+        # Photos are titled without changing of images
+        for field, title in titles.items():
+            if field not in images:
+                self._retitleCoinPhotos(field, title, ids_sql, ids_params)
+
+        currentTime = QDateTime.currentDateTimeUtc()
+        values['updatedat'] = currentTime.toString(Qt.ISODateWithMs)
+
+        assignments = ', '.join("%s=?" % field for field in values)
+        self._exec("UPDATE coins SET %s WHERE %s" % (assignments, ids_sql),
+                   tuple(values.values()) + ids_params)
+
+        tags_sql, tags_params = compileFilter(In('coin_id', tuple(coin_ids)))
+        for tag_id, state in multiRecord.value('tags').items():
+            if state == Qt.Checked:
+                sql = "INSERT INTO coins_tags (coin_id, tag_id)" \
+                      " SELECT id, ? FROM coins WHERE %s AND id NOT IN" \
+                      " (SELECT coin_id FROM coins_tags WHERE tag_id=?)" % ids_sql
+                self._exec(sql, (tag_id,) + ids_params + (tag_id,))
+            elif state == Qt.Unchecked:
+                sql = "DELETE FROM coins_tags WHERE tag_id=? AND %s" % tags_sql
+                self._exec(sql, (tag_id,) + tags_params)
+
+        if 'obverseimg' in images or 'reverseimg' in images:
+            self._updatePreviews(ids_sql, ids_params, len(coin_ids), parent)
+
+        self.database().commit()
+
+        self.collection.bumpDataGeneration()
+        self.select()
+
+        if self.proxy:
+            self.proxy.setDynamicSortFilter(True)
 
     def record(self, row=-1):
         if row >= 0:
-            record = super().record(row)
+            record = CoinRecord(self, super().record(row))
         else:
-            record = super().record()
+            record = CoinRecord(self, super().record())
 
+        # Images and tags are loaded only when accessed
         for field in ImageFields:
             record.append(QSqlField(field + '_title'))
             record.append(QSqlField(field + '_id'))
 
             img_id = record.value(field)
             if img_id:
-                data = self.getImage(img_id)
-                record.setValue(field, data)
-                record.setValue(field + '_title', self.getImageTitle(img_id))
                 record.setValue(field + '_id', img_id)
+                record.defer(field, img_id)
             else:
                 record.setValue(field, None)
 
         record.append(QSqlField('image_id'))
         img_id = record.value('image')
         if img_id:
-            data = self.getPreviewImage(img_id)
-            record.setValue('image', data)
             record.setValue('image_id', img_id)
+            record.defer('image', img_id)
         else:
             record.setValue('image', None)
 
-        tag_ids = []
+        record.append(QSqlField('tags'))
         coin_id = record.value('id')
         if coin_id:
-            query = QSqlQuery(self.database())
-            query.prepare("SELECT tag_id FROM coins_tags WHERE coin_id=?")
-            query.addBindValue(coin_id)
-            query.exec()
-
-            while query.next():
-                tag_id = query.record().value(0)
-                tag_ids.append(tag_id)
-
-        record.append(QSqlField('tags'))
-        record.setValue('tags', tag_ids)
+            record.defer('tags', coin_id)
+        else:
+            record.setValue('tags', [])
 
         return record
 
     # Fill multi record for editing
     def multiRecord(self, rows=None):
-        if not rows:
-            rows = range(self.rowCount())
+        coin_ids = self._coinIds(rows)
+        ids_sql, ids_params = compileFilter(In('id', tuple(coin_ids)))
+
+        multiRecord = self.record()
+        # All fields of single coin are used
+        single = (len(coin_ids) == 1)
+        usedFields = [Qt.Checked if single else Qt.Unchecked] * multiRecord.count()
+
+        # Value is common when it is the same not empty value in all coins
+        coinRecord = super().record()
+        columns = [coinRecord.fieldName(i) for i in range(coinRecord.count())]
+        aggregates = ["COUNT(DISTINCT %s), COUNT(%s), MIN(%s)" % (column, column, column)
+                      for column in columns]
+        sql = "SELECT %s FROM coins WHERE %s" % (', '.join(aggregates), ids_sql)
+        query = self._exec(sql, ids_params)
+        query.first()
+        for i, column in enumerate(columns):
+            distinct = query.value(i * 3)
+            count = query.value(i * 3 + 1)
+            value = query.value(i * 3 + 2)
+            isImage = column in ImageFields or column == 'image'
+            if distinct != 1 or count != len(coin_ids) or not value:
+                if single and not isImage:
+                    multiRecord.setValue(column, value)
+                continue
 
-        multiRecord = self.record(rows[0])
+            if isImage:
+                multiRecord.setValue(column + '_id', value)
+                multiRecord.defer(column, value)
+                usedFields[multiRecord.indexOf(column + '_id')] = Qt.Checked
+                if column != 'image' and multiRecord.value(column + '_title'):
+                    usedFields[multiRecord.indexOf(column + '_title')] = Qt.Checked
+            else:
+                multiRecord.setValue(column, value)
+            usedFields[multiRecord.indexOf(column)] = Qt.Checked
+
+        # Tags of all coins are checked and tags of some coins are partially
+        # checked
+        tags_sql, tags_params = compileFilter(In('coin_id', tuple(coin_ids)))
+        sql = "SELECT tag_id, COUNT(*) FROM coins_tags WHERE %s GROUP BY tag_id" % tags_sql
+        query = self._exec(sql, tags_params)
         tags = {}
-        for tag_id in multiRecord.value('tags'):
-            tags[tag_id] = Qt.Checked
-        usedFields = [Qt.Checked] * multiRecord.count()
-        for i in rows[1:]:
-            record = self.record(i)
-
-            tags_diff = set(tags).symmetric_difference(record.value('tags'))
-            for tag_id in tags_diff:
-                tags[tag_id] = Qt.PartiallyChecked
-
-            for j in range(multiRecord.count()):
-                field = record.field(j)
-                if field.name() != 'tags':
-                    value = field.value()
-                    if multiRecord.value(j) != value or not value:
-                        multiRecord.setNull(j)
-                        usedFields[j] = Qt.Unchecked
+        while query.next():
+            if query.value(1) >= len(coin_ids):
+                tags[query.value(0)] = Qt.Checked
+            else:
+                tags[query.value(0)] = Qt.PartiallyChecked
 
         multiRecord.setValue('tags', tags)
-        tags_index = multiRecord.indexOf('tags')
-        usedFields[tags_index] = Qt.Unchecked
+        usedFields[multiRecord.indexOf('tags')] = Qt.Unchecked
 
         return multiRecord, usedFields
 
+    def _coinIds(self, rows=None):
+        # Ids of coins in given rows or of all coins shown by model
+        coin_ids = []
+        if rows:
+            for row in rows:
+                coin_ids.append(super().record(row).value('id'))
+        else:
+            sql = "SELECT id FROM coins"
+            if self.filter():
+                sql += " WHERE " + self.filter()
+            query = self._exec(sql, self.filterParams())
+            while query.next():
+                coin_ids.append(query.value(0))
+
+        return coin_ids
+
+    def _multiEditColumns(self):
+        # Columns that are written directly by mass editing
+        skipped = ('id', 'image', 'sort_id', 'createdat', 'updatedat') + ImageFields
+        coinRecord = super().record()
+        return [coinRecord.fieldName(i) for i in range(coinRecord.count())
+                if coinRecord.fieldName(i) not in skipped]
+
+    def _exec(self, sql, params=()):
+        query = QSqlQuery(self.database())
+        if self._execErrors:
+            # Statements after failed one are skipped
+            return query
+
+        query.prepare(sql)
+        for param in params:
+            query.addBindValue(param)
+        query.exec()
+
+        if self._execErrors is not None and query.lastError().isValid():
+            self._execErrors.append(query.lastError())
+
+        return query
+
     def removeRow(self, row):
         record = super().record(row)
 
@@ -495,13 +871,7 @@ class CollectionModel(QSqlTableModel):
                 ids.append(value)
 
         if ids:
-            ids_sql = '(' + ','.join('?' * len(ids)) + ')'
-
-            query = QSqlQuery(self.database())
-            query.prepare("DELETE FROM photos WHERE id IN " + ids_sql)
-            for id_ in ids:
-                query.addBindValue(id_)
-            query.exec()
+            self._releasePhotos(ids)
 
         value = record.value('image')
         if value:
@@ -519,90 +889,271 @@ class CollectionModel(QSqlTableModel):
 
         return super().removeRow(row)
 
+    @waitCursorDecorator
+    def removeCoins(self, rows):
+        # Coins are deleted together with their photos, previews and tags
+        # in one transaction by set-based statements
+        if not rows:
+            return True
+
+        coin_ids = self._coinIds(rows)
+        ids_sql, ids_params = compileFilter(In('id', tuple(coin_ids)))
+        tags_sql, tags_params = compileFilter(In('coin_id', tuple(coin_ids)))
+
+        self.database().transaction()
+
+        # Whole deleting is rolled back on first failed statement
+        self._execErrors = []
+        try:
+            for field in ImageFields:
+                self._releaseCoinPhotos(field, ids_sql, ids_params)
+
+            sql = "DELETE FROM images WHERE id IN (SELECT image FROM coins WHERE %s)" % ids_sql
+            self._exec(sql, ids_params)
+            self._exec("DELETE FROM coins_tags WHERE %s" % tags_sql, tags_params)
+            self._exec("DELETE FROM coins WHERE %s" % ids_sql, ids_params)
+        finally:
+            errors = self._execErrors
+            self._execErrors = None
+
+        if errors:
+            self.database().rollback()
+
+            error = errors[0]
+
+            if error.nativeErrorCode() == self.SQLITE_READONLY:
+                message = self.tr("file is readonly")
+            else:
+                message = error.databaseText()
+            QMessageBox.critical(
+                self.parent(), self.tr("Saving"),
+                self.tr("Can't save data: %s") % message)
+
+            return False
+
+        self.database().commit()
+
+        self.collection.bumpDataGeneration()
+        self.select()
+
+        return True
+
+    def _acquirePhoto(self, title, image):
+        # Same photos are stored once and shared by reference counter
+        digest = imageDigest(image)
+
+        query = QSqlQuery(self.database())
+        query.prepare("SELECT id FROM photos WHERE hash=? AND ifnull(title, '')=? LIMIT 1")
+        query.addBindValue(digest)
+        query.addBindValue(title or '')
+        query.exec()
+        if query.first():
+            img_id = query.record().value(0)
+
+            query = QSqlQuery(self.database())
+            query.prepare("UPDATE photos SET refs=refs+1 WHERE id=?")
+            query.addBindValue(img_id)
+            query.exec()
+
+            return img_id
+
+        query = QSqlQuery(self.database())
+        query.prepare("INSERT INTO photos (title, image, hash, refs) VALUES (?, ?, ?, 1)")
+        query.addBindValue(title)
+        query.addBindValue(image)
+        query.addBindValue(digest)
+        query.exec()
+
+        return query.lastInsertId()
+
+    def _releasePhotos(self, ids):
+        for img_id in ids:
+            query = QSqlQuery(self.database())
+            query.prepare("UPDATE photos SET refs=refs-1 WHERE id=?")
+            query.addBindValue(img_id)
+            query.exec()
+
+        self._deleteUnusedPhotos(ids)
+
+    def _releaseCoinPhotos(self, field, ids_sql, ids_params):
+        # Releases photos of image field of many coins at once
+        sql = "SELECT DISTINCT %s FROM coins WHERE %s AND %s IS NOT NULL" % (
+            field, ids_sql, field)
+        query = self._exec(sql, ids_params)
+        ids = []
+        while query.next():
+            ids.append(query.value(0))
+        if not ids:
+            return
+
+        sql = "UPDATE photos SET refs=refs-(SELECT COUNT(*) FROM coins" \
+              " WHERE coins.%s=photos.id AND %s) WHERE id IN" \
+              " (SELECT %s FROM coins WHERE %s)" % (field, ids_sql, field, ids_sql)
+        self._exec(sql, ids_params + ids_params)
+
+        self._deleteUnusedPhotos(ids)
+
+    def _retitleCoinPhotos(self, field, title, ids_sql, ids_params):
+        # Photos of image field of many coins are replaced with photos with
+        # same image and new title
+        sql = "SELECT %s, COUNT(*) FROM coins WHERE %s AND %s IS NOT NULL" \
+              " GROUP BY %s" % (field, ids_sql, field, field)
+        query = self._exec(sql, ids_params)
+        photos = []
+        while query.next():
+            photos.append((query.value(0), query.value(1)))
+        if not photos:
+            return
+
+        for img_id, count in photos:
+            # Prefer current photo when it already has this title
+            query = self._exec("SELECT id FROM photos WHERE (id=? OR hash="
+                               "(SELECT hash FROM photos WHERE id=?))"
+                               " AND ifnull(title, '')=? ORDER BY id<>? LIMIT 1",
+                               (img_id, img_id, title or '', img_id))
+            if query.first():
+                new_img_id = query.value(0)
+                if new_img_id == img_id:
+                    continue
+
+                self._exec("UPDATE photos SET refs=refs+? WHERE id=?",
+                           (count, new_img_id))
+            else:
+                query = self._exec("INSERT INTO photos (title, image, hash, refs)"
+                                   " SELECT ?, image, hash, ? FROM photos WHERE id=?",
+                                   (title, count, img_id))
+                new_img_id = query.lastInsertId()
+
+            sql = "UPDATE coins SET %s=? WHERE %s=? AND %s" % (field, field, ids_sql)
+            self._exec(sql, (new_img_id, img_id) + ids_params)
+            self._exec("UPDATE photos SET refs=refs-? WHERE id=?",
+                       (count, img_id))
+
+        self._deleteUnusedPhotos([img_id for img_id, _count in photos])
+
+    def _deleteUnusedPhotos(self, ids):
+        ids_sql, ids_params = compileFilter(In('id', tuple(ids)))
+
+        sql = "DELETE FROM photo_hashes WHERE photo_id IN" \
+              " (SELECT id FROM photos WHERE refs<=0 AND %s)" % ids_sql
+        self._exec(sql, ids_params)
+
+        sql = "DELETE FROM photos WHERE refs<=0 AND %s" % ids_sql
+        self._exec(sql, ids_params)
+
+    def _updatePreviews(self, ids_sql, ids_params, count, parent=None):
+        # Previews are composed again for coins with changed obverse or reverse
+        progressDlg = Gui.ProgressDialog(self.tr("Updating records"),
+                                         self.tr("Cancel"), count, parent)
+
+        height = self._previewHeight()
+
+        sql = "SELECT id, image, obverseimg, reverseimg FROM coins WHERE %s" % ids_sql
+        query = self._exec(sql, ids_params)
+        coins = []
+        while query.next():
+            coins.append(tuple(query.value(i) for i in range(4)))
+
+        for coin_id, img_id, obverse_id, reverse_id in coins:
+            progressDlg.step()
+
+            obverse = None
+            if obverse_id:
+                obverse = self.getImage(obverse_id)
+            reverse = None
+            if reverse_id:
+                reverse = self.getImage(reverse_id)
+
+            value = previewImage(obverse, reverse, height)
+            if value:
+                if img_id:
+                    self._exec("UPDATE images SET image=? WHERE id=?",
+                               (value, img_id))
+                else:
+                    query = self._exec("INSERT INTO images (image) VALUES (?)",
+                                       (value,))
+                    self._exec("UPDATE coins SET image=? WHERE id=?",
+                               (query.lastInsertId(), coin_id))
+            elif img_id:
+                self._exec("DELETE FROM images WHERE id=?", (img_id,))
+                self._exec("UPDATE coins SET image=NULL WHERE id=?", (coin_id,))
+
+        progressDlg.reset()
+
     def _updateRecord(self, record):
+        # Returns names of changed image fields
+        images = self._prepareRecord(record)
+        changed = set(images)
+
+        # Preview is composed only when obverse or reverse image changed
+        preview = False
+        for field in ('obverseimg', 'reverseimg'):
+            if field in changed:
+                if not isinstance(record, CoinRecord) or \
+                        record.isImageChanged(field, withTitle=False):
+                    preview = True
+        if preview:
+            for field in ('obverseimg', 'reverseimg'):
+                if field not in images:
+                    images[field] = record.value(field)
+            changed.add('image')
+
+        processed = processImages(images, self.settings['ImageSideLen'],
+                                  self._previewHeight(),
+                                  self.IMAGE_FORMAT, self.IMAGE_QUALITY,
+                                  preview)
+        self._setProcessedImages(record, processed)
+
+        return changed
+
+    def _prepareRecord(self, record):
+        # Updates record except of images and returns changed images for
+        # processing
         if self.proxy:
             self.proxy.setDynamicSortFilter(False)
 
         for field in self.fields.userFields:
             if field.type == Type.Image:
-                # Convert image to DB format
+                if isinstance(record, CoinRecord) and not record.isLoaded(field.name):
+                    continue
+
                 image = record.value(field.name)
                 if isinstance(image, str):
                     # Copying record as text (from Excel) store missed images
                     # as string
                     record.setNull(field.name)
-                elif isinstance(image, QImage):
-                    buffer = QBuffer()
-                    buffer.open(QIODevice.WriteOnly)
-
-                    # Resize big images for storing in DB
-                    sideLen = self.settings['ImageSideLen']
-                    if sideLen > 0:
-                        maxWidth = sideLen
-                        maxHeight = sideLen
-                        if image.width() > maxWidth or image.height() > maxHeight:
-                            image = image.scaled(maxWidth, maxHeight,
-                                    Qt.KeepAspectRatio, Qt.SmoothTransformation)
-
-                    image.save(buffer, self.IMAGE_FORMAT, self.IMAGE_QUALITY)
-                    record.setValue(field.name, buffer.data())
                 elif isinstance(image, bytes):
                     ba = QByteArray(image)
                     record.setValue(field.name, ba)
 
-        # Creating preview image for list
-        self._recalculateImage(record)
-
         currentTime = QDateTime.currentDateTimeUtc()
         # currentTime.setTimeSpec(Qt.LocalTime)
         record.setValue('updatedat', currentTime.toString(Qt.ISODateWithMs))
 
-    def _recalculateImage(self, record):
-        # Creating preview image for list
-        if record.isNull('obverseimg') and record.isNull('reverseimg'):
-            record.setNull('image')
-        else:
-            # Get height of list view for resizing images
-            tmp = QTableView()
-            height_multiplex = self.settings['image_height']
-            height = int(tmp.verticalHeader().defaultSectionSize() * height_multiplex - 1)
-
-            obverseImage = QImage()
-            reverseImage = QImage()
-
-            if not record.isNull('obverseimg'):
-                obverseImage.loadFromData(record.value('obverseimg'))
-                obverseImage = obverseImage.scaledToHeight(height,
-                                                    Qt.SmoothTransformation)
-            if not record.isNull('reverseimg') and reverseImage.isNull():
-                reverseImage.loadFromData(record.value('reverseimg'))
-                reverseImage = reverseImage.scaledToHeight(height,
-                                                    Qt.SmoothTransformation)
-
-            if obverseImage.hasAlphaChannel() or reverseImage.hasAlphaChannel():
-                image = QImage(obverseImage.width() + reverseImage.width(),
-                               height, QImage.Format_ARGB32)
-                image.fill(Qt.transparent)
-            else:
-                image = QImage(obverseImage.width() + reverseImage.width(),
-                               height, QImage.Format_RGB32)
-                image.fill(Qt.white)
+        images = {}
+        for field in ImageFields:
+            if isinstance(record, CoinRecord) and not record.isImageChanged(field):
+                continue
+            images[field] = record.value(field)
 
-            paint = QPainter(image)
-            if not record.isNull('obverseimg'):
-                paint.drawImage(QRectF(0, 0, obverseImage.width(), height), obverseImage,
-                                QRectF(0, 0, obverseImage.width(), height))
-            if not record.isNull('reverseimg'):
-                paint.drawImage(QRectF(obverseImage.width(), 0, reverseImage.width(), height), reverseImage,
-                                QRectF(0, 0, reverseImage.width(), height))
-            paint.end()
+        return images
 
-            buffer = QBuffer()
-            buffer.open(QIODevice.WriteOnly)
+    def _setProcessedImages(self, record, images):
+        for field, value in images.items():
+            if value:
+                record.setValue(field, value)
+            else:
+                record.setNull(field)
 
-            # Store as lossless WebP for better view
-            image.save(buffer, 'webp', 100)
-            record.setValue('image', buffer.data())
+    def _previewHeight(self):
+        # Get height of list view for resizing images
+        tmp = QTableView()
+        height_multiplex = self.settings['image_height']
+        return int(tmp.verticalHeader().defaultSectionSize() * height_multiplex - 1)
+
+    @staticmethod
+    def _imageWorkers():
+        return os.cpu_count() or 1
 
     def moveRows(self, row1, row2):
         if self.proxy:
@@ -611,24 +1162,34 @@ class CollectionModel(QSqlTableModel):
             sort_column_id = self.fields.sort_id.id
             self.sort(sort_column_id, Qt.AscendingOrder)
 
-        row_rang = []
-        if row2 == -1:
-            row_rang = range(row1 + 1, self.rowCount())
-        elif row1 > row2:
-            row_rang = range(row1 - 1, row2 - 1, -1)
-        elif row1 < row2:
-            row_rang = range(row1 + 1, row2 + 1)
+        self.__fetchRow(max(row1, row2) + 1)
+
+        # Only moved row is written. It gets position between its new
+        # neighbours
+        if row1 != row2 and not (row2 == -1 and row1 == self.rowCount() - 1):
+            sort_id = self.__sortIdBetween(row1, row2)
+            if sort_id is None:
+                error = self.collection.rebalanceSortIds()
+                if error.isValid():
+                    if error.nativeErrorCode() == self.SQLITE_READONLY:
+                        message = self.tr("file is readonly")
+                    else:
+                        message = error.databaseText()
+                    QMessageBox.critical(
+                        self.parent(), self.tr("Saving"),
+                        self.tr("Can't save data: %s") % message)
+
+                    if self.proxy:
+                        self.proxy.setDynamicSortFilter(True)
+                        self.sort(-1, Qt.AscendingOrder)
+                    return
+
+                super().select()
+                self.__fetchRow(max(row1, row2) + 1)
+                sort_id = self.__sortIdBetween(row1, row2)
 
-        if row_rang:
             record = super().record(row1)
-            old_sort_id = record.value('sort_id')
-            for row in row_rang:
-                record1 = super().record(row)
-                sort_id = record1.value('sort_id')
-                record1.setValue('sort_id', old_sort_id)
-                super().setRecord(row, record1)
-                old_sort_id = sort_id
-            record.setValue('sort_id', old_sort_id)
+            record.setValue('sort_id', sort_id)
             super().setRecord(row1, record)
 
         self.submitAll()
@@ -636,15 +1197,49 @@ class CollectionModel(QSqlTableModel):
         if self.proxy:
             self.sort(-1, Qt.AscendingOrder)
 
+    def __fetchRow(self, row):
+        while self.rowCount() <= row and self.canFetchMore():
+            self.fetchMore()
+
+    def __sortIdBetween(self, row1, row2):
+        # Position for placing row1 at row2 or None when there is no gap
+        if row2 == -1:
+            return self.collection.nextSortId()
+
+        if row1 > row2:
+            before, after = row2 - 1, row2
+        else:
+            before, after = row2, row2 + 1
+
+        if after >= self.rowCount():
+            return self.collection.nextSortId()
+
+        low = 0
+        if before >= 0:
+            low = super().record(before).value('sort_id')
+        high = super().record(after).value('sort_id')
+        if high - low < 2:
+            return None
+
+        return (low + high) // 2
+
     @waitCursorDecorator
     def setRowsPos(self, indexes):
         sorted_ids = sorted([index.data(Qt.UserRole) for index in indexes])
+        positions = []
         for index, sort_id in zip(indexes, sorted_ids):
-            record = super().record(index.row())
-            record.setValue('sort_id', sort_id)
-            super().setRecord(index.row(), record)
+            if index.data(Qt.UserRole) != sort_id:
+                coin_id = super().record(index.row()).value('id')
+                positions.append((coin_id, sort_id))
 
-        self.submitAll()
+        # All changed positions are written by one statement
+        if positions:
+            sql = "UPDATE coins SET sort_id=json_extract(positions.value, '$[1]')" \
+                  " FROM json_each(?) AS positions" \
+                  " WHERE coins.id=json_extract(positions.value, '$[0]')"
+            self._exec(sql, (json.dumps(positions),))
+
+        self.select()
 
     def recalculateAllImages(self, parent=None):
         while self.canFetchMore():
@@ -657,25 +1252,53 @@ class CollectionModel(QSqlTableModel):
         progressDlg = Gui.ProgressDialog(self.tr("Updating records"),
                                          self.tr("Cancel"), rowCount, parent)
 
-        self.database().transaction()
+        height = self._previewHeight()
+        workers = self._imageWorkers()
+        pending = deque()
 
-        for row in range(rowCount):
-            progressDlg.step()
-            if progressDlg.wasCanceled():
-                break
+        query = QSqlQuery(self.database())
+        query.prepare("UPDATE images SET image=? WHERE id=?")
 
-            record = self.record(row)
-            self._recalculateImage(record)
-            img_id = record.value('image_id')
-            value = record.value('image')
-            if value and img_id:
-                query = QSqlQuery(self.database())
-                query.prepare("UPDATE images SET image=? WHERE id=?")
-                query.addBindValue(record.value('image'))
+        def writePreview(img_id, future):
+            value = future.result()
+            if value:
+                query.addBindValue(value)
                 query.addBindValue(img_id)
                 query.exec()
 
-        progressDlg.setLabelText(self.tr("Saving..."))
+        self.database().transaction()
+
+        # Previews are composed on worker threads while results are written
+        with ThreadPoolExecutor(workers) as pool:
+            for row in range(rowCount):
+                progressDlg.step()
+                if progressDlg.wasCanceled():
+                    break
+
+                record = super().record(row)
+                img_id = record.value('image')
+                if not img_id:
+                    continue
+
+                obverse = None
+                obverse_id = record.value('obverseimg')
+                if obverse_id:
+                    obverse = self.getImage(obverse_id)
+                reverse = None
+                reverse_id = record.value('reverseimg')
+                if reverse_id:
+                    reverse = self.getImage(reverse_id)
+
+                future = pool.submit(previewImage, obverse, reverse, height)
+                pending.append((img_id, future))
+
+                while len(pending) > workers * 4:
+                    writePreview(*pending.popleft())
+
+            progressDlg.setLabelText(self.tr("Saving..."))
+
+            while pending:
+                writePreview(*pending.popleft())
 
         self.database().commit()
 
@@ -698,12 +1321,85 @@ class CollectionModel(QSqlTableModel):
         return ret
 
     def select(self):
-        ret = super().select()
+        ret = self.__select()
 
         self.modelChanged.emit()
 
         return ret
 
+    def __select(self):
+        # Coins found by background search are selected by their ids instead
+        # of evaluating search filter again
+        if self.foundCount() is not None:
+            filter_ = "id IN (SELECT value FROM json_each(?))"
+            params = (self.__found[4],)
+        else:
+            filter_ = self.filter()
+            params = self.filterParams()
+
+        if not params:
+            return super().select()
+
+        # QSqlTableModel can't bind filter values. Base class clears edited
+        # rows with empty select and then bound query is set
+        self.__emptySelect = True
+        ret = super().select()
+        self.__emptySelect = False
+        if not ret:
+            return ret
+
+        sql = "SELECT * FROM coins WHERE " + filter_
+        orderBy = self.orderByClause()
+        if orderBy:
+            sql += ' ' + orderBy
+        query = self._exec(sql, params)
+        self.setQuery(query)
+
+        return query.isActive()
+
+    def selectStatement(self):
+        if self.__emptySelect:
+            return "SELECT * FROM coins WHERE 0"
+
+        return super().selectStatement()
+
+    def setSort(self, column, order):
+        self.sortColumn = column
+        self.sortOrder = order
+        super().setSort(column, order)
+
+    def sortInDatabase(self, column, order):
+        self.setSort(column, order)
+        # Filter not changed - skip modelChanged signal
+        self.__select()
+
+    def orderByClause(self):
+        if self.sortColumn < 0 or self.sortColumn >= len(self.fields.fields):
+            return ''
+
+        field = self.fields.fields[self.sortColumn]
+        if field.name == 'status':
+            cases = ["WHEN '%s' THEN %d" % (status, Statuses.order(status))
+                     for status in Statuses.keys()]
+            expr = "CASE status %s ELSE 0 END" % ' '.join(cases)
+        elif field.name == 'year':
+            expr = "CAST(year AS INTEGER)"
+        elif field.type in (Type.String, Type.ShortString, Type.Text):
+            expr = "%s COLLATE NOCASE" % field.name
+        else:
+            expr = field.name
+
+        if self.sortOrder == Qt.DescendingOrder:
+            direction = 'DESC'
+        else:
+            direction = 'ASC'
+
+        clause = "ORDER BY %s %s" % (expr, direction)
+        if field.name != 'sort_id':
+            clause += ", sort_id %s" % direction
+
+        return clause
+
     def columnType(self, column):
         if isinstance(column, QModelIndex):
             column = column.column()
@@ -724,6 +1420,24 @@ class CollectionModel(QSqlTableModel):
         if query.first():
             return query.record().value(0)
 
+    def getImages(self, ids):
+        ids = tuple(ids)
+        ids_sql = '(' + ','.join('?' * len(ids)) + ')'
+
+        query = QSqlQuery(self.database())
+        query.prepare("SELECT id, title, image, hash FROM photos WHERE id IN " + ids_sql)
+        for id_ in ids:
+            query.addBindValue(id_)
+        query.exec()
+
+        images = {}
+        while query.next():
+            record = query.record()
+            images[record.value(0)] = (record.value(1), record.value(2),
+                                       record.value(3))
+
+        return images
+
     def getPreviewImage(self, img_id):
         query = QSqlQuery(self.database())
         query.prepare("SELECT image FROM images WHERE id=?")
@@ -740,40 +1454,78 @@ class CollectionModel(QSqlTableModel):
         if query.first():
             return query.record().value(0)
 
+    def getTags(self, coin_id):
+        query = QSqlQuery(self.database())
+        query.prepare("SELECT tag_id FROM coins_tags WHERE coin_id=?")
+        query.addBindValue(coin_id)
+        query.exec()
+
+        tag_ids = []
+        while query.next():
+            tag_id = query.record().value(0)
+            tag_ids.append(tag_id)
+
+        return tag_ids
+
     def clearFilters(self):
         self.intFilter = ''
+        self.intParams = ()
         self.searchFilter = ''
         self.__applyFilter()
 
-    def setFilter(self, filter_):
+    def setFilter(self, filter_, params=()):
         self.intFilter = filter_
+        self.intParams = tuple(params)
         self.__applyFilter()
 
-    def setAdditionalFilter(self, filter_):
+    def setAdditionalFilter(self, filter_, params=()):
         self.extFilter = filter_
+        self.extParams = tuple(params)
         self.__applyFilter()
 
-    def setSearchFilter(self, filter_):
+    def setSearchFilter(self, filter_, foundIds=None):
         self.searchFilter = filter_
+        if foundIds is not None:
+            self.__found = (self.combinedFilter(filter_), self.filterParams(),
+                            self.dataGeneration(), len(foundIds),
+                            json.dumps(foundIds))
         self.__applyFilter()
 
-    def __applyFilter(self):
+    def filterParams(self):
+        # Bind values of placeholders in filter()
+        params = ()
+        if self.intFilter:
+            params += self.intParams
+        if self.extFilter:
+            params += self.extParams
+        return params
+
+    def foundCount(self):
+        # Found ids are valid until filters or coins changed
+        if self.__found and self.__found[:3] == (
+                self.filter(), self.filterParams(), self.dataGeneration()):
+            return self.__found[3]
+
+        return None
+
+    def combinedFilter(self, searchFilter):
         filters = []
         if self.intFilter:
             filters.append(self.intFilter)
         if self.extFilter:
             filters.append(self.extFilter)
-        if self.searchFilter:
-            filters.append(self.searchFilter)
-        combinedFilter = ' AND '.join(filters)
-
-        # Checking for SQLITE_MAX_SQL_LENGTH (default value - 1 000 000)
-        if len(combinedFilter) > 900000:
-            QMessageBox.warning(self.parent(),
-                            self.tr("Filtering"),
-                            self.tr("Filter is too complex. Will be ignored"))
-            return
+        if searchFilter:
+            filters.append(searchFilter)
+        return ' AND '.join(filters)
 
+    def __applyFilter(self):
+        combinedFilter = self.combinedFilter(self.searchFilter)
+        if self.__found and self.__found[:2] != (combinedFilter,
+                                                 self.filterParams()):
+            self.__found = None
+
+        # Large value sets are bound as JSON arrays, so filter is never
+        # close to SQLITE_MAX_SQL_LENGTH
         super().setFilter(combinedFilter)
 
     def isExist(self, record):
@@ -801,7 +1553,7 @@ class CollectionModel(QSqlTableModel):
 
 class CollectionSettings(BaseSettings):
     Default = {
-            'Version': 10,
+            'Version': 11,
             'Type': version.AppName,
             'Password': cryptPassword(),
             'ImageSideLen': 1024,
@@ -944,18 +1696,147 @@ class CollectionSettings(BaseSettings):
 
 
 class Collection(QObject):
+    # Old and new values of changed coin or None, None for many changes
+    coinsChanged = pyqtSignal(object, object)
+    # Columns used in lookups by application itself
+    CoinsIndexes = ('createdat', 'updatedat', 'status', 'sort_id')
+    CoinsTagsIndexes = ('coin_id', 'tag_id')
+    PhotosIndexes = ('hash',)
+    # Indexes created for columns of saved filters and tree levels
+    AdvisedIndexPrefix = 'coins_advised_'
+    STATEMENT_CACHE_SIZE = 32
+    # Gap between positions of neighbour coins, so a coin can be moved by
+    # changing only its own position
+    SORT_ID_STEP = 1024
+
     def __init__(self, parent=None):
         super().__init__(parent)
 
         self.db = QSqlDatabase.addDatabase('QSQLITE')
         self._pages = None
         self.fileName = None
+        # Bumped on every write to coins table, so cached aggregates
+        # stay valid until collection data changed
+        self.dataGeneration = 0
+        self._queryService = None
+        self._interruptibleQueryService = None
+        self._imageQueryService = None
+        self._fullTextFields = None
+        # Prepared statements by SQL text
+        self._statements = OrderedDict()
+        # Position for next new coin, shared by models of all pages
+        self._nextSortId = None
+        # Columns sent by coinsChanged for each watching view
+        self._watchedColumns = {}
+
+    def bumpDataGeneration(self, old=None, new=None):
+        self.dataGeneration += 1
+        self.coinsChanged.emit(old, new)
+
+    def watchColumns(self, owner, columns):
+        key = id(owner)
+        if key not in self._watchedColumns:
+            owner.destroyed.connect(lambda: self._watchedColumns.pop(key, None))
+        self._watchedColumns[key] = tuple(columns)
+
+    def watchedColumns(self):
+        columns = set()
+        for owner_columns in self._watchedColumns.values():
+            columns.update(owner_columns)
+        columns.discard('id')
+        return sorted(columns)
+
+    def nextSortId(self):
+        if self._nextSortId is None:
+            query = QSqlQuery("SELECT ifnull(MAX(sort_id), 0) FROM coins", self.db)
+            query.first()
+            self._nextSortId = query.record().value(0)
+
+        self._nextSortId += self.SORT_ID_STEP
+        return self._nextSortId
+
+    def rebalanceSortIds(self):
+        # Spreads positions of all coins with equal gaps when there is no
+        # free position between neighbours. Returns error of update
+        sql = f"""UPDATE coins SET sort_id=positions.pos*{self.SORT_ID_STEP}
+            FROM (SELECT id, ROW_NUMBER() OVER (ORDER BY sort_id, id) AS pos
+                  FROM coins) AS positions
+            WHERE coins.id=positions.id"""
+        query = QSqlQuery(sql, self.db)
+
+        self._nextSortId = None
+
+        return query.lastError()
+
+    def queryService(self):
+        # Read-only connection for long queries of views
+        if not self._queryService:
+            self._queryService = QueryService(self.fileName, self)
+        return self._queryService
+
+    def interruptibleQueryService(self):
+        # Connection for queries superseded by next one, like quick search
+        if not self._interruptibleQueryService:
+            self._interruptibleQueryService = InterruptibleQueryService(self.fileName, self)
+        return self._interruptibleQueryService
+
+    def imageQueryService(self):
+        # Thumbnails are read on own connection and don't wait for long
+        # queries of statistics and summary
+        if not self._imageQueryService:
+            self._imageQueryService = QueryService(self.fileName, self)
+        return self._imageQueryService
+
+    def closeQueryService(self):
+        if self._queryService:
+            self._queryService.close()
+            self._queryService = None
+        if self._interruptibleQueryService:
+            self._interruptibleQueryService.close()
+            self._interruptibleQueryService = None
+        if self._imageQueryService:
+            self._imageQueryService.close()
+            self._imageQueryService = None
+
+    def cachedQuery(self, sql):
+        # Statements of repeated queries, like counting coins after every
+        # select, are prepared once and reused
+        if sql in self._statements:
+            self._statements.move_to_end(sql)
+            return self._statements[sql]
+
+        query = QSqlQuery(self.db)
+        query.setForwardOnly(True)
+        query.prepare(sql)
+
+        self._statements[sql] = query
+        if len(self._statements) > self.STATEMENT_CACHE_SIZE:
+            self._statements.popitem(last=False)
+
+        return query
+
+    def queryValue(self, sql, params=()):
+        query = self.cachedQuery(sql)
+        for param in params:
+            query.addBindValue(param)
+        query.exec()
+
+        value = None
+        if query.next():
+            value = query.value(0)
+        query.finish()
+
+        return value
 
     def isOpen(self):
         return self.db.isValid() and self.fileName
 
     def open(self, fileName):
         self.fileName = None
+        self.closeQueryService()
+        self._fullTextFields = None
+        self._statements.clear()
+        self._nextSortId = None
 
         file = QFileInfo(fileName)
         if file.isFile():
@@ -1008,15 +1889,22 @@ class Collection(QObject):
             return False
 
         self._pages = CollectionPages(self.db)
+        self.bumpDataGeneration()
 
         self.description = CollectionDescription(self)
 
         self.__speedup()
 
+        self.adviseIndexes()
+
         return True
 
     def create(self, fileName):
         self.fileName = None
+        self.closeQueryService()
+        self._fullTextFields = None
+        self._statements.clear()
+        self._nextSortId = None
 
         if QFileInfo(fileName).exists():
             QMessageBox.critical(self.parent(),
@@ -1039,10 +1927,13 @@ class Collection(QObject):
         self.createCoinsTable()
         self.createTagsTable()
         self.createPricesTable()
+        self.createPhotoHashesTable()
+        self.createFullTextIndex()
 
         self.fileName = fileName
 
         self._pages = CollectionPages(self.db)
+        self.bumpDataGeneration()
 
         self.description = CollectionDescription(self)
 
@@ -1074,12 +1965,96 @@ class Collection(QObject):
         sql = "CREATE TABLE coins (" + ", ".join(sqlFields) + ")"
         QSqlQuery(sql, self.db)
 
-        sql = "CREATE TABLE photos (id INTEGER PRIMARY KEY, title TEXT, image BLOB)"
+        sql = """CREATE TABLE photos (
+            id INTEGER PRIMARY KEY, title TEXT, image BLOB,
+            hash TEXT, refs INTEGER)"""
         QSqlQuery(sql, self.db)
 
         sql = "CREATE TABLE images (id INTEGER PRIMARY KEY, image BLOB)"
         QSqlQuery(sql, self.db)
 
+        for column in self.CoinsIndexes:
+            self._createIndex('coins', column)
+        for column in self.PhotosIndexes:
+            self._createIndex('photos', column)
+
+    def createIndexes(self):
+        for column in self.CoinsIndexes:
+            self._createIndex('coins', column)
+        for column in self.PhotosIndexes:
+            self._createIndex('photos', column)
+        for column in self.CoinsTagsIndexes:
+            self._createIndex('coins_tags', column)
+
+    def updatePhotoRefs(self, ids_sql=None):
+        # Recount references from coins to shared photos
+        sql = " UNION ALL ".join(["SELECT %s AS id FROM coins" % field
+                                  for field in ImageFields])
+
+        QSqlQuery("""CREATE TEMP TABLE photo_refs (
+            id INTEGER PRIMARY KEY, refs INTEGER)""", self.db)
+        QSqlQuery("""INSERT INTO temp.photo_refs (id, refs)
+            SELECT id, COUNT(*) FROM (%s)
+            WHERE id IS NOT NULL GROUP BY id""" % sql, self.db)
+
+        sql = """UPDATE photos SET refs=ifnull(
+            (SELECT refs FROM temp.photo_refs WHERE photo_refs.id=photos.id), 0)"""
+        if ids_sql:
+            sql += " WHERE id IN (%s)" % ids_sql
+        QSqlQuery(sql, self.db)
+
+        QSqlQuery("DROP TABLE temp.photo_refs", self.db)
+
+    def _createIndex(self, table, column):
+        sql = "CREATE INDEX IF NOT EXISTS %s_%s_idx ON %s (%s)" % (
+            table, column, table, column)
+        QSqlQuery(sql, self.db)
+
+    def adviseIndexes(self):
+        # Keep indexes for columns used in saved filters and tree levels.
+        # They are named with own prefix, so indexes of columns which are
+        # not used anymore are dropped
+        names = set()
+        for page in self._pages.pagesParam():
+            names.update(page.treeParam.usedFieldNames())
+            listParam = getattr(page, 'listParam', None)
+            if listParam:
+                for fieldId in listParam.filters.keys():
+                    names.add(self.fields.field(fieldId).name)
+
+        advised = set()
+        for name in names:
+            field = getattr(self.fields, name, None)
+            if not field or field.type in Type.ImageTypes or field.type == Type.Text:
+                continue
+            if name in self.CoinsIndexes:
+                continue
+
+            advised.add(self.AdvisedIndexPrefix + name)
+
+        existing = set()
+        query = QSqlQuery(self.db)
+        query.prepare("SELECT name FROM sqlite_master"
+                      " WHERE type='index' AND tbl_name='coins'"
+                      " AND substr(name, 1, ?)=?")
+        query.addBindValue(len(self.AdvisedIndexPrefix))
+        query.addBindValue(self.AdvisedIndexPrefix)
+        query.exec()
+        while query.next():
+            existing.add(query.record().value(0))
+
+        if advised == existing:
+            return
+
+        self.db.transaction()
+        for index in sorted(existing - advised):
+            QSqlQuery("DROP INDEX IF EXISTS %s" % index, self.db)
+        for index in sorted(advised - existing):
+            column = index[len(self.AdvisedIndexPrefix):]
+            QSqlQuery("CREATE INDEX IF NOT EXISTS %s ON coins (%s)" % (
+                index, column), self.db)
+        self.db.commit()
+
     def createTagsTable(self):
         sql = """CREATE TABLE tags (
                     id INTEGER NOT NULL PRIMARY KEY,
@@ -1093,6 +2068,22 @@ class Collection(QObject):
                     tag_id INTEGER)"""
         QSqlQuery(sql, self.db)
 
+        for column in self.CoinsTagsIndexes:
+            self._createIndex('coins_tags', column)
+
+        self.createTagsClosureTable()
+
+    def createTagsClosureTable(self):
+        # Tag subtrees, so coins of a tag with its subtags are selected
+        # with one indexed query
+        sql = """CREATE TABLE IF NOT EXISTS tags_closure (
+                    ancestor_id INTEGER NOT NULL,
+                    descendant_id INTEGER NOT NULL,
+                    PRIMARY KEY (ancestor_id, descendant_id)) WITHOUT ROWID"""
+        QSqlQuery(sql, self.db)
+
+        updateTagsClosure(self.db)
+
     def createPricesTable(self):
         sql = """CREATE TABLE prices (
                     id INTEGER NOT NULL PRIMARY KEY,
@@ -1107,6 +2098,83 @@ class Collection(QObject):
                     grade TEXT)"""
         QSqlQuery(sql, self.db)
 
+    def createPhotoHashesTable(self):
+        # Cache of perceptual hashes for search by image
+        sql = """CREATE TABLE IF NOT EXISTS photo_hashes (
+                    photo_id INTEGER NOT NULL,
+                    method TEXT NOT NULL,
+                    digest TEXT,
+                    hash TEXT,
+                    PRIMARY KEY (photo_id, method))"""
+        QSqlQuery(sql, self.db)
+
+        self._createIndex('photo_hashes', 'digest')
+
+    def createFullTextIndex(self):
+        # Index of text columns for quick search. External content table
+        # keeps only index, triggers keep it in sync with coins
+        fields = [field.name for field in self.fields
+                  if field.type in (Type.String, Type.ShortString, Type.Text)]
+
+        sql = """CREATE VIRTUAL TABLE coins_fts USING fts5(%s,
+                    content='coins', content_rowid='id',
+                    tokenize='unicode61 remove_diacritics 2',
+                    prefix='2 3')""" % ', '.join(fields)
+        query = QSqlQuery(self.db)
+        if not query.exec(sql):
+            # SQLite without FTS5. Quick search falls back to LIKE
+            print(query.lastError().text())
+            return False
+
+        sql_fields = ', '.join(fields)
+        new_fields = ', '.join(['new.' + field for field in fields])
+        old_fields = ', '.join(['old.' + field for field in fields])
+
+        sql = f"""CREATE TRIGGER coins_fts_insert AFTER INSERT ON coins BEGIN
+            INSERT INTO coins_fts (rowid, {sql_fields}) VALUES (new.id, {new_fields});
+            END"""
+        QSqlQuery(sql, self.db)
+        sql = f"""CREATE TRIGGER coins_fts_delete AFTER DELETE ON coins BEGIN
+            INSERT INTO coins_fts (coins_fts, rowid, {sql_fields})
+                VALUES ('delete', old.id, {old_fields});
+            END"""
+        QSqlQuery(sql, self.db)
+        # Changing of other columns (sort order, images) don't touch index
+        sql = f"""CREATE TRIGGER coins_fts_update AFTER UPDATE OF {sql_fields} ON coins BEGIN
+            INSERT INTO coins_fts (coins_fts, rowid, {sql_fields})
+                VALUES ('delete', old.id, {old_fields});
+            INSERT INTO coins_fts (rowid, {sql_fields}) VALUES (new.id, {new_fields});
+            END"""
+        QSqlQuery(sql, self.db)
+
+        sql = "INSERT INTO coins_fts (coins_fts) VALUES ('rebuild')"
+        QSqlQuery(sql, self.db)
+
+        self._fullTextFields = None
+
+        return True
+
+    def fullTextFields(self):
+        if self._fullTextFields is None:
+            self._fullTextFields = []
+            if 'coins_fts' in self.db.tables():
+                record = self.db.record('coins_fts')
+                for i in range(record.count()):
+                    self._fullTextFields.append(record.fieldName(i))
+
+        return self._fullTextFields
+
+    def fullTextFilter(self, text, fields):
+        # Every word is searched as prefix of a word in any of fields.
+        # Case and diacritics are folded by tokenizer
+        words = text.split()
+        if not words:
+            return None
+
+        terms = ' '.join(['"%s"*' % word.replace('"', '""') for word in words])
+        match = "{%s} : (%s)" % (' '.join(fields), terms)
+        return Match('coins_fts', match)
+
     def isReferenceAttached(self):
         return ('sections' in self.db.tables())
 
@@ -1352,18 +2420,33 @@ class Collection(QObject):
 
         return acts
 
-    @waitCursorDecorator
-    def __make_backup(self, backupFileName):
-        srcFile = QFile(self.fileName)
-        return srcFile.copy(backupFileName)
+    def __make_backup(self, backupFileName, compress):
+        # Online backup runs in worker thread and doesn't block UI
+        progressDlg = Gui.ProgressDialog(self.tr("Backup"),
+                                         None, 100, self.parent())
+
+        thread = BackupThread(self.fileName, backupFileName, compress)
+        thread.progress.connect(progressDlg.setValue)
+
+        loop = QEventLoop()
+        thread.finished.connect(loop.quit)
+        thread.start()
+        loop.exec()
+
+        progressDlg.reset()
+
+        return thread.result
 
     def backup(self):
-        backupDir = QDir(Settings()['backup'])
+        settings = Settings()
+        backupDir = QDir(settings['backup'])
         if not backupDir.exists():
             backupDir.mkpath(backupDir.absolutePath())
 
-        backupFileName = backupDir.filePath("%s_%s.db" % (self.getCollectionName(), QDateTime.currentDateTime().toString('yyMMddhhmmss')))
-        if not self.__make_backup(backupFileName):
+        compress = settings['backup_compress']
+        suffix = '.db.xz' if compress else '.db'
+        backupFileName = backupDir.filePath("%s_%s%s" % (self.getCollectionName(), QDateTime.currentDateTime().toString('yyMMddhhmmss'), suffix))
+        if not self.__make_backup(backupFileName, compress):
             QMessageBox.critical(self.parent(),
                             self.tr("Backup collection"),
                             self.tr("Can't make a collection backup at %s") %
@@ -1379,8 +2462,12 @@ class Collection(QObject):
     def isNeedBackup(self):
         settings = Settings()
         autobackup_depth = settings['autobackup_depth']
-        filter_ = ('%s_????????????.db' % self.getCollectionName(),)
+        filter_ = ('%s_????????????.db' % self.getCollectionName(),
+                   '%s_????????????.db.xz' % self.getCollectionName())
         files = QDirIterator(settings['backup'], filter_, QDir.Files)
+
+        # Latest backup has fewest changes after it, so only it is checked
+        last_date_time = None
         while files.hasNext():
             file_info = files.nextFileInfo()
 
@@ -1391,17 +2478,18 @@ class Collection(QObject):
             if date_time.isValid():
                 if date_time.date().year() < 2000:
                     date_time = date_time.addYears(100)
-                date_time = date_time.toUTC()
+                if last_date_time is None or date_time > last_date_time:
+                    last_date_time = date_time
 
-                query = QSqlQuery(self.db)
-                query.prepare("SELECT count(*) FROM coins WHERE updatedat > ?")
-                query.addBindValue(date_time.toString(Qt.ISODate))
-                query.exec()
-                query.first()
-                if query.record().value(0) < autobackup_depth:
-                    return False
+        if last_date_time is None:
+            return True
 
-        return True
+        query = QSqlQuery(self.db)
+        query.prepare("SELECT count(*) FROM coins WHERE updatedat > ?")
+        query.addBindValue(last_date_time.toUTC().toString(Qt.ISODate))
+        query.exec()
+        query.first()
+        return query.record().value(0) >= autobackup_depth
 
     @waitCursorDecorator
     def vacuum(self):
@@ -1770,12 +2858,8 @@ class Collection(QObject):
             if result == QDialog.Rejected:
                 return
 
-        query = QSqlQuery("SELECT COUNT(*) FROM src.coins", self.db)
-        query.first()
-        count = query.record().value(0)
-
-        progressDlg = Gui.ProgressDialog(
-            self.tr("Synchronizing"), self.tr("Cancel"), count, self.parent())
+        # Active statement locks creating and dropping temp tables
+        query.finish()
 
         fields_query = QSqlQuery("PRAGMA table_info(coins)", self.db)
         fields_query.exec()
@@ -1783,155 +2867,242 @@ class Collection(QObject):
         while fields_query.next():
             fields.append(fields_query.record().value(1))
         fields.remove('id')
-        sql_fields = ','.join(fields)
 
-        inserted_count = 0
-        updated_count = 0
-        query = QSqlQuery("SELECT DISTINCT createdat FROM src.coins", self.db)
-        while query.next():
-            progressDlg.step()
-            if progressDlg.wasCanceled():
-                break
+        self.db.transaction()
 
-            self.db.transaction()
+        # Coins changed in source collection
+        sql = "CREATE TEMP TABLE merge_update (id INTEGER PRIMARY KEY)"
+        QSqlQuery(sql, self.db)
+        sql = """INSERT INTO temp.merge_update (id)
+            SELECT coins.id FROM coins
+            INNER JOIN src.coins src_coins ON coins.id=src_coins.id
+            WHERE src_coins.createdat=coins.createdat AND
+                  src_coins.updatedat>coins.updatedat"""
+        QSqlQuery(sql, self.db)
 
-            sql = "SELECT 1 FROM coins WHERE createdat=? LIMIT 1"
-            select_query = QSqlQuery(sql, self.db)
-            select_query.addBindValue(query.record().value(0))
-            select_query.exec()
-            if select_query.first():
-                dst_fields = ImageFields + \
-                             ('id', 'image', 'sort_id')
-                sql_dst_fields = ','.join(['coins.%s AS coins_%s' % (f, f) for f in dst_fields])
-                sql_src_fields = ','.join(['src_coins.%s' % f for f in fields])
-                sql = "SELECT %s, %s FROM coins\
-                    INNER JOIN src.coins src_coins ON coins.id=src_coins.id\
-                    WHERE src_coins.createdat=? AND\
-                          src_coins.createdat=coins.createdat AND\
-                          src_coins.updatedat>coins.updatedat" % (sql_src_fields, sql_dst_fields)
-                sel_query = QSqlQuery(sql, self.db)
-                sel_query.addBindValue(query.record().value(0))
-                sel_query.exec()
-                if sel_query.first():
-                    sql = "UPDATE coins SET %s WHERE id=?" % ','.join(['%s=?' % f for f in fields])
-                    up_query = QSqlQuery(sql, self.db)
-                    for field in fields:
-                        if field == 'image':
-                            img_id = sel_query.record().value(field)
-                            old_img_id = sel_query.record().value('coins_image')
-                            if img_id and old_img_id:
-                                sql = "UPDATE images SET image=(SELECT image FROM src.images WHERE id=?) WHERE id=?"
-                                img_query = QSqlQuery(sql, self.db)
-                                img_query.addBindValue(img_id)
-                                img_query.addBindValue(old_img_id)
-                                img_query.exec()
-                            elif img_id:
-                                sql = "INSERT INTO images (image) SELECT image FROM src.images WHERE id=?"
-                                img_query = QSqlQuery(sql, self.db)
-                                img_query.addBindValue(img_id)
-                                img_query.exec()
-                                img_id = img_query.lastInsertId()
-                            elif old_img_id:
-                                sql = "DELETE FROM images WHERE id=?"
-                                img_query = QSqlQuery(sql, self.db)
-                                img_query.addBindValue(old_img_id)
-                                img_query.exec()
-                                img_id = None
-
-                            up_query.addBindValue(img_id)
-                        elif field in ImageFields:
-                            img_id = sel_query.record().value(field)
-                            old_img_id = sel_query.record().value('coins_%s' % field)
-                            if img_id and old_img_id:
-                                sql = "UPDATE photos SET title=(SELECT title FROM src.photos WHERE id=?), image=(SELECT image FROM src.photos WHERE id=?) WHERE id=?"
-                                img_query = QSqlQuery(sql, self.db)
-                                img_query.addBindValue(img_id)
-                                img_query.addBindValue(img_id)
-                                img_query.addBindValue(old_img_id)
-                                img_query.exec()
-                                img_id = old_img_id
-                            elif img_id:
-                                sql = "INSERT INTO photos (title, image) SELECT title, image FROM src.photos WHERE id=?"
-                                img_query = QSqlQuery(sql, self.db)
-                                img_query.addBindValue(img_id)
-                                img_query.exec()
-                                img_id = img_query.lastInsertId()
-                            elif old_img_id:
-                                sql = "DELETE FROM photos WHERE id=?"
-                                img_query = QSqlQuery(sql, self.db)
-                                img_query.addBindValue(old_img_id)
-                                img_query.exec()
-                                img_id = None
-
-                            up_query.addBindValue(img_id)
-                        elif field == 'sort_id':
-                            up_query.addBindValue(sel_query.record().value('coins_sort_id'))
-                        else:
-                            up_query.addBindValue(sel_query.record().value(field))
-                    up_query.addBindValue(sel_query.record().value('coins_id'))
+        # New coins in source collection. Position defines new sort_id
+        sql = """CREATE TEMP TABLE merge_insert (
+            pos INTEGER PRIMARY KEY, id INTEGER)"""
+        QSqlQuery(sql, self.db)
+        sql = """INSERT INTO temp.merge_insert (id)
+            SELECT id FROM src.coins src_coins
+            WHERE createdat IS NOT NULL AND NOT EXISTS
+                (SELECT 1 FROM coins WHERE coins.createdat=src_coins.createdat)
+            ORDER BY sort_id, id"""
+        QSqlQuery(sql, self.db)
 
-                    up_query.exec()
-                    updated_count += 1
-            else:
-                sql = "SELECT %s FROM src.coins WHERE createdat=?" % sql_fields
-                sel_query = QSqlQuery(sql, self.db)
-                sel_query.addBindValue(query.record().value(0))
-                sel_query.exec()
-                while sel_query.next():
-                    sql = "INSERT INTO coins (%s) VALUES (%s)" % (sql_fields, ','.join(['?'] * len(fields)))
-                    ins_query = QSqlQuery(sql, self.db)
-                    for field in fields:
-                        if field == 'image':
-                            old_img_id = sel_query.record().value(field)
-                            if old_img_id:
-                                sql = "INSERT INTO images (image) SELECT image FROM src.images WHERE id=?"
-                                img_query = QSqlQuery(sql, self.db)
-                                img_query.addBindValue(old_img_id)
-                                img_query.exec()
-
-                                img_id = img_query.lastInsertId()
-                            else:
-                                img_id = None
-                            ins_query.addBindValue(img_id)
-                        elif field in ImageFields:
-                            old_img_id = sel_query.record().value(field)
-                            if old_img_id:
-                                sql = "INSERT INTO photos (title, image) SELECT title, image FROM src.photos WHERE id=?"
-                                img_query = QSqlQuery(sql, self.db)
-                                img_query.addBindValue(old_img_id)
-                                img_query.exec()
-
-                                img_id = img_query.lastInsertId()
-                            else:
-                                img_id = None
-                            ins_query.addBindValue(img_id)
-                        elif field == 'sort_id':
-                            sort_query = QSqlQuery("SELECT MAX(sort_id) FROM coins", self.db)
-                            sort_query.first()
-                            sort_id = sort_query.record().value(0)
-                            if not sort_id:
-                                sort_id = 0
-                            ins_query.addBindValue(sort_id + 1)
-                        else:
-                            ins_query.addBindValue(sel_query.record().value(field))
+        if self.__mergeConfirm():
+            res = self.__mergeApply(fields)
+        else:
+            res = None
 
-                    ins_query.exec()
-                    inserted_count += 1
+        for table in ('merge_update', 'merge_insert', 'merge_released',
+                      'merge_photos', 'merge_images'):
+            QSqlQuery("DROP TABLE IF EXISTS temp.%s" % table, self.db)
 
+        if res:
             self.db.commit()
+            self.bumpDataGeneration()
+        else:
+            self.db.rollback()
 
         query = QSqlQuery("DETACH src", self.db)
         query.exec()
 
-        progressDlg.reset()
+        if res is False:
+            QMessageBox.critical(self.parent(),
+                                 self.tr("Synchronizing"),
+                                 self.tr("Can't synchronize collection:\n%s") %
+                                 self._mergeError)
 
-        if inserted_count or updated_count:
-            text = self.tr("Inserted %d coins, updated %d coins.\nThe application will need to restart now.") % (inserted_count, updated_count)
-            QMessageBox.information(self.parent(), self.tr("Synchronizing"),
-                                    text)
-            # TODO: refresh
-            self.parent().restart()
-        else:
+        return bool(res)
+
+    def __mergeConfirm(self):
+        # Dry run: show what will be changed before applying
+        inserted = []
+        sql = """SELECT src_coins.title FROM temp.merge_insert
+            INNER JOIN src.coins src_coins ON src_coins.id=merge_insert.id
+            ORDER BY merge_insert.pos"""
+        query = QSqlQuery(sql, self.db)
+        while query.next():
+            inserted.append(query.record().value(0))
+
+        updated = []
+        sql = """SELECT src_coins.title FROM temp.merge_update
+            INNER JOIN src.coins src_coins ON src_coins.id=merge_update.id"""
+        query = QSqlQuery(sql, self.db)
+        while query.next():
+            updated.append(query.record().value(0))
+
+        if not inserted and not updated:
             text = self.tr("Collections looks like identical")
             QMessageBox.information(self.parent(), self.tr("Synchronizing"),
                                     text)
+            return False
+
+        details = []
+        if inserted:
+            details.append(self.tr("Inserted:"))
+            details.extend(inserted)
+        if updated:
+            if details:
+                details.append('')
+            details.append(self.tr("Updated:"))
+            details.extend(updated)
+
+        msgBox = QMessageBox(
+            QMessageBox.Question, self.tr("Synchronizing"),
+            self.tr("Will be inserted %d coins, updated %d coins.\n"
+                    "Continue?") % (len(inserted), len(updated)),
+            QMessageBox.Yes | QMessageBox.Cancel, self.parent())
+        msgBox.setDefaultButton(QMessageBox.Yes)
+        msgBox.setDetailedText('\n'.join(details))
+        result = msgBox.exec()
+
+        return result == QMessageBox.Yes
+
+    def __mergeApply(self, fields):
+        progressDlg = Gui.ProgressDialog(
+            self.tr("Synchronizing"), None, 6, self.parent())
+
+        merged_ids = "SELECT id FROM temp.merge_update" \
+                     " UNION ALL SELECT id FROM temp.merge_insert"
+
+        # Photos of updated coins will be released after updating and
+        # removed if not used anymore. Old previews will be replaced
+        queries = []
+        sql = "CREATE TEMP TABLE merge_released (id INTEGER PRIMARY KEY)"
+        queries.append(sql)
+        for field in ImageFields:
+            sql = """INSERT OR IGNORE INTO temp.merge_released (id)
+                SELECT %s FROM coins
+                WHERE %s IS NOT NULL AND id IN
+                    (SELECT id FROM temp.merge_update)""" % (field, field)
+            queries.append(sql)
+        sql = """DELETE FROM images WHERE id IN
+            (SELECT image FROM coins WHERE id IN
+                (SELECT id FROM temp.merge_update))"""
+        queries.append(sql)
+
+        if not self.__mergeExec(queries):
+            return False
+        progressDlg.step()
+
+        # Map image IDs of source collection to existing same photos or
+        # to new IDs
+        queries = []
+        sql = """CREATE TEMP TABLE merge_photos (
+            pos INTEGER PRIMARY KEY, src_id INTEGER UNIQUE, dst_id INTEGER,
+            new INTEGER)"""
+        queries.append(sql)
+        for field in ImageFields:
+            sql = """INSERT OR IGNORE INTO temp.merge_photos (src_id)
+                SELECT %s FROM src.coins
+                WHERE %s IS NOT NULL AND id IN (%s)""" % (field, field, merged_ids)
+            queries.append(sql)
+        sql = """UPDATE temp.merge_photos SET dst_id=
+            (SELECT photos.id FROM photos
+             INNER JOIN src.photos src_photos ON
+                photos.hash=src_photos.hash AND
+                ifnull(photos.title, '')=ifnull(src_photos.title, '')
+             WHERE src_photos.id=merge_photos.src_id LIMIT 1)"""
+        queries.append(sql)
+        sql = """UPDATE temp.merge_photos
+            SET new=1, dst_id=pos+(SELECT ifnull(MAX(id), 0) FROM photos)
+            WHERE dst_id IS NULL"""
+        queries.append(sql)
+
+        sql = """CREATE TEMP TABLE merge_images (
+            pos INTEGER PRIMARY KEY, src_id INTEGER UNIQUE, dst_id INTEGER)"""
+        queries.append(sql)
+        sql = """INSERT OR IGNORE INTO temp.merge_images (src_id)
+            SELECT image FROM src.coins
+            WHERE image IS NOT NULL AND id IN (%s)""" % merged_ids
+        queries.append(sql)
+        sql = """UPDATE temp.merge_images
+            SET dst_id=pos+(SELECT ifnull(MAX(id), 0) FROM images)"""
+        queries.append(sql)
+
+        # Copy images
+        sql = """INSERT INTO photos (id, title, image, hash, refs)
+            SELECT merge_photos.dst_id, src_photos.title, src_photos.image,
+                   src_photos.hash, 0
+            FROM temp.merge_photos
+            INNER JOIN src.photos src_photos ON src_photos.id=merge_photos.src_id
+            WHERE merge_photos.new=1"""
+        queries.append(sql)
+        sql = """INSERT INTO images (id, image)
+            SELECT merge_images.dst_id, src_images.image
+            FROM temp.merge_images
+            INNER JOIN src.images src_images ON src_images.id=merge_images.src_id"""
+        queries.append(sql)
+
+        if not self.__mergeExec(queries):
+            return False
+        progressDlg.step()
+
+        values = {}
+        for field in fields:
+            if field == 'image':
+                values[field] = "(SELECT dst_id FROM temp.merge_images" \
+                                " WHERE src_id=src_coins.image)"
+            elif field in ImageFields:
+                values[field] = "(SELECT dst_id FROM temp.merge_photos" \
+                                " WHERE src_id=src_coins.%s)" % field
+            else:
+                values[field] = "src_coins.%s" % field
+
+        # Update changed coins with keeping their position
+        sql = "UPDATE coins SET %s FROM src.coins src_coins" \
+              " WHERE coins.id=src_coins.id AND" \
+              " coins.id IN (SELECT id FROM temp.merge_update)" % \
+              ','.join(['%s=%s' % (f, values[f]) for f in fields if f != 'sort_id'])
+
+        if not self.__mergeExec((sql,)):
+            return False
+        progressDlg.step()
+
+        # Append new coins to the end of list
+        query = QSqlQuery("SELECT ifnull(MAX(sort_id), 0) FROM coins", self.db)
+        query.first()
+        sort_id = query.record().value(0)
+        values['sort_id'] = "merge_insert.pos*%d+%d" % (self.SORT_ID_STEP, sort_id)
+        self._nextSortId = None
+
+        sql = "INSERT INTO coins (%s) SELECT %s FROM temp.merge_insert" \
+              " INNER JOIN src.coins src_coins ON src_coins.id=merge_insert.id" \
+              " ORDER BY merge_insert.pos" % \
+              (','.join(fields), ','.join([values[f] for f in fields]))
+
+        if not self.__mergeExec((sql,)):
+            return False
+        progressDlg.step()
+
+        self.updatePhotoRefs("SELECT id FROM temp.merge_released"
+                             " UNION SELECT dst_id FROM temp.merge_photos")
+
+        queries = []
+        sql = """DELETE FROM photo_hashes WHERE photo_id IN
+            (SELECT id FROM photos WHERE refs<=0 AND id IN
+                (SELECT id FROM temp.merge_released))"""
+        queries.append(sql)
+        sql = """DELETE FROM photos WHERE refs<=0 AND id IN
+            (SELECT id FROM temp.merge_released)"""
+        queries.append(sql)
+
+        if not self.__mergeExec(queries):
+            return False
+        progressDlg.step()
+
+        progressDlg.reset()
+
+        return True
+
+    def __mergeExec(self, queries):
+        for sql in queries:
+            query = QSqlQuery(self.db)
+            if not query.exec(sql):
+                self._mergeError = query.lastError().text()
+                return False
+
+        return True
@@ -0,0 +1,159 @@
+import json
+from collections import OrderedDict
+from dataclasses import dataclass
+
+
+@dataclass(slots=True, frozen=True)
+class Sql:
+    """Plain SQL expression"""
+    sql: str
+
+
+@dataclass(slots=True, frozen=True)
+class Equal:
+    field: str
+    value: object
+    negate: bool = False
+
+
+@dataclass(slots=True, frozen=True)
+class Blank:
+    """NULL or empty value"""
+    field: str
+    negate: bool = False
+
+
+@dataclass(slots=True, frozen=True)
+class In:
+    field: str
+    values: tuple
+    negate: bool = False
+
+
+@dataclass(slots=True, frozen=True)
+class Like:
+    field: str
+    pattern: str
+
+
+@dataclass(slots=True, frozen=True)
+class Match:
+    """Full-text query over FTS5 table with rowid equal to coin id"""
+    table: str
+    query: str
+
+
+@dataclass(slots=True, frozen=True)
+class And:
+    filters: tuple
+
+
+@dataclass(slots=True, frozen=True)
+class Or:
+    filters: tuple
+
+
+def quote(value):
+    if value is None:
+        return 'NULL'
+    elif isinstance(value, bool):
+        return str(int(value))
+    elif isinstance(value, (int, float)):
+        return repr(value)
+    else:
+        return "'%s'" % str(value).replace("'", "''")
+
+
+class FilterCompiler:
+    """Compiles filter tree to SQL with bind values for own queries or with
+    literal values for QSqlTableModel, which can't bind filter values.
+    Large value sets are passed as one JSON array instead of long IN list"""
+    CACHE_SIZE = 256
+    # Longer filters aren't cached for not holding large value sets
+    CACHE_SQL_LIMIT = 4096
+    IN_LIST_LIMIT = 32
+
+    def __init__(self, inline=False):
+        self.inline = inline
+        self._cache = OrderedDict()
+
+    def compile(self, filter_):
+        if filter_ is None:
+            return ('', ())
+
+        if filter_ in self._cache:
+            self._cache.move_to_end(filter_)
+            return self._cache[filter_]
+
+        params = []
+        sql = self._compile(filter_, params)
+        result = (sql, tuple(params))
+
+        if len(sql) + sum(len(str(param)) for param in params) > self.CACHE_SQL_LIMIT:
+            return result
+
+        self._cache[filter_] = result
+        if len(self._cache) > self.CACHE_SIZE:
+            self._cache.popitem(last=False)
+
+        return result
+
+    def _param(self, value, params):
+        if self.inline:
+            return quote(value)
+
+        params.append(value)
+        return '?'
+
+    def _compile(self, filter_, params):
+        if isinstance(filter_, Sql):
+            return filter_.sql
+        elif isinstance(filter_, Equal):
+            op = '<>' if filter_.negate else '='
+            return "%s%s%s" % (filter_.field, op,
+                               self._param(filter_.value, params))
+        elif isinstance(filter_, Blank):
+            op = '<>' if filter_.negate else '='
+            return "ifnull(%s,'')%s''" % (filter_.field, op)
+        elif isinstance(filter_, In):
+            op = 'NOT IN' if filter_.negate else 'IN'
+            if not filter_.values:
+                return 'TRUE' if filter_.negate else 'FALSE'
+            elif len(filter_.values) > self.IN_LIST_LIMIT:
+                values = json.dumps(list(filter_.values))
+                return "%s %s (SELECT value FROM json_each(%s))" % (
+                    filter_.field, op, self._param(values, params))
+            else:
+                values = [self._param(value, params) for value in filter_.values]
+                return "%s %s (%s)" % (filter_.field, op, ','.join(values))
+        elif isinstance(filter_, Like):
+            return "%s LIKE %s" % (filter_.field,
+                                   self._param(filter_.pattern, params))
+        elif isinstance(filter_, Match):
+            return "id IN (SELECT rowid FROM %s WHERE %s MATCH %s)" % (
+                filter_.table, filter_.table, self._param(filter_.query, params))
+        elif isinstance(filter_, (And, Or)):
+            op = ' AND ' if isinstance(filter_, And) else ' OR '
+            parts = [self._compile(part, params) for part in filter_.filters]
+            if not parts:
+                return 'TRUE' if isinstance(filter_, And) else 'FALSE'
+            elif len(parts) == 1:
+                return parts[0]
+            return '(' + op.join(parts) + ')'
+
+        raise TypeError("Unknown filter %r" % (filter_,))
+
+
+_bindCompiler = FilterCompiler()
+_inlineCompiler = FilterCompiler(inline=True)
+
+
+def compileFilter(filter_):
+    """Returns SQL with placeholders and bind values"""
+    return _bindCompiler.compile(filter_)
+
+
+def filterToSql(filter_):
+    """Returns SQL with literal values"""
+    sql, _params = _inlineCompiler.compile(filter_)
+    return sql
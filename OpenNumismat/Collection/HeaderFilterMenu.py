@@ -1,10 +1,15 @@
-from PySide6.QtCore import Qt
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import cmp_to_key
+
+from PySide6.QtCore import Qt, QAbstractListModel, QModelIndex, QSortFilterProxyModel
+from PySide6.QtCore import Signal as pyqtSignal
 from PySide6.QtGui import QIcon
-from PySide6.QtSql import QSqlQuery
 from PySide6.QtWidgets import (
     QDialogButtonBox,
+    QLabel,
     QLineEdit,
-    QListWidget,
+    QListView,
     QListWidgetItem,
     QMenu,
     QPushButton,
@@ -16,38 +21,120 @@ from PySide6.QtWidgets import (
 
 from OpenNumismat.Collection.CollectionFields import FieldTypes as Type
 from OpenNumismat.Collection.CollectionFields import Statuses
+from OpenNumismat.Collection.FilterCompiler import And, Or, Sql, Blank, Equal, In
+from OpenNumismat.Collection.FilterCompiler import compileFilter, filterToSql
+from OpenNumismat.Collection.QueryService import AsyncQuery
 from OpenNumismat.Tools.Gui import statusIcon
 from OpenNumismat.Tools.Converters import numberWithFraction, compareYears
 
 
-class CustomSortListWidgetItem(QListWidgetItem):
+def compareValues(left, right):
+    if isinstance(left, str):
+        right = str(right)
+    elif isinstance(right, str):
+        left = str(left)
+
+    return (left > right) - (left < right)
+
+
+@dataclass(slots=True)
+class FilterItem():
+    type: int
+    label: object
+    value: str
+    count: int
+    checkState: Qt.CheckState
+    icon: QIcon = None
+
+
+class FilterListModel(QAbstractListModel):
+    """Check list of column values. Items are plain objects, so the view
+    creates widgets only for visible rows"""
+    checkedChanged = pyqtSignal(int)
+
+    def __init__(self, items, iconProvider=None, parent=None):
+        super().__init__(parent)
 
-    def __lt__(self, other):
-        left = self.data(Qt.UserRole + 1)
-        right = other.data(Qt.UserRole + 1)
+        self.items = items
+        self.iconProvider = iconProvider
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.items)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+
+        item = self.items[index.row()]
+        if role == Qt.DisplayRole:
+            return item.label
+        elif role == Qt.UserRole:
+            return item.value
+        elif role == Qt.CheckStateRole:
+            return item.checkState
+        elif role == Qt.DecorationRole:
+            if item.type != FilterMenuButton.DefaultType or not self.iconProvider:
+                return None
+            # Icons are created only for shown rows
+            if item.icon is None:
+                item.icon = self.iconProvider(item.value) or QIcon()
+            return item.icon
+        elif role == Qt.ToolTipRole:
+            if item.count:
+                return self.tr("%n coin(s)", '', item.count)
+
+        return None
+
+    def flags(self, index):
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsUserCheckable
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if not index.isValid() or role != Qt.CheckStateRole:
+            return False
+
+        item = self.items[index.row()]
+        item.checkState = Qt.CheckState(value)
+
+        if item.type == FilterMenuButton.SelectAllType:
+            for other in self.items[1:]:
+                other.checkState = item.checkState
+            self.dataChanged.emit(self.index(0), self.index(len(self.items) - 1),
+                                  [Qt.CheckStateRole])
+        else:
+            self.dataChanged.emit(index, index, [Qt.CheckStateRole])
 
-        if isinstance(left, str):
-            right = str(right)
-        elif isinstance(right, str):
-            left = str(left)
+        self.updateSelectAll()
 
-        return left < right
+        return True
 
+    def updateSelectAll(self):
+        if not self.items:
+            return
 
-class YearSortListWidgetItem(QListWidgetItem):
+        checkedCount = self.checkedCount()
+        if checkedCount == 0:
+            state = Qt.Unchecked
+        elif checkedCount == len(self.items) - 1:
+            state = Qt.Checked
+        else:
+            state = Qt.PartiallyChecked
 
-    def __lt__(self, other):
-        left = self.data(Qt.UserRole + 1)
-        right = other.data(Qt.UserRole + 1)
-        return compareYears(left, right) < 0
+        if self.items[0].checkState != state:
+            self.items[0].checkState = state
+            self.dataChanged.emit(self.index(0), self.index(0),
+                                  [Qt.CheckStateRole])
 
+        self.checkedChanged.emit(checkedCount)
 
-class StatusSortListWidgetItem(QListWidgetItem):
+    def checkedCount(self):
+        count = 0
+        for item in self.items[1:]:
+            if item.checkState == Qt.Checked:
+                count += 1
 
-    def __lt__(self, other):
-        left = self.data(Qt.UserRole)
-        right = other.data(Qt.UserRole)
-        return Statuses.compare(left, right) < 0
+        return count
 
 
 class FilterMenuButton(QPushButton):
@@ -56,6 +143,8 @@ class FilterMenuButton(QPushButton):
     BlanksType = QListWidgetItem.UserType + 2
     DataType = QListWidgetItem.UserType + 3
 
+    CACHE_SIZE = 16
+
     def __init__(self, columnParam, listParam, model, parent):
         super().__init__(parent)
 
@@ -68,8 +157,16 @@ class FilterMenuButton(QPushButton):
         self.listParam = listParam
         self.settings = model.settings
 
+        # Column values by queries, valid until collection data changed
+        self._cache = OrderedDict()
+        self._cacheGeneration = None
+
+        self.asyncQuery = AsyncQuery(model.collection, self)
+        self.asyncQuery.finished.connect(self.valuesLoaded)
+
         menu = QMenu(self)
         menu.aboutToShow.connect(self.prepareMenu)
+        menu.aboutToHide.connect(self.asyncQuery.cancel)
         self.setMenu(menu)
 
         self.setToolTip(self.tr("Filter items"))
@@ -84,292 +181,243 @@ class FilterMenuButton(QPushButton):
             self.setIcon(QIcon(':/filters.ico'))
 
     def prepareMenu(self):
-        self.listWidget = QListWidget(self)
+        self.listModel = FilterListModel([], parent=self)
+
+        # Search is applied by proxy without touching every row of view
+        self.proxyModel = QSortFilterProxyModel(self)
+        self.proxyModel.setFilterCaseSensitivity(Qt.CaseInsensitive)
+        self.proxyModel.setDynamicSortFilter(False)
+        self.proxyModel.setSourceModel(self.listModel)
+
+        self.listView = QListView(self)
+        self.listView.setUniformItemSizes(True)
+        self.listView.setModel(self.proxyModel)
 
         filters = self.filters.copy()
-        appliedValues = []
-        columnFilters = None
-        revert = False
+        self.appliedValues = []
+        self.columnFilters = None
+        self.revert = False
         if self.fieldid in filters.keys():
-            columnFilters = filters.pop(self.fieldid)
-            for filter_ in columnFilters.filters():
+            self.columnFilters = filters.pop(self.fieldid)
+            for filter_ in self.columnFilters.filters():
                 if filter_.isRevert():
-                    revert = True
-                appliedValues.append(filter_.value)
+                    self.revert = True
+                self.appliedValues.append(filter_.value)
 
-        hasBlanks = False
-        columnType = self.model.columnType(self.fieldid)
-        if self.model.columnName(self.fieldid) == 'year':
-            filtersSql = self.filtersToSql(filters.values())
-            if filtersSql:
-                filtersSql = 'WHERE ' + filtersSql
-            sql = "SELECT DISTINCT %s FROM coins %s" % (self.columnName, filtersSql)
-            query = QSqlQuery(sql, self.db)
-
-            while query.next():
-                icon = None
-                if query.record().isNull(0):
-                    data = None
-                else:
-                    orig_data = query.record().value(0)
-                    data = str(orig_data)
-                    label = data
-                    try:
-                        year = str(data)
-                        if year and year[0] == '-':
-                            label = "%s BC" % year[1:]
-                    except ValueError:
-                        pass
+        self.loadingLabel = QLabel(self.tr("Loading..."), self)
+        self.loadingLabel.setAlignment(Qt.AlignCenter)
 
-                if not data:
-                    hasBlanks = True
-                    continue
+        self.searchBox = QLineEdit(self)
+        self.searchBox.setPlaceholderText(self.tr("Filter"))
+        self.searchBox.textChanged.connect(self.applySearch)
 
-                item = YearSortListWidgetItem()
-                item.setData(Qt.DisplayRole, label)
-                item.setData(Qt.UserRole, data)
-                item.setData(Qt.UserRole + 1, orig_data)
-                if (data in appliedValues) ^ revert:
-                    item.setCheckState(Qt.Unchecked)
-                else:
-                    item.setCheckState(Qt.Checked)
-                self.listWidget.addItem(item)
+        self.buttonBox = QDialogButtonBox(Qt.Horizontal)
+        self.buttonBox.addButton(QDialogButtonBox.Ok)
+        self.buttonBox.addButton(QDialogButtonBox.Cancel)
+        self.buttonBox.accepted.connect(self.apply)
+        self.buttonBox.rejected.connect(self.menu().hide)
+        self.buttonBox.button(QDialogButtonBox.Ok).setDisabled(True)
 
-            self.listWidget.sortItems()
-        elif columnType == Type.Text or columnType in Type.ImageTypes:
+        layout = QVBoxLayout()
+        layout.addWidget(self.searchBox)
+        layout.addWidget(self.loadingLabel)
+        layout.addWidget(self.listView)
+        layout.addWidget(self.buttonBox)
+
+        widget = QWidget(self)
+        widget.setLayout(layout)
+
+        widgetAction = QWidgetAction(self)
+        widgetAction.setDefaultWidget(widget)
+        self.menu().clear()
+        self.menu().addAction(widgetAction)
+
+        self._requestedQueries = self.valuesQueries(filters)
+        if self.isCached(self._requestedQueries):
+            self._cache.move_to_end(self._requestedQueries)
+            self.fillItems(self._cache[self._requestedQueries])
+        else:
+            # Menu is shown at once and filled when values are loaded in
+            # background
+            self._requestGeneration = self.model.dataGeneration()
+            self.asyncQuery.exec(self._requestedQueries)
+
+    def valuesQueries(self, filters):
+        columnType = self.model.columnType(self.fieldid)
+        filtersSql, params = compileFilter(self.filtersToFilter(filters.values()))
+        if self.model.columnName(self.fieldid) != 'year' and \
+                (columnType == Type.Text or columnType in Type.ImageTypes):
             dataFilter = BlankFilter(self.columnName).toSql()
             blanksFilter = DataFilter(self.columnName).toSql()
 
-            filtersSql = self.filtersToSql(filters.values())
             sql = "SELECT 1 FROM coins WHERE " + filtersSql
             if filtersSql:
                 sql += ' AND '
 
-            # Get blank row count
-            blank_sql = sql + blanksFilter + " LIMIT 1"
-            query = QSqlQuery(blank_sql, self.db)
-            if query.first():
-                hasBlanks = True
-
-            # Get not blank row count
-            not_blank_sql = sql + dataFilter + " LIMIT 1"
-            query = QSqlQuery(not_blank_sql, self.db)
-            if query.first():
-                if columnType in Type.ImageTypes:
-                    label = self.tr("(Images)")
-                elif columnType == Type.Text:
-                    label = self.tr("(Text)")
-                else:
-                    label = self.tr("(Data)")
-                item = QListWidgetItem(label,
-                                       type=FilterMenuButton.DataType)
-                item.setData(Qt.UserRole, label)
-                item.setCheckState(Qt.Checked)
-                if columnFilters and columnFilters.hasData():
-                    item.setCheckState(Qt.Unchecked)
-                self.listWidget.addItem(item)
-        elif columnType == Type.Status:
-            filtersSql = self.filtersToSql(filters.values())
-            if filtersSql:
-                filtersSql = 'WHERE ' + filtersSql
-            sql = "SELECT DISTINCT %s FROM coins %s" % (
-                self.columnName, filtersSql)
-            query = QSqlQuery(sql, self.db)
+            # Get blank and not blank row existence
+            return ((sql + blanksFilter + " LIMIT 1", params),
+                    (sql + dataFilter + " LIMIT 1", params))
 
-            while query.next():
-                value = query.record().value(0)
-                label = Statuses[value]
+        if filtersSql:
+            filtersSql = 'WHERE ' + filtersSql
+        sql = "SELECT %s, COUNT(*) FROM coins %s GROUP BY %s" % (
+            self.columnName, filtersSql, self.columnName)
+        return ((sql, params), )
 
-                item = StatusSortListWidgetItem(label)
-                item.setData(Qt.UserRole, value)
+    def valuesLoaded(self, results):
+        values = self.processValues(results)
+        # Values of changed data are shown but not cached
+        if self._requestGeneration == self.model.dataGeneration():
+            self.storeCache(self._requestedQueries, values)
 
-                icon = statusIcon(value)
-                item.setIcon(icon)
+        self.fillItems(values)
 
-                if (value in appliedValues) ^ revert:
-                    item.setCheckState(Qt.Unchecked)
-                else:
-                    item.setCheckState(Qt.Checked)
-                self.listWidget.addItem(item)
-
-            self.listWidget.sortItems()
-        elif columnType == Type.Denomination:
-            filtersSql = self.filtersToSql(filters.values())
-            if filtersSql:
-                filtersSql = 'WHERE ' + filtersSql
-            sql = "SELECT DISTINCT %s FROM coins %s" % (self.columnName, filtersSql)
-            query = QSqlQuery(sql, self.db)
-
-            while query.next():
-                icon = None
-                if query.record().isNull(0):
-                    data = None
-                else:
-                    orig_data = query.record().value(0)
-                    data = str(orig_data)
-                    label, _ = numberWithFraction(data, self.settings['convert_fraction'])
+    def processValues(self, results):
+        """Returns sorted (label, value, count) of column values and
+        existence of blank and data values"""
+        hasBlanks = False
+        hasData = False
+        values = []
 
+        columnType = self.model.columnType(self.fieldid)
+        if self.model.columnName(self.fieldid) == 'year':
+            for orig_data, count in results[0]:
+                data = '' if orig_data is None else str(orig_data)
                 if not data:
                     hasBlanks = True
                     continue
 
-                item = CustomSortListWidgetItem()
-                item.setData(Qt.DisplayRole, label)
-                item.setData(Qt.UserRole, data)
-                item.setData(Qt.UserRole + 1, orig_data)
-                if (data in appliedValues) ^ revert:
-                    item.setCheckState(Qt.Unchecked)
-                else:
-                    item.setCheckState(Qt.Checked)
-                self.listWidget.addItem(item)
+                label = data
+                if data[0] == '-':
+                    label = "%s BC" % data[1:]
+                values.append((label, data, count, orig_data))
 
-            self.listWidget.sortItems()
-        else:
-            filtersSql = self.filtersToSql(filters.values())
-            if filtersSql:
-                filtersSql = 'WHERE ' + filtersSql
-            sql = "SELECT DISTINCT %s FROM coins %s" % (self.columnName, filtersSql)
-            query = QSqlQuery(sql, self.db)
-
-            while query.next():
-                icon = None
-                if query.record().isNull(0):
-                    data = None
-                else:
-                    orig_data = query.record().value(0)
-                    data = str(orig_data)
-                    icon = self.reference.getIcon(self.columnName, data)
+            values.sort(key=cmp_to_key(lambda left, right:
+                                       compareYears(left[3], right[3])))
+        elif columnType == Type.Text or columnType in Type.ImageTypes:
+            hasBlanks = bool(results[0])
+            hasData = bool(results[1])
+        elif columnType == Type.Status:
+            for value, count in results[0]:
+                values.append((Statuses[value], value, count, value))
 
+            values.sort(key=cmp_to_key(lambda left, right:
+                                       Statuses.compare(left[1], right[1])))
+        else:
+            convert_fraction = self.settings['convert_fraction']
+            for orig_data, count in results[0]:
+                data = '' if orig_data is None else str(orig_data)
                 if not data:
                     hasBlanks = True
                     continue
 
-                item = QListWidgetItem()
-                item.setData(Qt.DisplayRole, orig_data)
-                item.setData(Qt.UserRole, data)
-                if icon:
-                    item.setIcon(icon)
-                if (data in appliedValues) ^ revert:
-                    item.setCheckState(Qt.Unchecked)
+                if columnType == Type.Denomination:
+                    label, _ = numberWithFraction(data, convert_fraction)
                 else:
-                    item.setCheckState(Qt.Checked)
-                self.listWidget.addItem(item)
+                    label = orig_data
+                values.append((label, data, count, orig_data))
 
-            self.listWidget.sortItems()
+            values.sort(key=cmp_to_key(lambda left, right:
+                                       compareValues(left[3], right[3])))
 
-        item = QListWidgetItem(self.tr("(Select all)"),
-                               type=FilterMenuButton.SelectAllType)
-        item.setData(Qt.UserRole, self.tr("(Select all)"))
-        item.setCheckState(Qt.Checked)
-        self.listWidget.insertItem(0, item)
+        return ([value[:3] for value in values], hasBlanks, hasData)
 
-        if hasBlanks:
-            item = QListWidgetItem(self.tr("(Blanks)"),
-                                   type=FilterMenuButton.BlanksType)
-            item.setData(Qt.UserRole, self.tr("(Blanks)"))
-            item.setCheckState(Qt.Checked)
-            if revert:
-                if columnFilters and not columnFilters.hasBlank():
-                    item.setCheckState(Qt.Unchecked)
-            else:
-                if columnFilters and columnFilters.hasBlank():
-                    item.setCheckState(Qt.Unchecked)
-            self.listWidget.addItem(item)
+    def fillItems(self, values):
+        values, hasBlanks, hasData = values
 
-        self.listWidget.itemChanged.connect(self.itemChanged)
+        items = []
 
-        self.searchBox = QLineEdit(self)
-        self.searchBox.setPlaceholderText(self.tr("Filter"))
-        self.searchBox.textChanged.connect(self.applySearch)
+        item = FilterItem(FilterMenuButton.SelectAllType, self.tr("(Select all)"),
+                          self.tr("(Select all)"), 0, Qt.Checked)
+        items.append(item)
 
-        self.buttonBox = QDialogButtonBox(Qt.Horizontal)
-        self.buttonBox.addButton(QDialogButtonBox.Ok)
-        self.buttonBox.addButton(QDialogButtonBox.Cancel)
-        self.buttonBox.accepted.connect(self.apply)
-        self.buttonBox.rejected.connect(self.menu().hide)
-
-        layout = QVBoxLayout()
-        layout.addWidget(self.searchBox)
-        layout.addWidget(self.listWidget)
-        layout.addWidget(self.buttonBox)
-
-        widget = QWidget(self)
-        widget.setLayout(layout)
+        if hasData:
+            columnType = self.model.columnType(self.fieldid)
+            if columnType in Type.ImageTypes:
+                label = self.tr("(Images)")
+            elif columnType == Type.Text:
+                label = self.tr("(Text)")
+            else:
+                label = self.tr("(Data)")
+            item = FilterItem(FilterMenuButton.DataType, label, label, 0,
+                              Qt.Checked)
+            if self.columnFilters and self.columnFilters.hasData():
+                item.checkState = Qt.Unchecked
+            items.append(item)
+
+        appliedValues = set(self.appliedValues)
+        for label, value, count in values:
+            if (value in appliedValues) ^ self.revert:
+                checkState = Qt.Unchecked
+            else:
+                checkState = Qt.Checked
+            items.append(FilterItem(FilterMenuButton.DefaultType, label, value,
+                                    count, checkState))
 
-        widgetAction = QWidgetAction(self)
-        widgetAction.setDefaultWidget(widget)
-        self.menu().clear()
-        self.menu().addAction(widgetAction)
+        if hasBlanks:
+            item = FilterItem(FilterMenuButton.BlanksType, self.tr("(Blanks)"),
+                              self.tr("(Blanks)"), 0, Qt.Checked)
+            if self.revert:
+                if self.columnFilters and not self.columnFilters.hasBlank():
+                    item.checkState = Qt.Unchecked
+            else:
+                if self.columnFilters and self.columnFilters.hasBlank():
+                    item.checkState = Qt.Unchecked
+            items.append(item)
 
-        # Fill items
-        if self.listWidget.count() > 1:
-            self.itemChanged(self.listWidget.item(1))
+        columnType = self.model.columnType(self.fieldid)
+        if self.model.columnName(self.fieldid) == 'year' or \
+                columnType == Type.Denomination:
+            iconProvider = None
+        elif columnType == Type.Status:
+            iconProvider = statusIcon
+        else:
+            iconProvider = self.referenceIcon
 
-    def itemChanged(self, item):
-        self.listWidget.itemChanged.disconnect(self.itemChanged)
+        self.listModel = FilterListModel(items, iconProvider, self)
+        self.listModel.checkedChanged.connect(self.checkedChanged)
+        # Proxy keeps search text entered while values were loading
+        self.proxyModel.setSourceModel(self.listModel)
 
-        if item.type() == FilterMenuButton.SelectAllType:
-            for i in range(1, self.listWidget.count()):
-                self.listWidget.item(i).setCheckState(item.checkState())
+        self.loadingLabel.hide()
 
-            # Disable applying filter when nothing to show
-            button = self.buttonBox.button(QDialogButtonBox.Ok)
-            button.setDisabled(item.checkState() == Qt.Unchecked)
-        else:
-            checkedCount = 0
-            for i in range(1, self.listWidget.count()):
-                item = self.listWidget.item(i)
-                if item.checkState() == Qt.Checked:
-                    checkedCount = checkedCount + 1
-
-            if checkedCount == 0:
-                state = Qt.Unchecked
-            elif checkedCount == self.listWidget.count() - 1:
-                state = Qt.Checked
-            else:
-                state = Qt.PartiallyChecked
-            self.listWidget.item(0).setCheckState(state)
+        # Fill items
+        self.listModel.updateSelectAll()
 
-            # Disable applying filter when nothing to show
-            button = self.buttonBox.button(QDialogButtonBox.Ok)
-            button.setDisabled(checkedCount == 0)
+    def referenceIcon(self, value):
+        return self.reference.getIcon(self.columnName, value)
 
-        self.listWidget.itemChanged.connect(self.itemChanged)
+    def checkedChanged(self, checkedCount):
+        # Disable applying filter when nothing to show
+        button = self.buttonBox.button(QDialogButtonBox.Ok)
+        button.setDisabled(checkedCount == 0)
 
     def apply(self):
         filters = ColumnFilters(self.columnName)
-        unchecked = 0
-        checked = 0
-        for i in range(1, self.listWidget.count()):
-            item = self.listWidget.item(i)
-            if item.checkState() == Qt.Unchecked:
-                unchecked = unchecked + 1
-            else:
-                checked = checked + 1
+        items = self.listModel.items[1:]
+        checked = self.listModel.checkedCount()
+        unchecked = len(items) - checked
 
-        for i in range(1, self.listWidget.count()):
-            item = self.listWidget.item(i)
+        for item in items:
             if unchecked > checked:
-                if item.checkState() == Qt.Checked:
-                    if item.type() == FilterMenuButton.BlanksType:
+                if item.checkState == Qt.Checked:
+                    if item.type == FilterMenuButton.BlanksType:
                         filter_ = BlankFilter(self.columnName)
-                    elif item.type() == FilterMenuButton.DataType:
+                    elif item.type == FilterMenuButton.DataType:
                         filter_ = DataFilter(self.columnName)
                     else:
-                        value = item.data(Qt.UserRole)
-                        filter_ = ValueFilter(self.columnName, value)
+                        filter_ = ValueFilter(self.columnName, item.value)
 
                     filter_.revert = True
                     filters.addFilter(filter_)
             else:
-                if item.checkState() == Qt.Unchecked:
-                    if item.type() == FilterMenuButton.BlanksType:
+                if item.checkState == Qt.Unchecked:
+                    if item.type == FilterMenuButton.BlanksType:
                         filter_ = BlankFilter(self.columnName)
-                    elif item.type() == FilterMenuButton.DataType:
+                    elif item.type == FilterMenuButton.DataType:
                         filter_ = DataFilter(self.columnName)
                     else:
-                        value = item.data(Qt.UserRole)
-                        filter_ = ValueFilter(self.columnName, value)
+                        filter_ = ValueFilter(self.columnName, item.value)
 
                     filters.addFilter(filter_)
 
@@ -377,6 +425,23 @@ class FilterMenuButton(QPushButton):
 
         self.menu().hide()
 
+    def _validateCache(self):
+        generation = self.model.dataGeneration()
+        if generation != self._cacheGeneration:
+            self._cache.clear()
+            self._cacheGeneration = generation
+
+    def isCached(self, queries):
+        self._validateCache()
+        return queries in self._cache
+
+    def storeCache(self, queries, values):
+        self._validateCache()
+
+        self._cache[queries] = values
+        if len(self._cache) > self.CACHE_SIZE:
+            self._cache.popitem(last=False)
+
     def applyFilters(self, filters):
         if filters.filters():
             self.setIcon(QIcon(':/filters.ico'))
@@ -386,8 +451,8 @@ class FilterMenuButton(QPushButton):
             if self.fieldid in self.filters.keys():
                 self.filters.pop(self.fieldid)
 
-        filtersSql = self.filtersToSql(self.filters.values())
-        self.model.setFilter(filtersSql)
+        filtersSql, params = self.compileFilters(self.filters.values())
+        self.model.setFilter(filtersSql, params)
 
         self.listParam.save_filters()
 
@@ -395,21 +460,21 @@ class FilterMenuButton(QPushButton):
         self.setIcon(QIcon())
 
     def applySearch(self, text):
-        text = text.lower()
-        for i in range(self.listWidget.count()):
-            item = self.listWidget.item(i)
-            if item.text().lower().find(text) >= 0:
-                item.setHidden(False)
-            else:
-                item.setHidden(True)
+        if not text and not self.proxyModel.filterRegularExpression().pattern():
+            return
+
+        self.proxyModel.setFilterFixedString(text)
 
     @staticmethod
-    def filtersToSql(filters):
-        sqlFilters = []
-        for columnFilters in filters:
-            sqlFilters.append(columnFilters.toSql())
+    def filtersToFilter(filters):
+        parts = tuple(columnFilters.toFilter() for columnFilters in filters)
+        if parts:
+            return And(parts)
+        return None
 
-        return ' AND '.join(sqlFilters)
+    @staticmethod
+    def compileFilters(filters):
+        return compileFilter(FilterMenuButton.filtersToFilter(filters))
 
 
 class BaseFilter:
@@ -418,9 +483,12 @@ class BaseFilter:
         self.value = None
         self.revert = False
 
-    def toSql(self):
+    def toFilter(self):
         raise NotImplementedError
 
+    def toSql(self):
+        return filterToSql(self.toFilter())
+
     def isBlank(self):
         return False
 
@@ -437,35 +505,23 @@ class ValueFilter(BaseFilter):
 
         self.value = value
 
-    # TODO: Deprecated method
-    def toSql(self):
-        if self.revert:
-            return "%s='%s'" % (self.name, self.value.replace("'", "''"))
-        else:
-            return "%s<>'%s'" % (self.name, self.value.replace("'", "''"))
+    def toFilter(self):
+        return Equal(self.name, self.value, negate=not self.revert)
 
 
 class DataFilter(BaseFilter):
-    def toSql(self):
-        if self.revert:
-            # Filter out blank values
-            return "ifnull(%s,'')<>''" % self.name
-        else:
-            # Filter out not null and not empty values
-            return "ifnull(%s,'')=''" % self.name
+    def toFilter(self):
+        # Filter out not null and not empty values or blank values if revert
+        return Blank(self.name, negate=self.revert)
 
     def isData(self):
         return True
 
 
 class BlankFilter(BaseFilter):
-    def toSql(self):
-        if self.revert:
-            # Filter out not null and not empty values
-            return "ifnull(%s,'')=''" % self.name
-        else:
-            # Filter out blank values
-            return "ifnull(%s,'')<>''" % self.name
+    def toFilter(self):
+        # Filter out blank values or not blank values if revert
+        return Blank(self.name, negate=not self.revert)
 
     def isBlank(self):
         return True
@@ -499,37 +555,33 @@ class ColumnFilters:
     def hasRevert(self):
         return self._revert
 
-    def toSql(self):
-        values = []
-        for filter_ in self._valueFilters():
-            sql = "'%s'" % filter_.value.replace("'", "''")
-            values.append(sql)
+    def toFilter(self):
+        values = tuple(filter_.value for filter_ in self._valueFilters())
 
-        combinedFilters = ''
+        combinedFilter = None
         if values:
-            sqlValueFilters = ','.join(values)
-            if self.hasRevert():
-                combinedFilters = "%s IN (%s)" % (self.name, sqlValueFilters)
-            else:
-                combinedFilters = "%s NOT IN (%s)" % (self.name, sqlValueFilters)
+            combinedFilter = In(self.name, values, negate=not self.hasRevert())
 
         if self.hasBlank():
-            if combinedFilters:
+            if combinedFilter:
                 if self.hasRevert():
-                    combinedFilters = combinedFilters + ' OR ' + self._blank.toSql()
+                    combinedFilter = Or((combinedFilter, self._blank.toFilter()))
                 else:
-                    combinedFilters = combinedFilters + ' AND ' + self._blank.toSql()
+                    combinedFilter = And((combinedFilter, self._blank.toFilter()))
             else:
-                combinedFilters = self._blank.toSql()
+                combinedFilter = self._blank.toFilter()
         elif self.hasData():
             # Data filter can't contain any additional value filters
-            combinedFilters = self._data.toSql()
+            combinedFilter = self._data.toFilter()
 
         # Note: In SQLite SELECT * FROM coins WHERE title NOT IN ('value') also
         # filter out a NULL values. Work around this problem
         if not self.hasBlank() and not self.hasRevert():
-            combinedFilters = combinedFilters + (' OR %s IS NULL' % self.name)
-        return '(' + combinedFilters + ')'
+            combinedFilter = Or((combinedFilter, Sql('%s IS NULL' % self.name)))
+        return combinedFilter
+
+    def toSql(self):
+        return filterToSql(self.toFilter())
 
     def _valueFilters(self):
         for filter_ in self._filters:
@@ -837,30 +837,36 @@ class ColnectDialog(QDialog):
     def addCoins(self, indexes):
         progressDlg = None
 
-        for progress, index in enumerate(indexes):
-            if index.row() >= len(self.items):
-                break
-
-            if progressDlg:
-                progressDlg.setValue(progress)
-                if progressDlg.wasCanceled():
+        try:
+            for progress, index in enumerate(indexes):
+                if index.row() >= len(self.items):
                     break
 
-            record = self.makeCoin(index)
+                if progressDlg:
+                    progressDlg.setValue(progress)
+                    if progressDlg.wasCanceled():
+                        break
 
+                record = self.makeCoin(index)
+
+                if progressDlg:
+                    if not record.value('status'):
+                        record.setValue('status', self.model.settings['default_status'])
+                    self.model.bulkAppendRecord(record)
+                else:
+                    btn = self.model.addCoins(record, len(indexes) - progress)
+                    if btn == QDialogButtonBox.Abort:
+                        break
+                    if btn == QDialogButtonBox.SaveAll:
+                        progressDlg = ProgressDialog(
+                            self.tr("Inserting records"),
+                            self.tr("Cancel"),
+                            len(indexes), self)
+                        # Rest of coins are saved in one transaction
+                        self.model.beginBulkInsert()
+        finally:
             if progressDlg:
-                if not record.value('status'):
-                    record.setValue('status', self.model.settings['default_status'])
-                self.model.appendRecord(record)
-            else:
-                btn = self.model.addCoins(record, len(indexes) - progress)
-                if btn == QDialogButtonBox.Abort:
-                    break
-                if btn == QDialogButtonBox.SaveAll:
-                    progressDlg = ProgressDialog(
-                        self.tr("Inserting records"),
-                        self.tr("Cancel"),
-                        len(indexes), self)
+                self.model.endBulkInsert()
 
         if progressDlg:
             progressDlg.reset()
@@ -49,14 +49,19 @@ class _Import(QObject):
                 self.progressDlg.setMaximum(len(rows))
                 self.progressDlg.setLabelText(QApplication.translate('_Import', "Importing from %s") % src)
 
-                for progress, row in enumerate(rows):
-                    self.progressDlg.setValue(progress)
-                    if self.progressDlg.wasCanceled():
-                        break
-
-                    record = model.record()
-                    self._setRecord(record, row)
-                    model.appendRecord(record)
+                model.beginBulkInsert()
+                try:
+                    for progress, row in enumerate(rows):
+                        self.progressDlg.setValue(progress)
+                        if self.progressDlg.wasCanceled():
+                            break
+
+                        record = model.record()
+                        self._setRecord(record, row)
+                        model.bulkAppendRecord(record)
+                finally:
+                    self.progressDlg.setLabelText(QApplication.translate('_Import', "Saving..."))
+                    model.endBulkInsert()
 
                 self.progressDlg.reset()
             else:
@@ -139,14 +144,19 @@ class _Import2(QObject):
                 progressDlg.setMaximum(rows_count)
                 progressDlg.setLabelText(QApplication.translate('_Import2', "Importing from %s") % src)
 
-                for row in range(rows_count):
-                    progressDlg.setValue(row)
-                    if progressDlg.wasCanceled():
-                        break
-
-                    record = model.record()
-                    self._setRecord(record, row)
-                    model.appendRecord(record)
+                model.beginBulkInsert()
+                try:
+                    for row in range(rows_count):
+                        progressDlg.setValue(row)
+                        if progressDlg.wasCanceled():
+                            break
+
+                        record = model.record()
+                        self._setRecord(record, row)
+                        model.bulkAppendRecord(record)
+                finally:
+                    progressDlg.setLabelText(QApplication.translate('_Import2', "Saving..."))
+                    model.endBulkInsert()
 
                 progressDlg.reset()
             else:
@@ -0,0 +1,236 @@
+import itertools
+import sqlite3
+from urllib.request import pathname2url
+
+from PySide6.QtCore import Qt, QObject, QThread
+from PySide6.QtCore import Signal as pyqtSignal
+from PySide6.QtCore import Slot as pyqtSlot
+from PySide6.QtSql import QSqlDatabase, QSqlQuery
+
+
+class _QueryWorker(QObject):
+    finished = pyqtSignal(int, object)
+
+    def __init__(self, fileName, connectionName, service):
+        super().__init__()
+
+        self.fileName = fileName
+        self.connectionName = connectionName
+        self.service = service
+        self.db = None
+
+    def _open(self):
+        # Connection must be created in the thread where it will be used
+        self.db = QSqlDatabase.addDatabase('QSQLITE', self.connectionName)
+        self.db.setDatabaseName(self.fileName)
+        self.db.setConnectOptions("QSQLITE_OPEN_READONLY;QSQLITE_BUSY_TIMEOUT=5000")
+        if not self.db.open():
+            print(self.db.lastError().text())
+
+    @pyqtSlot(int, object)
+    def exec(self, ticket, queries):
+        if self.service.isCancelled(ticket):
+            return
+
+        if self.db is None:
+            self._open()
+
+        results = []
+        for sql, binds in queries:
+            query = QSqlQuery(self.db)
+            query.setForwardOnly(True)
+            query.prepare(sql)
+            for bind in binds:
+                query.addBindValue(bind)
+            query.exec()
+
+            rows = []
+            while query.next():
+                # Stop reading rows of superseded request
+                if self.service.isCancelled(ticket):
+                    query.finish()
+                    return
+
+                record = query.record()
+                rows.append(tuple(record.value(i) for i in range(record.count())))
+            query.finish()
+
+            results.append(rows)
+
+        self.finished.emit(ticket, results)
+
+    @pyqtSlot()
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+            QSqlDatabase.removeDatabase(self.connectionName)
+
+
+class QueryService(QObject):
+    """Runs read-only queries on a separate connection in a worker thread"""
+    _request = pyqtSignal(int, object)
+    _close = pyqtSignal()
+
+    _ids = itertools.count(1)
+
+    def __init__(self, fileName, parent=None):
+        super().__init__(parent)
+
+        self._tickets = itertools.count(1)
+        self._active = {}
+
+        self._worker = self._createWorker(fileName)
+        self._thread = QThread(self)
+        self._worker.moveToThread(self._thread)
+
+        self._request.connect(self._worker.exec)
+        self._close.connect(self._worker.close, Qt.BlockingQueuedConnection)
+        self._worker.finished.connect(self._finished)
+
+        self._thread.start()
+
+    def _createWorker(self, fileName):
+        connectionName = 'query_service_%d' % next(self._ids)
+        return _QueryWorker(fileName, connectionName, self)
+
+    def submit(self, handle, queries):
+        ticket = next(self._tickets)
+        self._active[ticket] = handle
+
+        # Query may be a plain SQL or SQL with bind values
+        request = []
+        for query in queries:
+            if isinstance(query, str):
+                request.append((query, ()))
+            else:
+                request.append(query)
+
+        self._request.emit(ticket, request)
+
+        return ticket
+
+    def cancel(self, ticket):
+        self._active.pop(ticket, None)
+
+    def isCancelled(self, ticket):
+        return ticket not in self._active
+
+    def _finished(self, ticket, results):
+        handle = self._active.pop(ticket, None)
+        if handle is not None:
+            try:
+                handle.finished.emit(results)
+            except RuntimeError:
+                # Handle was deleted together with its view
+                pass
+
+    def close(self):
+        self._active.clear()
+
+        self._close.emit()
+        self._thread.quit()
+        self._thread.wait()
+
+
+class _InterruptibleWorker(QObject):
+    finished = pyqtSignal(int, object)
+
+    def __init__(self, fileName, service):
+        super().__init__()
+
+        self.fileName = fileName
+        self.service = service
+        self.connection = None
+
+    def _open(self):
+        uri = 'file:%s?mode=ro' % pathname2url(self.fileName)
+        # Connection is interrupted from main thread
+        self.connection = sqlite3.connect(uri, uri=True, timeout=5,
+                                          check_same_thread=False)
+
+    @pyqtSlot(int, object)
+    def exec(self, ticket, queries):
+        if self.service.isCancelled(ticket):
+            return
+
+        try:
+            if self.connection is None:
+                self._open()
+
+            results = []
+            for sql, binds in queries:
+                rows = self.connection.execute(sql, binds).fetchall()
+                results.append(rows)
+        except sqlite3.OperationalError as error:
+            if self.service.isCancelled(ticket):
+                # Interrupted by next request
+                return
+
+            print(error)
+            results = None
+
+        self.finished.emit(ticket, results)
+
+    def interrupt(self):
+        if self.connection is not None:
+            self.connection.interrupt()
+
+    @pyqtSlot()
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class InterruptibleQueryService(QueryService):
+    """Runs one request at a time. New request interrupts running query
+    with sqlite3_interrupt instead of waiting for it"""
+
+    def _createWorker(self, fileName):
+        return _InterruptibleWorker(fileName, self)
+
+    def submit(self, handle, queries):
+        self._cancelAll()
+        return super().submit(handle, queries)
+
+    def cancel(self, ticket):
+        super().cancel(ticket)
+        self._worker.interrupt()
+
+    def _cancelAll(self):
+        if self._active:
+            self._active.clear()
+            self._worker.interrupt()
+
+
+class AsyncQuery(QObject):
+    """Handle for requests of one view. New request supersedes previous one"""
+    finished = pyqtSignal(object)
+
+    def __init__(self, collection, parent=None, interruptible=False):
+        super().__init__(parent)
+
+        self.collection = collection
+        self.interruptible = interruptible
+        self._service = None
+        self._ticket = None
+
+    def exec(self, queries):
+        self.cancel()
+
+        # Service is recreated when other collection opened
+        if self.interruptible:
+            self._service = self.collection.interruptibleQueryService()
+        else:
+            self._service = self.collection.queryService()
+        self._ticket = self._service.submit(self, queries)
+
+    def cancel(self):
+        if self._ticket is not None:
+            self._service.cancel(self._ticket)
+            self._ticket = None
+
+    def isActive(self):
+        return self._ticket is not None and \
+            not self._service.isCancelled(self._ticket)
@@ -3,7 +3,9 @@ from PySide6.QtSql import QSqlQuery
 from PySide6.QtWidgets import QApplication
 
 from OpenNumismat.Collection.CollectionFields import FieldTypes as Type
+from OpenNumismat.Collection.CollectionFields import ImageFields
 from OpenNumismat.Tools import Gui
+from OpenNumismat.Tools.ImageProcessing import imageDigest
 
 
 class Updater(QObject):
@@ -49,6 +51,9 @@ class Updater(QObject):
             if self.currentVersion < 10:
                 updater = UpdaterTo10(self.collection)
                 updater.update()
+            if self.currentVersion < 11:
+                updater = UpdaterTo11(self.collection)
+                updater.update()
 
             self.__finalize()
 
@@ -663,6 +668,93 @@ class UpdaterTo10(_Updater):
         self._finish()
 
 
+class UpdaterTo11(_Updater):
+
+    def __init__(self, collection):
+        super().__init__(collection)
+        self.progressDlg.setMinimumDuration(0)
+
+    def getTotalCount(self):
+        sql = "SELECT count(*) FROM photos"
+        query = QSqlQuery(sql, self.db)
+        query.first()
+        return query.record().value(0) + 6
+
+    def update(self):
+        self._begin()
+
+        self.db.transaction()
+
+        self._updateRecord()
+
+        self.collection.createPhotoHashesTable()
+
+        self._updateRecord()
+
+        # Store same photos once
+        sql = "ALTER TABLE photos ADD COLUMN hash TEXT"
+        QSqlQuery(sql, self.db)
+        sql = "ALTER TABLE photos ADD COLUMN refs INTEGER"
+        QSqlQuery(sql, self.db)
+
+        digests = []
+        query = QSqlQuery("SELECT id, image FROM photos", self.db)
+        while query.next():
+            self._updateRecord()
+
+            record = query.record()
+            image = record.value('image')
+            if image:
+                digests.append((record.value('id'), imageDigest(image)))
+        query.finish()
+
+        query = QSqlQuery(self.db)
+        query.prepare("UPDATE photos SET hash=? WHERE id=?")
+        for photo_id, digest in digests:
+            query.addBindValue(digest)
+            query.addBindValue(photo_id)
+            query.exec()
+
+        self.collection.createIndexes()
+
+        self._updateRecord()
+
+        for field in ImageFields:
+            sql = f"""UPDATE coins SET {field}=
+                (SELECT MIN(same.id) FROM photos same
+                 INNER JOIN photos ON same.hash=photos.hash AND
+                    ifnull(same.title, '')=ifnull(photos.title, '')
+                 WHERE photos.id=coins.{field})
+                WHERE {field} IN (SELECT id FROM photos WHERE hash IS NOT NULL)"""
+            QSqlQuery(sql, self.db)
+
+        sql = """DELETE FROM photos WHERE hash IS NOT NULL AND id NOT IN
+            (SELECT MIN(id) FROM photos GROUP BY hash, ifnull(title, ''))"""
+        QSqlQuery(sql, self.db)
+        sql = """DELETE FROM photo_hashes
+            WHERE photo_id NOT IN (SELECT id FROM photos)"""
+        QSqlQuery(sql, self.db)
+
+        self.collection.updatePhotoRefs()
+
+        self._updateRecord()
+
+        self.collection.createFullTextIndex()
+
+        self._updateRecord()
+
+        self.collection.createTagsClosureTable()
+
+        self._updateRecord()
+
+        self.collection.settings['Version'] = 11
+        self.collection.settings.save()
+
+        self.db.commit()
+
+        self._finish()
+
+
 def updateCollection(collection):
     updater = Updater(collection, collection.parent())
     if updater.check():
@@ -1,6 +1,5 @@
 from PySide6.QtCore import Qt, QSettings, QUrl
 from PySide6.QtGui import QDesktopServices
-from PySide6.QtSql import QSqlQuery
 from PySide6.QtWidgets import QSizePolicy
 from PySide6.QtCore import Signal as pyqtSignal
 from PySide6.QtCore import Slot as pyqtSlot
@@ -8,6 +7,7 @@ from PySide6.QtWebChannel import QWebChannel
 from PySide6.QtWebEngineCore import QWebEnginePage
 from PySide6.QtWebEngineWidgets import QWebEngineView
 
+from OpenNumismat.Collection.QueryService import AsyncQuery
 from OpenNumismat.Tools.CursorDecorators import waitCursorDecorator
 from OpenNumismat.Settings import Settings
 
@@ -61,20 +61,23 @@ class BaseMapWidget(QWebView):
     def setModel(self, model):
         self.model = model
 
+        self.asyncQuery = AsyncQuery(model.collection, self)
+        self.asyncQuery.finished.connect(self.markersLoaded)
+
     def modelChanged(self):
+        # Clear markers until new ones loaded in background
         self.points = []
+        self.showMarkers()
+
         sql = "SELECT latitude, longitude, id, status FROM coins WHERE ifnull(latitude,'')<>'' AND ifnull(longitude,'')<>''"
         filter_ = self.model.filter()
         if filter_:
             sql += " AND " + filter_
-        query = QSqlQuery(self.model.database())
-        query.exec(sql)
-        while query.next():
-            record = query.record()
-            lat = record.value(0)
-            lng = record.value(1)
-            coin_id = record.value(2)
-            status = record.value(3)
+        self.asyncQuery.exec([(sql, self.model.filterParams())])
+
+    def markersLoaded(self, results):
+        self.points = []
+        for lat, lng, coin_id, status in results[0]:
             self.addMarker(lat, lng, coin_id, status)
 
         self.showMarkers()
@@ -1,6 +1,9 @@
-import cv2
 import imagehash
 import io
+import multiprocessing
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 from dataclasses import dataclass
 from PIL import Image
 import numpy as np
@@ -10,6 +13,7 @@ from PySide6.QtGui import QImage, QPixmap, QIcon, QTextOption, QPalette, QColor
 from PySide6.QtSql import QSqlQuery
 from PySide6.QtWidgets import (
     QAbstractItemView,
+    QApplication,
     QCheckBox,
     QComboBox,
     QDialog,
@@ -38,6 +42,8 @@ from OpenNumismat.EditCoinDialog.ImageLabel import ImageEdit, ImageLabel
 from OpenNumismat.Tools.DialogDecorators import storeDlgSizeDecorator
 from OpenNumismat.Tools import Gui
 from OpenNumismat.Tools.Gui import statusColor
+from OpenNumismat.Tools.ImageHash import imageDataHash, imageHash
+from OpenNumismat.Tools.ImageProcessing import imageDigest
 
 
 @dataclass(slots=True, frozen=True)
@@ -197,71 +203,84 @@ class FindDialog(QDialog):
                                 self.tr("No image fields selected"))
             return
 
-        # Get count of coins with photos
-        row_count = 0
-        sql = "SELECT COUNT(*) FROM coins"
-        for field in fields:
-            sql += " LEFT JOIN photos %s ON coins.%s=%s.id" % (field, field, field)
-        if self.model.filter():
-            sql += " WHERE " + self.model.filter()
-        query = QSqlQuery(sql, self.model.database())
-        if query.first():
-            record = query.record()
-            row_count = record.value(0)
+        db = self.model.database()
 
+        # Get photos of coins with hashes stored by previous searches
         sql_fileds = ""
         for field in fields:
-            sql_fileds += ", %s.image AS %s_image, %s.id AS %s_id" % (field, field, field, field)
-        sql = "SELECT coins.id, coins.title, coins.status%s FROM coins" % sql_fileds
+            sql_fileds += ", coins.%s AS %s_id, %s.hash AS %s_hash" % (field, field, field, field)
+        sql = "SELECT coins.id AS coin_id, coins.title AS coin_title, coins.status AS coin_status%s FROM coins" % sql_fileds
         for field in fields:
-            sql += " LEFT JOIN photos %s ON coins.%s=%s.id" % (field, field, field)
+            sql += " LEFT JOIN photo_hashes %s ON coins.%s=%s.photo_id AND %s.method='%s'" % (field, field, field, field, method)
         if self.model.filter():
             # TODO: Filter by title fail this request
             sql += " WHERE " + self.model.filter()
-        query = QSqlQuery(sql, self.model.database())
-
-        progressDlg = Gui.ProgressDialog(
-                    self.tr("Processing..."),
-                    self.tr("Cancel"), row_count,
-                    self)
-
-        comparison_results = []
+        query = QSqlQuery(db)
+        query.prepare(sql)
+        for param in self.model.filterParams():
+            query.addBindValue(param)
+        query.exec()
 
+        coins = []
+        missed_ids = set()
         while query.next():
-            progressDlg.step()
-            if progressDlg.wasCanceled():
-                break
-
             record = query.record()
-            coin_id = record.value('coins.id')
-            coin_title = record.value('coins.title')
-            coin_status = record.value('coins.status')
 
-            record_distances = {}
+            photos = []
             for field in fields:
-                img = record.value('%s_image' % field)
-                if img:
-                    pil_img = Image.open(io.BytesIO(img))
-                    hash_ = self._imageHash(pil_img, method)
-
-                    # TODO: Test similarity threshold here
-                    record_distances[field] = target_hash - hash_
-                    # record_distances[field] = (target_hash - hash_) / len(hash_.hash) ** 2
-
-            if record_distances:
-                field = min(record_distances, key=record_distances.get)
                 photo_id = record.value('%s_id' % field)
-                distance = record_distances[field]
+                if photo_id:
+                    hash_ = record.value('%s_hash' % field)
+                    if not hash_:
+                        missed_ids.add(photo_id)
+                    photos.append((photo_id, hash_))
+
+            if photos:
+                coins.append((record.value('coin_id'),
+                              record.value('coin_title'),
+                              record.value('coin_status'),
+                              photos))
+
+        hashes = self._fillHashes(missed_ids, method)
+
+        # Flatten photos for comparing all hashes at once
+        coin_indexes = []
+        photo_ids = []
+        photo_hashes = []
+        for i, (_coin_id, _coin_title, _coin_status, photos) in enumerate(coins):
+            for photo_id, hash_ in photos:
+                if not hash_:
+                    hash_ = hashes.get(photo_id)
+                if hash_:
+                    coin_indexes.append(i)
+                    photo_ids.append(photo_id)
+                    photo_hashes.append(hash_)
 
-                comparison_results.append(ComparisonResult(
-                    coin_id,
-                    coin_title,
-                    photo_id,
-                    distance,
-                    statusColor(coin_status)
-                ))
+        if method == 'crop_resistant_hash':
+            distances = [target_hash - imagehash.hex_to_multihash(hash_)
+                         for hash_ in photo_hashes]
+        else:
+            # Hamming distance over packed 64-bit hashes
+            target = np.uint64(int(str(target_hash), 16))
+            values = np.array([int(hash_, 16) for hash_ in photo_hashes],
+                              dtype=np.uint64)
+            distances = np.bitwise_count(values ^ target).tolist()
 
-        progressDlg.reset()
+        best = {}
+        for i, photo_id, distance in zip(coin_indexes, photo_ids, distances):
+            if i not in best or distance < best[i][1]:
+                best[i] = (photo_id, distance)
+
+        comparison_results = []
+        for i, (photo_id, distance) in best.items():
+            coin_id, coin_title, coin_status, _photos = coins[i]
+            comparison_results.append(ComparisonResult(
+                coin_id,
+                coin_title,
+                photo_id,
+                distance,
+                statusColor(coin_status)
+            ))
 
         comparison_results = sorted(comparison_results, key=lambda x: x.distance)
 
@@ -289,37 +308,126 @@ class FindDialog(QDialog):
 
         self.table.update()
 
+    def _fillHashes(self, photo_ids, method, inProcess=False):
+        hashes = {}
+        if not photo_ids:
+            return hashes
+
+        db = self.model.database()
+
+        progressDlg = Gui.ProgressDialog(
+                    self.tr("Processing..."),
+                    self.tr("Cancel"), len(photo_ids),
+                    self)
+
+        # Photos are read here and decoded with hashing by worker processes
+        workers = os.cpu_count() or 1
+        executor = None
+        if not inProcess:
+            executor = ProcessPoolExecutor(
+                workers, mp_context=multiprocessing.get_context('spawn'))
+        pending = {}  # future => digest
+        waiting = {}  # digest => photo ids with same image
+
+        db.transaction()
+
+        try:
+            for photo_id in photo_ids:
+                if progressDlg.wasCanceled():
+                    break
+
+                img = self._getImageData(photo_id)
+                if not img:
+                    progressDlg.step()
+                    continue
+
+                digest = imageDigest(img)
+                if digest in waiting:
+                    waiting[digest].append(photo_id)
+                    continue
+
+                # Same image can be stored for several coins
+                query = QSqlQuery(db)
+                query.prepare("SELECT hash FROM photo_hashes WHERE digest=? AND method=? LIMIT 1")
+                query.addBindValue(digest)
+                query.addBindValue(method)
+                query.exec()
+                if query.first():
+                    self._storeHash(photo_id, method, digest, query.record().value(0), hashes)
+                    progressDlg.step()
+                    continue
+
+                if executor is None:
+                    hash_ = imageDataHash(img.data(), method)
+                    if hash_:
+                        self._storeHash(photo_id, method, digest, hash_, hashes)
+                    progressDlg.step()
+                    continue
+
+                waiting[digest] = [photo_id]
+                future = executor.submit(imageDataHash, img.data(), method)
+                pending[future] = digest
+
+                # Limit count of images kept in memory
+                while len(pending) >= workers * 4 and not progressDlg.wasCanceled():
+                    self._collectHashes(pending, waiting, method, hashes, progressDlg)
+
+            while pending and not progressDlg.wasCanceled():
+                self._collectHashes(pending, waiting, method, hashes, progressDlg)
+        except BrokenProcessPool as error:
+            # Worker process crashed or was killed - hash all photos again
+            # in this process
+            print(error)
+            executor.shutdown(wait=False, cancel_futures=True)
+            executor = None
+            db.rollback()
+            progressDlg.reset()
+
+            return self._fillHashes(photo_ids, method, inProcess=True)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+        db.commit()
+
+        progressDlg.reset()
+
+        return hashes
+
+    def _collectHashes(self, pending, waiting, method, hashes, progressDlg):
+        done, _ = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+        for future in done:
+            digest = pending.pop(future)
+            try:
+                hash_ = future.result()
+            except BrokenProcessPool:
+                raise
+            except Exception as error:
+                # Photo that can't be hashed is skipped
+                print(error)
+                hash_ = None
+            for photo_id in waiting.pop(digest):
+                if hash_:
+                    self._storeHash(photo_id, method, digest, hash_, hashes)
+                progressDlg.step()
+
+        if not done:
+            QApplication.processEvents()
+
+    def _storeHash(self, photo_id, method, digest, hash_, hashes):
+        query = QSqlQuery(self.model.database())
+        query.prepare("INSERT OR REPLACE INTO photo_hashes (photo_id, method, digest, hash)"
+                      " VALUES (?, ?, ?, ?)")
+        query.addBindValue(photo_id)
+        query.addBindValue(method)
+        query.addBindValue(digest)
+        query.addBindValue(hash_)
+        query.exec()
+
+        hashes[photo_id] = hash_
+
     def _imageHash(self, image, method):
-        # Squaring
-        if method != 'crop_resistant_hash':
-            w, h = image.size
-            if w > h:
-                offset = (w - h) // 2
-                image = image.crop((offset, 0, w - offset, h))
-            else:
-                offset = (h - w) // 2
-                image = image.crop((0, offset, w, h - offset))
-
-        # Resize
-        # image = image.resize((256, 256), Image.Resampling.LANCZOS)
-
-        # Filter
-        if method == 'phash_orb':
-            image = img2orientedBRIEF(image)
-
-        # Compute hash
-        if method == 'ahash':
-            return imagehash.average_hash(image)
-        elif method == 'phash' or method == 'phash_orb':
-            return imagehash.phash(image)
-        elif method == 'dhash':
-            return imagehash.dhash(image)
-        elif method == 'whash':
-            return imagehash.whash(image)
-        elif method == 'colorhash':
-            return imagehash.colorhash(image)
-        elif method == 'crop_resistant_hash':
-            return imagehash.crop_resistant_hash(image)
+        return imageHash(image, method)
 
     def _updateTableSizes(self):
         defaultHeight = self.table.verticalHeader().defaultSectionSize()
@@ -484,30 +592,3 @@ class CardDelegate(QStyledItemDelegate):
             image_rect.setSize(pixmap.size())
             painter.drawPixmap(image_rect, pixmap)
 
-
-def img2orientedBRIEF(image, nfeatures=2000):
-    if isinstance(image, Image.Image):  # convert PIL to cv2
-        image = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
-
-    if len(image.shape) == 3:
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-
-    # https://www.geeksforgeeks.org/feature-detection-and-matching-with-opencv-python/
-    orb = cv2.ORB_create(nfeatures=nfeatures)
-    kp = orb.detect(image)
-
-    height, width = image.shape
-    img = np.zeros([height, width, 1], dtype=np.uint8)
-    img.fill(255)
-
-    # Drawing the keypoints
-    if width <= 512:
-        for i in kp:
-            x = int(i.pt[0])
-            y = int(i.pt[1])
-            cv2.circle(img, (x, y), 2, (0, 0, 255), -1)
-    else:
-        img = cv2.drawKeypoints(img, kp, 0, color=(0, 255, 0))
-
-    image = Image.fromarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))  # convert cv2 to PIL
-    return image
@@ -10,9 +10,12 @@ from PySide6.QtCore import (
     QMargins,
     QMimeData,
     QModelIndex,
+    QObject,
     QRect,
     QRectF,
+    QRunnable,
     QSortFilterProxyModel,
+    QThreadPool,
     QUrl,
 )
 from PySide6.QtCore import Signal as pyqtSignal
@@ -25,9 +28,10 @@ from PySide6.QtGui import (
     QKeySequence,
     QPalette,
     QPixmap,
+    QPixmapCache,
     QTextOption,
 )
-from PySide6.QtSql import QSqlQuery
+from PySide6.QtSql import QSqlDatabase, QSqlQuery
 from PySide6.QtWidgets import (
     QAbstractItemView,
     QApplication,
@@ -47,6 +51,8 @@ from OpenNumismat.Collection.CollectionFields import FieldTypes as Type
 from OpenNumismat.Collection.CollectionFields import Statuses
 from OpenNumismat.SelectColumnsDialog import SelectColumnsDialog
 from OpenNumismat.Collection.HeaderFilterMenu import FilterMenuButton
+from OpenNumismat.Collection.QueryService import AsyncQuery
+from OpenNumismat.Collection.FilterCompiler import Like, Or, filterToSql
 from OpenNumismat.Tools import Gui, TemporaryDir
 from OpenNumismat.Tools.Converters import compareYears
 from OpenNumismat.Reports.Report import Report
@@ -77,6 +83,7 @@ class BaseTableView(QTableView):
     rowChanged = pyqtSignal(object)
     # TODO: Changes mime type
     MimeType = 'num/data'
+    PrefetchMargin = 256
 
     def __init__(self, listParam, parent=None):
         super().__init__(parent)
@@ -85,7 +92,10 @@ class BaseTableView(QTableView):
 
         self.sortingChanged = False
         self.searchText = ''
+        self.searchQuery = None
         self.listParam = listParam
+        # Load only visible rows (and prefetch margin) instead of whole list
+        self.lazyLoading = False
 
         self.selectedId = None
 
@@ -128,20 +138,43 @@ class BaseTableView(QTableView):
         return self.dragDropMode() == QAbstractItemView.InternalMove
 
     def modelChanged(self):
-        # Fetch all selected records
-        while self.model().canFetchMore():
-            self.model().fetchMore()
-        newCount = self.model().rowCount()
+        if self.lazyLoading:
+            # Fetch only records required for filling view, the rest will be
+            # fetched by view itself while scrolling
+            self._fetchVisible()
+
+            # Count of coins found by background search
+            newCount = self.model().foundCount()
+            if newCount is None:
+                filter_ = self.model().filter()
+                sql = "SELECT count(*) FROM coins"
+                if filter_:
+                    sql += " WHERE " + filter_
+                newCount = self.model().collection.queryValue(
+                    sql, self.model().filterParams())
+        else:
+            # Fetch all selected records
+            self._fetchAll()
+            newCount = self.model().rowCount()
 
         # Show updated coins count
         sql = "SELECT count(*) FROM coins"
-        query = QSqlQuery(sql, self.model().database())
-        query.first()
-        totalCount = query.record().value(0)
+        totalCount = self.model().collection.queryValue(sql)
 
         labelText = QApplication.translate('BaseTableView', "%d/%d records") % (newCount, totalCount)
         self.listCountLabel.setText(labelText)
 
+    def _fetchAll(self):
+        while self.model().canFetchMore():
+            self.model().fetchMore()
+
+    def _fetchVisible(self):
+        rowHeight = self.verticalHeader().defaultSectionSize()
+        visibleCount = self.viewport().height() // max(rowHeight, 1) + 1
+        needCount = visibleCount + self.PrefetchMargin
+        while self.model().canFetchMore() and self.model().rowCount() < needCount:
+            self.model().fetchMore()
+
     def itemDClicked(self, _index):
         selected_count = len(self.selectedCoins())
         if not selected_count:
@@ -168,6 +201,7 @@ class BaseTableView(QTableView):
             self.scrollToIndex(index)
             self.clearSelection()
         elif event.matches(QKeySequence.MoveToEndOfDocument):
+            self._fetchAll()
             index = self.model().index(self.model().rowCount() - 1, 0)
             self.scrollToIndex(index)
             self.clearSelection()
@@ -208,6 +242,8 @@ class BaseTableView(QTableView):
         pass
 
     def report(self):
+        self._fetchAll()
+
         indexes = []
         for i in range(self.model().rowCount()):
             index = self.proxyModel.index(i, 0)
@@ -230,6 +266,8 @@ class BaseTableView(QTableView):
         dstPath = os.path.join(TemporaryDir.path(), template_name + '.htm')
         report = Report(self.model(), template, dstPath, self)
 
+        self._fetchAll()
+
         indexes = []
         for i in range(self.model().rowCount()):
             index = self.proxyModel.index(i, 0)
@@ -259,6 +297,8 @@ class BaseTableView(QTableView):
             self, 'export_table', defaultFileName,
             OpenNumismat.HOME_PATH, filters)
         if fileName:
+            self._fetchAll()
+
             model = self.model()
             progressDlg = Gui.ProgressDialog(
                 QApplication.translate('BaseTableView', "Saving list"),
@@ -484,24 +524,8 @@ class BaseTableView(QTableView):
             QMessageBox.Yes | QMessageBox.Cancel,
             QMessageBox.Cancel)
         if result == QMessageBox.Yes:
-            progressDlg = Gui.ProgressDialog(
-                QApplication.translate('BaseTableView', "Deleting records"),
-                QApplication.translate('BaseTableView', "Cancel"),
-                len(indexes), self)
-
-            model = self.model()
-            for index in indexes:
-                progressDlg.step()
-                if progressDlg.wasCanceled():
-                    break
-
-                model.removeRow(index.row())
-
-            progressDlg.setLabelText(
-                QApplication.translate('BaseTableView', "Saving..."))
-            model.submitAll()
-
-            progressDlg.reset()
+            rows = [index.row() for index in indexes]
+            self.model().removeCoins(rows)
 
     def _clone(self, index=None):
         if not index:
@@ -510,6 +534,84 @@ class BaseTableView(QTableView):
         record = self.model().record(index.row())
         self.model().addCoin(record, self)
 
+    def search(self, text):
+        self.searchText = text
+        self.model().setSearchFilter(self.searchFilter(text))
+
+    def scheduleSearch(self, text):
+        # With lazy loading coins are found on a background connection, and
+        # running search is interrupted by next one. Only ids found for last
+        # text are applied to view. Without it view fetches all found coins
+        # itself
+        if self.searchQuery is None:
+            self.searchQuery = AsyncQuery(self.model().collection, self,
+                                          interruptible=True)
+            self.searchQuery.finished.connect(self.searchFinished)
+
+        if not text or not self.lazyLoading:
+            self.searchQuery.cancel()
+            self.search(text)
+            return
+
+        filter_ = self.model().combinedFilter(self.searchFilter(text))
+        params = self.model().filterParams()
+        sql = "SELECT id FROM coins"
+        if filter_:
+            sql += " WHERE " + filter_
+
+        self._scheduled = (text, filter_, params, self.model().dataGeneration())
+        self.searchQuery.exec([(sql, params)])
+
+    def searchFinished(self, results):
+        text, filter_, params, generation = self._scheduled
+        model = self.model()
+        searchFilter = self.searchFilter(text)
+        if results is None or generation != model.dataGeneration() or \
+                (filter_, params) != (model.combinedFilter(searchFilter),
+                                      model.filterParams()):
+            # Coins or other filters changed while searching
+            self.search(text)
+            return
+
+        self.searchText = text
+        model.setSearchFilter(searchFilter, [row[0] for row in results[0]])
+
+    def searchFilter(self, text):
+        raise NotImplementedError
+
+    def _searchFilter(self, text, parts):
+        model = self.model()
+
+        # Indexed text columns are searched by full-text index
+        filters = []
+        fullTextFields = model.collection.fullTextFields()
+        fullTextParts = [part for part in parts if part in fullTextFields]
+        if fullTextParts:
+            fullTextFilter = model.collection.fullTextFilter(text, fullTextParts)
+            if fullTextFilter:
+                filters.append(fullTextFilter)
+            parts = [part for part in parts if part not in fullTextFields]
+
+        val = "%%%s%%" % text
+        values = []
+        val_lower = val.lower()
+        values.append(val_lower)
+        val_upper = val.upper()
+        if val_lower != val_upper:
+            values.append(val_upper)
+            values.append(val.title())
+        if val not in values:
+            values.append(val)
+
+        for part in parts:
+            for val in values:
+                filters.append(Like(part, val))
+
+        if filters:
+            return filterToSql(Or(tuple(filters)))
+        else:
+            return ''
+
 
 class ImageDelegate(QStyledItemDelegate):
     def __init__(self, parent):
@@ -542,11 +644,20 @@ class SortFilterProxyModel(QSortFilterProxyModel):
         self.year_id = model.fields.year.id
 
         self.setDynamicSortFilter(True)
+        # Sort by SQL ORDER BY instead of comparing loaded rows
+        self.sortInDatabase = False
 
         locale = Settings()['locale']
         self.collator = QCollator(QLocale(locale))
         self.collator.setNumericMode(True)
 
+    def sort(self, column, order=Qt.AscendingOrder):
+        if self.sortInDatabase:
+            super().sort(-1, order)
+            self.model.sortInDatabase(column, order)
+        else:
+            super().sort(column, order)
+
     def lessThan(self, left, right):
         leftData = self.model.dataDisplayRole(left)
         rightData = self.model.dataDisplayRole(right)
@@ -574,6 +685,8 @@ class ListView(BaseTableView):
     def __init__(self, listParam, parent=None):
         super().__init__(listParam, parent)
 
+        self.lazyLoading = Settings()['lazy_list']
+
         self.setSelectionBehavior(QAbstractItemView.SelectRows)
         self.setSelectionMode(QAbstractItemView.ExtendedSelection)
         self.setEditTriggers(QAbstractItemView.NoEditTriggers)
@@ -696,6 +809,7 @@ class ListView(BaseTableView):
         model.rowInserted.connect(self.scrollToIndex)
 
         self.proxyModel = SortFilterProxyModel(model, self)
+        self.proxyModel.sortInDatabase = self.lazyLoading
         super().setModel(self.proxyModel)
         model.proxy = self.proxyModel
 
@@ -705,9 +819,9 @@ class ListView(BaseTableView):
                                    self.horizontalHeader())
             self.headerButtons.append(btn)
 
-        filtersSql = FilterMenuButton.filtersToSql(
+        filtersSql, params = FilterMenuButton.compileFilters(
                                             self.listParam.filters.values())
-        self.model().setFilter(filtersSql)
+        self.model().setFilter(filtersSql, params)
 
         self.horizontalHeader().sectionResized.disconnect(self.columnResized)
         self.horizontalHeader().sortIndicatorChanged.disconnect(
@@ -948,28 +1062,18 @@ class ListView(BaseTableView):
 
         index1 = QTableView.currentIndex(self)
         if index1.row() == self.model().rowCount() - 1:
-            return
+            if not self.model().canFetchMore():
+                return
+            self.model().fetchMore()
 
         index2 = self.proxyModel.index(index1.row() + 1, 0)
 
         self.model().moveRows(index1.row(), index2.row())
 
-    def search(self, text):
-        self.searchText = text
+    def searchFilter(self, text):
         model = self.model()
 
         if text:
-            val = "'%%%s%%'" % text.replace("'", "''")
-            values = []
-            val_lower = val.lower()
-            values.append(val_lower)
-            val_upper = val.upper()
-            if val_lower != val_upper:
-                values.append(val_upper)
-                values.append(val.title())
-            if val not in values:
-                values.append(val)
-
             parts = []
             for param in self.listParam.columns:
                 if not param.enabled:
@@ -981,15 +1085,13 @@ class ListView(BaseTableView):
 
                 parts.append(field.name)
 
-            sql = []
-            for part in parts:
-                for val in values:
-                    sql.append("%s LIKE %s" % (part, val))
-            model.setSearchFilter('(' + ' OR '.join(sql) + ')')
+            return self._searchFilter(text, parts)
         else:
-            model.setSearchFilter('')
+            return ''
 
     def saveSorting(self):
+        self._fetchAll()
+
         sort_column_id = self.model().fields.sort_id.id
         indexes = []
         for i in range(self.model().rowCount()):
@@ -1002,14 +1104,141 @@ class ListView(BaseTableView):
             self.clearSorting()
 
 
+class _ImageDecodeTask(QRunnable):
+
+    def __init__(self, loader, key, data, width, height):
+        super().__init__()
+
+        self.loader = loader
+        self.key = key
+        self.data = data
+        self.width = width
+        self.height = height
+
+    def run(self):
+        image = QImage()
+        if self.data:
+            image.loadFromData(self.data)
+
+        if not image.isNull():
+            if self.height:
+                if image.width() > self.width or image.height() > self.height:
+                    image = image.scaled(self.width, self.height,
+                                Qt.KeepAspectRatio, Qt.SmoothTransformation)
+            elif image.width() > self.width:
+                image = image.scaledToWidth(self.width, Qt.SmoothTransformation)
+
+        try:
+            self.loader.loaded.emit(self.key, image)
+        except RuntimeError:
+            # Loader was deleted together with its view
+            pass
+
+
+class _ImageRequest(QObject):
+    """Handle of image reading on image connection of collection"""
+    finished = pyqtSignal(object)
+
+    def __init__(self, loader, key, width, height):
+        super().__init__(loader)
+
+        self.loader = loader
+        self.key = key
+        self.width = width
+        self.height = height
+
+        self.finished.connect(self._read)
+
+    def _read(self, results):
+        data = None
+        if results and results[0]:
+            data = results[0][0][0]
+
+        # Only decoding and scaling are done in pool, so pool threads
+        # don't require DB connections
+        task = _ImageDecodeTask(self.loader, self.key, data,
+                                self.width, self.height)
+        QThreadPool.globalInstance().start(task)
+
+        self.deleteLater()
+
+
+class PixmapLoader(QObject):
+    """Decodes and scales images in background and keeps result in
+    QPixmapCache, so painting of delegates never waits for DB or decoder."""
+    loaded = pyqtSignal(str, QImage)
+    CacheLimit = 64 * 1024  # in KB
+
+    def __init__(self, view):
+        super().__init__(view)
+
+        self.view = view
+        self.fileName = None
+        self.pending = {}
+        # Keys of missing or not decoded images aren't requested again
+        self.failed = set()
+
+        if QPixmapCache.cacheLimit() < self.CacheLimit:
+            QPixmapCache.setCacheLimit(self.CacheLimit)
+
+        self.loaded.connect(self._loaded)
+
+    def pixmap(self, table, img_id, stamp, width, height=0):
+        """Returns cached pixmap or None when it isn't ready yet.
+        Zero height means scaling to width only."""
+        dpr = self.view.devicePixelRatioF()
+        key = "%s_%s_%s_%dx%d_%s" % (table, img_id, stamp, width, height, dpr)
+
+        pixmap = QPixmapCache.find(key)
+        if pixmap is not None:
+            return pixmap
+
+        collection = self.view.model().collection
+        if self.fileName != collection.getFileName():
+            # Requests to previous collection are cancelled with its service
+            self.fileName = collection.getFileName()
+            for request in self.pending.values():
+                request.deleteLater()
+            self.pending.clear()
+            self.failed.clear()
+
+        if key not in self.pending and key not in self.failed:
+            request = _ImageRequest(self, key,
+                                    int(width * dpr), int(height * dpr))
+            sql = "SELECT image FROM %s WHERE id=?" % table
+            collection.imageQueryService().submit(request, [(sql, (img_id,))])
+            self.pending[key] = request
+
+        return None
+
+    def _loaded(self, key, image):
+        self.pending.pop(key, None)
+
+        if image.isNull():
+            self.failed.add(key)
+        else:
+            pixmap = QPixmap.fromImage(image)
+            pixmap.setDevicePixelRatio(self.view.devicePixelRatioF())
+            QPixmapCache.insert(key, pixmap)
+
+            self.view.viewport().update()
+
+
 class IconDelegate(QStyledItemDelegate):
 
+    def __init__(self, parent):
+        super().__init__(parent)
+
+        self.loader = PixmapLoader(parent)
+
     def paint(self, painter, option, index):
         model = index.model().model
         orig_index = index.model().mapToSource(index)
         if orig_index.isValid():
             image_index = model.index(orig_index.row(), model.fields.image.id)
-            image_data = image_index.data()
+            image_id = model.dataDisplayRole(image_index)
+            stamp_index = model.index(orig_index.row(), model.fields.updatedat.id)
+            stamp = model.dataDisplayRole(stamp_index)
             title_index = model.index(orig_index.row(), model.fields.title.id)
             title = title_index.data()
 
@@ -1040,31 +1269,37 @@ class IconDelegate(QStyledItemDelegate):
             text_option.setWrapMode(QTextOption.WrapAtWordBoundaryOrAnywhere)
             painter.drawText(QRectF(text_rect), title, text_option)
 
-            image = QImage()
-            image.loadFromData(image_data)
-            if rect.width() - 1 < image.width():
-                scaledImage = image.scaledToWidth(rect.width() - 2,
-                                                  Qt.SmoothTransformation)
-            else:
-                scaledImage = image
-            pixmap = QPixmap.fromImage(scaledImage)
-            # Set rect at center of item
-            rect.translate((rect.width() - pixmap.width()) // 2,
-                           (rect.height() + 35 - pixmap.height()) // 2)
-            rect.setSize(pixmap.size())
-            painter.drawPixmap(rect, pixmap)
+            if not image_id:
+                return
+
+            pixmap = self.loader.pixmap('images', image_id, stamp,
+                                        rect.width() - 2)
+            if pixmap:
+                size = pixmap.deviceIndependentSize().toSize()
+                # Set rect at center of item
+                rect.translate((rect.width() - size.width()) // 2,
+                               (rect.height() + 35 - size.height()) // 2)
+                rect.setSize(size)
+                painter.drawPixmap(rect, pixmap)
 
 
 class CardDelegate(QStyledItemDelegate):
 
+    def __init__(self, parent):
+        super().__init__(parent)
+
+        self.loader = PixmapLoader(parent)
+
     def paint(self, painter, option, index):
         model = index.model().model
         orig_index = index.model().mapToSource(index)
         if orig_index.isValid():
             obverse_index = model.index(orig_index.row(), model.fields.obverseimg.id)
-            obverse_data = obverse_index.data()
+            obverse_id = model.dataDisplayRole(obverse_index)
             reverse_index = model.index(orig_index.row(), model.fields.reverseimg.id)
-            reverse_data = reverse_index.data()
+            reverse_id = model.dataDisplayRole(reverse_index)
+            stamp_index = model.index(orig_index.row(), model.fields.updatedat.id)
+            stamp = model.dataDisplayRole(stamp_index)
             title_index = model.index(orig_index.row(), model.fields.title.id)
             title = title_index.data()
 
@@ -1103,36 +1338,30 @@ class CardDelegate(QStyledItemDelegate):
             maxWidth = obverse_rect.width() - 4
             maxHeight = obverse_rect.height() - 4
 
-            image = QImage()
-            image.loadFromData(obverse_data)
-            if image.width() > maxWidth or image.height() > maxHeight:
-                scaledImage = image.scaled(maxWidth, maxHeight,
-                                Qt.KeepAspectRatio, Qt.SmoothTransformation)
-            else:
-                scaledImage = image
-            pixmap = QPixmap.fromImage(scaledImage)
-            # Set rect at center of item
-            obverse_rect.translate((obverse_rect.width() - pixmap.width()) // 2,
-                                   (obverse_rect.height() - pixmap.height()) // 2)
-            obverse_rect.setSize(pixmap.size())
-            painter.drawPixmap(obverse_rect, pixmap)
+            if obverse_id:
+                pixmap = self.loader.pixmap('photos', obverse_id, stamp,
+                                            maxWidth, maxHeight)
+                if pixmap:
+                    size = pixmap.deviceIndependentSize().toSize()
+                    # Set rect at center of item
+                    obverse_rect.translate((obverse_rect.width() - size.width()) // 2,
+                                           (obverse_rect.height() - size.height()) // 2)
+                    obverse_rect.setSize(size)
+                    painter.drawPixmap(obverse_rect, pixmap)
 
             reverse_rect = QRect(rect.x(), rect.y() + rect.height() // 2,
                                  rect.width(), rect.height() // 2)
 
-            image = QImage()
-            image.loadFromData(reverse_data)
-            if image.width() > maxWidth or image.height() > maxHeight:
-                scaledImage = image.scaled(maxWidth, maxHeight,
-                                Qt.KeepAspectRatio, Qt.SmoothTransformation)
-            else:
-                scaledImage = image
-            pixmap = QPixmap.fromImage(scaledImage)
-            # Set rect at center of item
-            reverse_rect.translate((reverse_rect.width() - pixmap.width()) // 2,
-                                   (reverse_rect.height() - pixmap.height()) // 2)
-            reverse_rect.setSize(pixmap.size())
-            painter.drawPixmap(reverse_rect, pixmap)
+            if reverse_id:
+                pixmap = self.loader.pixmap('photos', reverse_id, stamp,
+                                            maxWidth, maxHeight)
+                if pixmap:
+                    size = pixmap.deviceIndependentSize().toSize()
+                    # Set rect at center of item
+                    reverse_rect.translate((reverse_rect.width() - size.width()) // 2,
+                                           (reverse_rect.height() - size.height()) // 2)
+                    reverse_rect.setSize(size)
+                    painter.drawPixmap(reverse_rect, pixmap)
 
 
 class CardModel(QAbstractProxyModel):
@@ -1360,30 +1589,12 @@ class IconView(BaseTableView):
 
         self.model().moveRows(index1.row(), index2.row())
 
-    def search(self, text):
-        self.searchText = text
-        model = self.model()
-
+    def searchFilter(self, text):
         if text:
-            val = "'%%%s%%'" % text.replace("'", "''")
-            values = []
-            val_lower = val.lower()
-            values.append(val_lower)
-            val_upper = val.upper()
-            if val_lower != val_upper:
-                values.append(val_upper)
-                values.append(val.title())
-            if val not in values:
-                values.append(val)
-
             parts = ('title',)
-            sql = []
-            for part in parts:
-                for val in values:
-                    sql.append("%s LIKE %s" % (part, val))
-            model.setSearchFilter('(' + ' OR '.join(sql) + ')')
+            return self._searchFilter(text, parts)
         else:
-            model.setSearchFilter('')
+            return ''
 
 
 class CardView(IconView):
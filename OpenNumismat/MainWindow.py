@@ -792,7 +792,7 @@ class MainWindow(QMainWindow):
 
     def quickSearchClicked(self):
         listView = self.viewTab.currentListView()
-        listView.search(self.quickSearch.text())
+        listView.scheduleSearch(self.quickSearch.text())
 
     def viewBrowserEvent(self):
         template = self.sender().data()
@@ -856,7 +856,11 @@ class MainWindow(QMainWindow):
                 self.tr("Open collection"), self.__workingDir(),
                 self.tr("Collections (*.db)"))
         if fileName:
-            self.collection.merge(fileName)
+            if self.collection.merge(fileName):
+                # Refresh all lists with merged coins
+                for i in range(self.viewTab.count()):
+                    pageView = self.viewTab.widget(i)
+                    pageView.model().select()
 
     def openCollection(self, fileName):
         self.__closeCollection()
@@ -921,6 +925,8 @@ class MainWindow(QMainWindow):
     def __shutDown(self):
         self.__saveParams()
 
+        self.collection.closeQueryService()
+
         settings = QSettings()
 
         # Save main window size
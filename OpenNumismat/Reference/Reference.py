@@ -253,13 +253,69 @@ class BaseReferenceSection(QObject):
         self.sort = sort
         self.parent_name = None
 
+        self._icons = None
+        self._positions = None
+
     def reload(self):
         self.beforeReload.emit()
+        self.invalidateCache()
         self.getSort()
         self.setSort()
         self.model.select()
         self.afterReload.emit()
 
+    def _connectModel(self):
+        # Any edit of section (also from AllReferenceDialog) invalidates
+        # cached icons and positions
+        self.model.modelReset.connect(self.invalidateCache)
+        self.model.dataChanged.connect(self.invalidateCache)
+        self.model.rowsInserted.connect(self.invalidateCache)
+        self.model.rowsRemoved.connect(self.invalidateCache)
+
+    def invalidateCache(self):
+        self._icons = None
+        self._positions = None
+
+    def icons(self):
+        if self._icons is None:
+            self._icons = {}
+
+            query = QSqlQuery(self.db)
+            query.prepare(f"SELECT value, icon FROM {self.table_name}"
+                          " WHERE icon IS NOT NULL ORDER BY id")
+            query.exec()
+            while query.next():
+                record = query.record()
+                value = str(record.value(0))
+                # Keep first one for same values in cross references
+                if value in self._icons:
+                    continue
+
+                data = record.value(1)
+                if data:
+                    pixmap = QPixmap()
+                    if pixmap.loadFromData(data):
+                        self._icons[value] = QIcon(pixmap)
+
+        return self._icons
+
+    def positions(self):
+        if self._positions is None:
+            self._positions = {}
+
+            query = QSqlQuery(self.db)
+            query.prepare(f"SELECT value, position FROM {self.table_name}"
+                          " ORDER BY id")
+            query.exec()
+            while query.next():
+                record = query.record()
+                value = str(record.value(0))
+                position = record.value(1)
+                if value not in self._positions and isinstance(position, int):
+                    self._positions[value] = position
+
+        return self._positions
+
     def setSort(self):
         self.model.sort(self.sort)
 
@@ -348,6 +404,7 @@ class ReferenceSection(BaseReferenceSection):
         self.model = SqlTableModel(None, db)
         self.model.setEditStrategy(QSqlTableModel.OnFieldChange)
         self.model.setTable(self.table_name)
+        self._connectModel()
 
         self.reload()
 
@@ -404,6 +461,7 @@ class CrossReferenceSection(BaseReferenceSection):
         self.model.parentidIndex = parentidIndex
         self.model.setRelation(
             parentidIndex, QSqlRelation(self.parent_table_name, 'id', 'value'))
+        self._connectModel()
 
         self.reload()
 
@@ -604,14 +662,11 @@ class Reference(QObject):
         for section in self.sections:
             section.load(self.db)
 
-        self.sections_with_icons = []
+        # Preload icons and positions - they are requested for each row
+        # of list and tree
         for section in self.sections:
-            name = section.table_name
-            sql = f"SELECT 1 FROM {name} WHERE icon IS NOT NULL LIMIT 1"
-            query = QSqlQuery(sql, self.db)
-            query.exec()
-            if query.first():
-                self.sections_with_icons.append(name)
+            section.icons()
+            section.positions()
 
     def section(self, name):
         # NOTE: payplace and saleplace fields has one reference section =>
@@ -648,48 +703,16 @@ class Reference(QObject):
         return sectionNames
 
     def getIcon(self, section, value):
-        if section in ('payplace', 'saleplace'):
-            section = 'place'
-        elif section in ('obversecolor', 'reversecolor'):
-            section = 'color'
-        elif section in ('edge', 'signaturetype'):
-            section = 'edge'
-        elif section in ('material', 'material2'):
-            section = 'material'
-
-        table_name = f"ref_{section}"
-        if table_name in self.sections_with_icons:
-            sql = f"SELECT icon FROM {table_name} WHERE value=?"
-            query = QSqlQuery(sql, self.db)
-            query.addBindValue(value)
-            query.exec()
-            if query.first():
-                data = query.record().value(0)
-                if data:
-                    pixmap = QPixmap()
-                    if pixmap.loadFromData(data):
-                        icon = QIcon(pixmap)
-                        return icon
+        ref_section = self.section(section)
+        if ref_section:
+            return ref_section.icons().get(str(value))
+
         return None
 
     def getPosition(self, section, value):
-        if section in ('payplace', 'saleplace'):
-            section = 'place'
-        elif section in ('obversecolor', 'reversecolor'):
-            section = 'color'
-        elif section in ('edge', 'signaturetype'):
-            section = 'edge'
-        elif section in ('material', 'material2'):
-            section = 'material'
-
-        sql = f"SELECT position FROM ref_{section} WHERE value=?"
-        query = QSqlQuery(sql, self.db)
-        query.addBindValue(value)
-        query.exec()
-        if query.first():
-            data = query.record().value(0)
-            if isinstance(data, int):
-                return data
+        ref_section = self.section(section)
+        if ref_section:
+            return ref_section.positions().get(str(value), sys.maxsize)
 
         return sys.maxsize
 
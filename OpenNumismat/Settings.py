@@ -98,6 +98,7 @@ class Settings(BaseSettings):
         'backup': OpenNumismat.HOME_PATH + "/backup/",
         'autobackup': True,
         'autobackup_depth': 25,
+        'backup_compress': False,
         'reference': OpenNumismat.HOME_PATH + "/reference.ref",
         'error': True,
         'speedup': 1,
@@ -125,6 +126,7 @@ class Settings(BaseSettings):
         'use_webcam': True,
         'UUID': _getUuid().replace('-', ''),
         'tree_counter': False,
+        'lazy_list': False,
         'color_scheme': Qt.ColorScheme.Unknown.value,
     }
 
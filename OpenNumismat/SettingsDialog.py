@@ -125,6 +125,10 @@ class MainSettingsPage(QWidget):
                       self.autobackupDepth)
         self.autobackupDepth.setEnabled(settings['autobackup'])
 
+        self.backupCompress = QCheckBox(self.tr("Compress backups"), self)
+        self.backupCompress.setChecked(settings['backup_compress'])
+        layout.addRow(self.backupCompress)
+
         self.errorSending = QCheckBox(
                             self.tr("Send error info to author"), self)
         self.errorSending.setChecked(settings['error'])
@@ -160,6 +164,11 @@ class MainSettingsPage(QWidget):
         self.treeCounter.setChecked(settings['tree_counter'])
         layout.addRow(self.treeCounter)
 
+        self.lazyList = QCheckBox(
+                        self.tr("Load list on demand (for big collections)"), self)
+        self.lazyList.setChecked(settings['lazy_list'])
+        layout.addRow(self.lazyList)
+
         self.builtInViewer = QCheckBox(
                         self.tr("Use built-in image viewer"), self)
         self.builtInViewer.setChecked(settings['built_in_viewer'])
@@ -283,6 +292,7 @@ class MainSettingsPage(QWidget):
         settings['backup'] = self.backupFolder.text()
         settings['autobackup'] = self.autobackup.isChecked()
         settings['autobackup_depth'] = self.autobackupDepth.value()
+        settings['backup_compress'] = self.backupCompress.isChecked()
         settings['reference'] = self.reference.text()
         settings['error'] = self.errorSending.isChecked()
         settings['updates'] = self.checkUpdates.isChecked()
@@ -296,6 +306,7 @@ class MainSettingsPage(QWidget):
         settings['transparent_color'] = self.transparent_color
         settings['transparent_store'] = self.transparentRadio.isChecked()
         settings['tree_counter'] = self.treeCounter.isChecked()
+        settings['lazy_list'] = self.lazyList.isChecked()
         settings['color_scheme'] = self.colorSchemeSelector.currentIndex()
 
         settings.save()
@@ -1,4 +1,5 @@
 import math
+from collections import OrderedDict
 from functools import cmp_to_key
 
 from PySide6.QtCharts import (
@@ -53,6 +54,7 @@ from PySide6.QtWebEngineWidgets import QWebEngineView as QWebView
 import OpenNumismat
 from OpenNumismat.Collection.CollectionFields import Statuses
 from OpenNumismat.Collection.CollectionFields import StatisticsFields
+from OpenNumismat.Collection.QueryService import AsyncQuery
 from OpenNumismat.Tools.Gui import getSaveFileName
 from OpenNumismat.Tools.Converters import numberWithFraction
 from OpenNumismat.Tools.misc import saveImageFilters
@@ -913,9 +915,14 @@ class AreaNiceChart(BaseChart):
 
 
 class StatisticsView(QWidget):
+    CACHE_SIZE = 64
+
     def __init__(self, statisticsParam, parent=None):
         super().__init__(parent)
 
+        self._cache = OrderedDict()
+        self._cacheGeneration = None
+
         locale = Settings()['locale']
         self.collator = QCollator(QLocale(locale))
         self.collator.setNumericMode(True)
@@ -1025,6 +1032,9 @@ class StatisticsView(QWidget):
     def setModel(self, model):
         self.model = model
 
+        self.asyncQuery = AsyncQuery(model.collection, self)
+        self.asyncQuery.finished.connect(self.queriesFinished)
+
         default_subfieldid = 0
         for field in self.model.fields.userFields:
             if field.name in StatisticsFields:
@@ -1097,6 +1107,18 @@ class StatisticsView(QWidget):
         self.regionSelector.currentIndexChanged.connect(self.regionChanged)
 
     def modelChanged(self):
+        queries = [query for query in map(self._boundQuery, self.chartQueries())
+                   if not self.isCached(query)]
+        if queries:
+            self._requestGeneration = self._generation()
+            self._requestedQueries = queries
+            self.asyncQuery.exec(queries)
+
+            self.showPlaceholder()
+            return
+
+        self.asyncQuery.cancel()
+
         chart = self.chartSelector.currentData()
         if chart == 'geochart':
             self.chart = self.geoChart()
@@ -1122,6 +1144,40 @@ class StatisticsView(QWidget):
 
         self.resizeEvent(None)
 
+    def queriesFinished(self, results):
+        # Results of changed data are dropped and requested again
+        if self._requestGeneration == self._generation():
+            for query, rows in zip(self._requestedQueries, results):
+                self.storeCache(query, rows)
+
+        self.modelChanged()
+
+    def showPlaceholder(self):
+        label = QLabel(self.tr("Loading..."), self)
+        label.setAlignment(Qt.AlignCenter)
+
+        self.chart = label
+        self.scroll.setWidget(self.chart)
+
+        self.resizeEvent(None)
+
+    def chartQueries(self):
+        chart = self.chartSelector.currentData()
+        if chart == 'geochart':
+            return [self.geoSql()]
+        elif chart == 'stacked':
+            return [self.stackedSql()]
+        elif chart == 'progress':
+            return [self.progressSql()]
+        elif chart == 'area':
+            area = self.areaSelector.currentData()
+            if area == 'status':
+                return self.areaStatusSql()
+            else:
+                return [self.areaSql()]
+        else:
+            return [self.barSql()]
+
     def fieldChaged(self, _text):
         fieldId = self.fieldSelector.currentData()
         self.statisticsParam['fieldid'] = fieldId
@@ -1187,35 +1243,90 @@ class StatisticsView(QWidget):
 
         self.modelChanged()
     
-    def fillBarChart(self, chart):
-        fieldId = self.fieldSelector.currentData()
-        field = self.model.fields.field(fieldId).name
+    def _generation(self):
+        # Current date is a part of generation for queries relative to now
+        return (self.model.dataGeneration(), QDate.currentDate())
+
+    def _validateCache(self):
+        generation = self._generation()
+        if generation != self._cacheGeneration:
+            self._cache.clear()
+            self._cacheGeneration = generation
+
+    def isCached(self, query):
+        self._validateCache()
+        return query in self._cache
+
+    def storeCache(self, query, rows):
+        self._validateCache()
+
+        self._cache[query] = rows
+        if len(self._cache) > self.CACHE_SIZE:
+            self._cache.popitem(last=False)
+
+    def _boundQuery(self, sql):
+        # Every chart query contains model filter once
+        return (sql, self.model.filterParams())
+
+    def aggregate(self, sql):
+        # Query text contains chart kind, fields, period, items and filter,
+        # and together with filter values results are reused until
+        # collection data changed
+        key = self._boundQuery(sql)
+        if self.isCached(key):
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        query = QSqlQuery(self.model.database())
+        query.prepare(sql)
+        for param in key[1]:
+            query.addBindValue(param)
+        query.exec()
+        rows = []
+        while query.next():
+            record = query.record()
+            rows.append(tuple(record.value(i) for i in range(record.count())))
+
+        self.storeCache(key, rows)
+
+        return rows
+
+    def _sqlField(self, field):
         if field == 'fineness':
-            sql_field = "IFNULL(material,''),IFNULL(fineness,'')"
+            return "IFNULL(material,''),IFNULL(fineness,'')"
         elif field == 'unit':
-            sql_field = "IFNULL(value,''),IFNULL(unit,'')"
+            return "IFNULL(value,''),IFNULL(unit,'')"
         else:
-            sql_field = "IFNULL(%s,'')" % field
+            return "IFNULL(%s,'')" % field
 
+    def _sqlFilter(self):
         filter_ = self.model.filter()
         if filter_:
-            sql_filter = "WHERE %s" % filter_
+            return "WHERE %s" % filter_
         else:
-            sql_filter = ""
-        
-        sql = "SELECT sum(iif(quantity!='',quantity,1)), %s FROM coins %s GROUP BY %s" % (
+            return ""
+
+    def barSql(self):
+        fieldId = self.fieldSelector.currentData()
+        field = self.model.fields.field(fieldId).name
+        sql_field = self._sqlField(field)
+        sql_filter = self._sqlFilter()
+
+        return "SELECT sum(iif(quantity!='',quantity,1)), %s FROM coins %s GROUP BY %s" % (
             sql_field, sql_filter, sql_field)
-        query = QSqlQuery(self.model.database())
-        query.exec(sql)
+
+    def fillBarChart(self, chart):
+        fieldId = self.fieldSelector.currentData()
+        field = self.model.fields.field(fieldId).name
+
         zz = {}
-        while query.next():
-            record = query.record()
-            count = record.value(0)
-            val = str(record.value(1))
+        for record in self.aggregate(self.barSql()):
+            count = record[0]
+            val = str(record[1])
             if field == 'unit':
-                val = numberWithFraction(val)[0] + ' ' + str(record.value(2))
+                val = numberWithFraction(val)[0] + ' ' + str(record[2])
             elif field == 'fineness':
-                val += ' ' + str(record.value(2))
+                val += ' ' + str(record[2])
             zz[val] = count
 
         if field == 'status':
@@ -1248,44 +1359,38 @@ class StatisticsView(QWidget):
         self.fillBarChart(chart)
         return chart
 
-    def stackedChart(self):
+    def stackedSql(self):
         fieldId = self.fieldSelector.currentData()
         field = self.model.fields.field(fieldId).name
-        if field == 'fineness':
-            sql_field = "IFNULL(material,''),IFNULL(fineness,'')"
-        elif field == 'unit':
-            sql_field = "IFNULL(value,''),IFNULL(unit,'')"
-        else:
-            sql_field = "IFNULL(%s,'')" % field
+        sql_field = self._sqlField(field)
+        sql_filter = self._sqlFilter()
 
-        filter_ = self.model.filter()
-        if filter_:
-            sql_filter = "WHERE %s" % filter_
-        else:
-            sql_filter = ""
-        
         subfieldId = self.subfieldSelector.currentData()
         subfield = self.model.fields.field(subfieldId).name
-        sql = "SELECT count(IFNULL(%s,'')), IFNULL(%s,''), %s FROM coins"\
-              " %s GROUP BY %s, IFNULL(%s,'')" % (
+        return "SELECT count(IFNULL(%s,'')), IFNULL(%s,''), %s FROM coins"\
+               " %s GROUP BY %s, IFNULL(%s,'')" % (
                         subfield, subfield, sql_field, sql_filter, sql_field, subfield)
-        query = QSqlQuery(self.model.database())
-        query.exec(sql)
+
+    def stackedChart(self):
+        fieldId = self.fieldSelector.currentData()
+        field = self.model.fields.field(fieldId).name
+        subfieldId = self.subfieldSelector.currentData()
+        subfield = self.model.fields.field(subfieldId).name
+
         xx = []
         yy = []
         zz = []
         vv = {}
-        while query.next():
-            record = query.record()
-            count = record.value(0)
-            val = str(record.value(2))
+        for record in self.aggregate(self.stackedSql()):
+            count = record[0]
+            val = str(record[2])
             if field == 'status':
                 val = Statuses[val]
             elif field == 'unit':
-                val = numberWithFraction(val)[0] + ' ' + str(record.value(3))
+                val = numberWithFraction(val)[0] + ' ' + str(record[3])
             elif field == 'fineness':
-                val += ' ' + str(record.value(3))
-            subval = str(record.value(1))
+                val += ' ' + str(record[3])
+            subval = str(record[1])
             if subfield == 'status':
                 subval = Statuses[subval]
 
@@ -1328,19 +1433,14 @@ class StatisticsView(QWidget):
         
         return chart
 
-    def progressChart(self):
-        chart = ProgressChart(self)
-
+    def progressSql(self):
         items = self.itemsSelector.currentData()
         if items == 'payprice':
             sql_field = 'sum(payprice)'
-            chart.setLabel(self.tr("Total price"))
         elif items == 'totalpayprice':
             sql_field = 'sum(totalpayprice)'
-            chart.setLabel(self.tr("Total paid"))
         else:
             sql_field = "sum(iif(quantity!='',quantity,1))"
-            chart.setLabel(self.tr("Quantity"))
 
         period = self.periodSelector.currentData()
         if items == 'createdat':
@@ -1409,13 +1509,26 @@ class StatisticsView(QWidget):
                   " GROUP BY strftime('%s', paydate) ORDER BY paydate" % (
                       sql_field, date_format, ' AND '.join(sql_filters),
                       date_format)
-        query = QSqlQuery(self.model.database())
-        query.exec(sql)
+
+        return sql
+
+    def progressChart(self):
+        chart = ProgressChart(self)
+
+        items = self.itemsSelector.currentData()
+        if items == 'payprice':
+            chart.setLabel(self.tr("Total price"))
+        elif items == 'totalpayprice':
+            chart.setLabel(self.tr("Total paid"))
+        else:
+            chart.setLabel(self.tr("Quantity"))
+
+        period = self.periodSelector.currentData()
+
         xx = {}
-        while query.next():
-            record = query.record()
-            count = record.value(0) or 0
-            val = str(record.value(1))
+        for record in self.aggregate(self.progressSql()):
+            count = record[0] or 0
+            val = str(record[1])
             xx[val] = count
 
         if period == 'year':
@@ -1438,16 +1551,11 @@ class StatisticsView(QWidget):
 
         return chart
 
-    def areaChart(self):
+    def areaSql(self):
         nice_years = Settings()['nice_years_chart']
         fieldId = self.fieldSelector.currentData()
         field = self.model.fields.field(fieldId).name
-        if field == 'fineness':
-            sql_field = "IFNULL(material,''),IFNULL(fineness,'')"
-        elif field == 'unit':
-            sql_field = "IFNULL(value,''),IFNULL(unit,'')"
-        else:
-            sql_field = "IFNULL(%s,'')" % field
+        sql_field = self._sqlField(field)
 
         area = self.areaSelector.currentData()
         if area == 'paydate':
@@ -1474,22 +1582,27 @@ class StatisticsView(QWidget):
                     date_field, sql_field,
                     ' AND '.join(sql_filters),
                     date_field, sql_field)
-        query = QSqlQuery(self.model.database())
-        query.exec(sql)
+
+        return sql
+
+    def areaChart(self):
+        nice_years = Settings()['nice_years_chart']
+        fieldId = self.fieldSelector.currentData()
+        field = self.model.fields.field(fieldId).name
+
         xx = {}
         zz = []
-        while query.next():
-            record = query.record()
-            count = record.value(0)
-            year = str(record.value(1))
-            val = str(record.value(2))
+        for record in self.aggregate(self.areaSql()):
+            count = record[0]
+            year = str(record[1])
+            val = str(record[2])
 
             if field == 'status':
                 val = Statuses[val]
             elif field == 'unit':
-                val = numberWithFraction(val)[0] + ' ' + str(record.value(3))
+                val = numberWithFraction(val)[0] + ' ' + str(record[3])
             elif field == 'fineness':
-                val += ' ' + str(record.value(3))
+                val += ' ' + str(record[3])
 
             if val not in zz:
                 zz.append(val)
@@ -1529,31 +1642,20 @@ class StatisticsView(QWidget):
 
         return chart
 
-    def areaStatusChart(self):
+    def areaStatusSql(self):
         nice_years = Settings()['nice_years_chart']
 
         filter_ = self.model.filter()
-        if filter_:
-            sql_filter = "WHERE %s" % filter_
-        else:
-            sql_filter = ""
+        sql_filter = self._sqlFilter()
 
         if nice_years:
             date_field = "strftime('%Y-%m', createdat)"
         else:
             date_field = "strftime('%Y', createdat)"
 
-        sql = "SELECT sum(iif(quantity!='',quantity,1)), %s FROM coins"\
-              " %s"\
-              " GROUP BY %s" % (date_field, sql_filter, date_field)
-        query = QSqlQuery(self.model.database())
-        query.exec(sql)
-        xx = {}
-        while query.next():
-            record = query.record()
-            count = record.value(0)
-            val = str(record.value(1))
-            xx[val] = [count, 0, 0]
+        created_sql = "SELECT sum(iif(quantity!='',quantity,1)), %s FROM coins"\
+                      " %s"\
+                      " GROUP BY %s" % (date_field, sql_filter, date_field)
 
         sql_filters = ["status IN ('owned', 'ordered', 'sale', 'sold', 'missing', 'duplicate', 'replacement')"]
         if filter_:
@@ -1564,19 +1666,9 @@ class StatisticsView(QWidget):
         else:
             date_field = "strftime('%Y', paydate)"
 
-        sql = "SELECT sum(iif(quantity!='',quantity,1)), %s FROM coins"\
-              " WHERE %s"\
-              " GROUP BY %s" % (date_field, ' AND '.join(sql_filters), date_field)
-        query = QSqlQuery(self.model.database())
-        query.exec(sql)
-        while query.next():
-            record = query.record()
-            count = record.value(0)
-            val = str(record.value(1))
-            if val in xx:
-                xx[val][1] = count
-            else:
-                xx[val] = [0, count, 0]
+        paid_sql = "SELECT sum(iif(quantity!='',quantity,1)), %s FROM coins"\
+                   " WHERE %s"\
+                   " GROUP BY %s" % (date_field, ' AND '.join(sql_filters), date_field)
 
         sql_filters = ["status='sold'"]
         if filter_:
@@ -1587,15 +1679,33 @@ class StatisticsView(QWidget):
         else:
             date_field = "strftime('%Y', saledate)"
 
-        sql = "SELECT sum(iif(quantity!='',quantity,1)), %s FROM coins"\
-              " WHERE %s"\
-              " GROUP BY %s" % (date_field, ' AND '.join(sql_filters), date_field)
-        query = QSqlQuery(self.model.database())
-        query.exec(sql)
-        while query.next():
-            record = query.record()
-            count = record.value(0)
-            val = str(record.value(1))
+        sold_sql = "SELECT sum(iif(quantity!='',quantity,1)), %s FROM coins"\
+                   " WHERE %s"\
+                   " GROUP BY %s" % (date_field, ' AND '.join(sql_filters), date_field)
+
+        return [created_sql, paid_sql, sold_sql]
+
+    def areaStatusChart(self):
+        nice_years = Settings()['nice_years_chart']
+        created_sql, paid_sql, sold_sql = self.areaStatusSql()
+
+        xx = {}
+        for record in self.aggregate(created_sql):
+            count = record[0]
+            val = str(record[1])
+            xx[val] = [count, 0, 0]
+
+        for record in self.aggregate(paid_sql):
+            count = record[0]
+            val = str(record[1])
+            if val in xx:
+                xx[val][1] = count
+            else:
+                xx[val] = [0, count, 0]
+
+        for record in self.aggregate(sold_sql):
+            count = record[0]
+            val = str(record[1])
             if val in xx:
                 xx[val][2] = count
             else:
@@ -1619,22 +1729,17 @@ class StatisticsView(QWidget):
 
         return chart
 
-    def geoChart(self):
-        filter_ = self.model.filter()
-        if filter_:
-            sql_filter = "WHERE %s" % filter_
-        else:
-            sql_filter = ""
+    def geoSql(self):
+        sql_filter = self._sqlFilter()
 
-        sql = "SELECT sum(iif(quantity!='',quantity,1)), IFNULL(country,'') FROM coins %s GROUP BY IFNULL(country,'')" % sql_filter
-        query = QSqlQuery(self.model.database())
-        query.exec(sql)
+        return "SELECT sum(iif(quantity!='',quantity,1)), IFNULL(country,'') FROM coins %s GROUP BY IFNULL(country,'')" % sql_filter
+
+    def geoChart(self):
         xx = []
         yy = []
-        while query.next():
-            record = query.record()
-            count = record.value(0)
-            val = str(record.value(1))
+        for record in self.aggregate(self.geoSql()):
+            count = record[0]
+            val = str(record[1])
             xx.append(val)
             yy.append(count)
 
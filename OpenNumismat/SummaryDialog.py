@@ -1,9 +1,9 @@
 # -*- coding: utf-8 -*-
 
 from PySide6.QtCore import Qt, QDate, QLocale
-from PySide6.QtSql import QSqlQuery
 from PySide6.QtWidgets import QDialog, QTextEdit, QVBoxLayout, QDialogButtonBox
 
+from OpenNumismat.Collection.QueryService import AsyncQuery
 from OpenNumismat.Tools.DialogDecorators import storeDlgSizeDecorator
 from OpenNumismat.Tools.Converters import stringToMoney
 
@@ -23,6 +23,7 @@ class SummaryDialog(QDialog):
 
         self.textBox = QTextEdit(self)
         self.textBox.setReadOnly(True)
+        self.textBox.setText(self.tr("Calculating..."))
 
         layout = QVBoxLayout()
         layout.addWidget(self.textBox)
@@ -30,8 +31,24 @@ class SummaryDialog(QDialog):
 
         self.setLayout(layout)
 
-        lines_all = self.fillSummary(model)
-        lines_selected = self.fillSummary(model, model.filter())
+        # All queries are made in background, so dialog is shown at once
+        self.queries_all = self.summaryQueries()
+        self.queries_selected = self.summaryQueries(model.filter())
+
+        self.asyncQuery = AsyncQuery(model.collection, self)
+        self.asyncQuery.finished.connect(self.summaryLoaded)
+        self.finished.connect(self.asyncQuery.cancel)
+        params = model.filterParams()
+        self.asyncQuery.exec(list(self.queries_all.values()) +
+                             [(sql, params) for sql in self.queries_selected.values()])
+
+    def summaryLoaded(self, results):
+        results_all = dict(zip(self.queries_all, results))
+        results_selected = dict(zip(self.queries_selected,
+                                    results[len(self.queries_all):]))
+
+        lines_all = self.fillSummary(results_all)
+        lines_selected = self.fillSummary(results_selected)
 
         lines = [self.tr("[Selected]")] + lines_selected + ["", self.tr("[All]")] + lines_all
         self.textBox.setText('\n'.join(lines))
@@ -45,24 +62,50 @@ class SummaryDialog(QDialog):
 
         return sql
 
-    def fillSummary(self, model, filter_=None):
+    def summaryQueries(self, filter_=None):
+        queries = {}
+
+        queries['total'] = "SELECT count(*) FROM coins"
+        queries['owned'] = "SELECT quantity FROM coins WHERE status IN ('owned', 'ordered', 'sale', 'duplicate', 'replacement')"
+
+        gold = self.materialFilter("Gold", self.tr("Gold"), "Au")
+        queries['gold_count'] = self.materialCountSql(gold)
+        queries['gold_weight'] = self.materialWeightSql(gold)
+        silver = self.materialFilter("Silver", self.tr("Silver"), "Ag")
+        queries['silver_count'] = self.materialCountSql(silver)
+        queries['silver_weight'] = self.materialWeightSql(silver)
+
+        queries['wish'] = "SELECT count(*) FROM coins WHERE status='wish'"
+        queries['sold'] = "SELECT count(*) FROM coins WHERE status='sold'"
+        queries['bidding'] = "SELECT count(*) FROM coins WHERE status='bidding'"
+        queries['missing'] = "SELECT count(*) FROM coins WHERE status='missing'"
+        queries['paid'] = "SELECT SUM(totalpayprice) FROM coins WHERE status IN ('owned', 'ordered', 'sale', 'sold', 'missing', 'duplicate', 'replacement') AND totalpayprice<>'' AND totalpayprice IS NOT NULL"
+        queries['paid_without_commission'] = "SELECT SUM(payprice) FROM coins WHERE status IN ('owned', 'ordered', 'sale', 'sold', 'missing', 'duplicate', 'replacement') AND payprice<>'' AND payprice IS NOT NULL"
+        queries['earned'] = "SELECT SUM(totalsaleprice) FROM coins WHERE status='sold' AND totalsaleprice<>'' AND totalsaleprice IS NOT NULL"
+        queries['earn_without_commission'] = "SELECT SUM(saleprice) FROM coins WHERE status='sold' AND saleprice<>'' AND saleprice IS NOT NULL"
+        queries['first_purchase'] = "SELECT paydate FROM coins WHERE status IN ('owned', 'ordered', 'sale', 'sold', 'missing', 'duplicate', 'replacement') AND paydate<>'' AND paydate IS NOT NULL ORDER BY paydate LIMIT 1"
+        queries['est_owned'] = "SELECT UPPER(grade), price1, price2, price3, price4, quantity FROM coins WHERE status IN ('owned', 'ordered', 'sale', 'duplicate', 'replacement') AND (ifnull(price1,'')<>'' OR ifnull(price2,'')<>'' OR ifnull(price3,'')<>'' OR ifnull(price4,'')<>'')"
+        queries['est_wish'] = "SELECT price1, price2, price3, price4 FROM coins WHERE status='wish' AND (ifnull(price1,'')<>'' OR ifnull(price2,'')<>'' OR ifnull(price3,'')<>'' OR ifnull(price4,'')<>'')"
+        queries['images'] = "SELECT count(*) FROM photos"
+
+        for key, sql in queries.items():
+            queries[key] = self.makeSql(sql, filter_)
+
+        return queries
+
+    def fillSummary(self, results):
         lines = []
         locale = QLocale.system()
 
-        sql = "SELECT count(*) FROM coins"
-        sql = self.makeSql(sql, filter_)
-        query = QSqlQuery(sql, model.database())
-        if query.first():
-            totalCount = query.record().value(0)
+        rows = results['total']
+        if rows:
+            totalCount = rows[0][0]
             lines.append(self.tr("Total count: %d") % totalCount)
 
         count_owned = 0
         quantity_owned = 0
-        sql = "SELECT quantity FROM coins WHERE status IN ('owned', 'ordered', 'sale', 'duplicate', 'replacement')"
-        sql = self.makeSql(sql, filter_)
-        query = QSqlQuery(sql, model.database())
-        while query.next():
-            quantity = query.record().value('quantity')
+        for record in results['owned']:
+            quantity = record[0]
             if not isinstance(quantity, int):
                 quantity = 1
             quantity_owned += quantity
@@ -72,8 +115,7 @@ class SummaryDialog(QDialog):
         else:
             lines.append(self.tr("Count owned: %d/%d") % (quantity_owned, count_owned))
 
-        count_gold, quantity_gold = self.materialCount(
-                ("Gold", self.tr("Gold"), "Au"), model, filter_)
+        count_gold, quantity_gold = self.materialCount(results['gold_count'])
         if count_gold:
             if count_gold == quantity_gold:
                 lines.append(self.tr("Gold coins: %d") % count_gold)
@@ -81,7 +123,7 @@ class SummaryDialog(QDialog):
                 lines.append(self.tr("Gold coins: %d/%d") % (quantity_gold, count_gold))
 
             gold_weight, gold_count, gold_quantity = self.materialWeight(
-                ("Gold", self.tr("Gold"), "Au"), model, filter_)
+                results['gold_weight'])
             if gold_weight:
                 if gold_count == gold_quantity:
                     comment = self.tr("(calculated for %d coins)") % gold_quantity
@@ -90,8 +132,7 @@ class SummaryDialog(QDialog):
                 gold_weight_str = locale.toString(float(gold_weight), 'f', precision=2)
                 lines.append(' '.join((self.tr("Gold weight: %s gramm") % gold_weight_str, comment)))
 
-        count_silver, quantity_silver = self.materialCount(
-                ("Silver", self.tr("Silver"), "Ag"), model, filter_)
+        count_silver, quantity_silver = self.materialCount(results['silver_count'])
         if count_silver:
             if count_silver == quantity_silver:
                 lines.append(self.tr("Silver coins: %d") % count_silver)
@@ -99,7 +140,7 @@ class SummaryDialog(QDialog):
                 lines.append(self.tr("Silver coins: %d/%d") % (quantity_silver, count_silver))
 
             silver_weight, silver_count, silver_quantity = self.materialWeight(
-                ("Silver", self.tr("Silver"), "Ag"), model, filter_)
+                results['silver_weight'])
             if silver_weight:
                 if silver_count == silver_quantity:
                     comment = self.tr("(calculated for %d coins)") % silver_quantity
@@ -108,51 +149,39 @@ class SummaryDialog(QDialog):
                 silver_weight_str = locale.toString(float(silver_weight), 'f', precision=2)
                 lines.append(' '.join((self.tr("Silver weight: %s gramm") % silver_weight_str, comment)))
 
-        sql = "SELECT count(*) FROM coins WHERE status='wish'"
-        sql = self.makeSql(sql, filter_)
-        query = QSqlQuery(sql, model.database())
-        if query.first():
-            count = query.record().value(0)
+        rows = results['wish']
+        if rows:
+            count = rows[0][0]
             lines.append(self.tr("Count wish: %d") % count)
 
         count_sold = 0
-        sql = "SELECT count(*) FROM coins WHERE status='sold'"
-        sql = self.makeSql(sql, filter_)
-        query = QSqlQuery(sql, model.database())
-        if query.first():
-            count_sold = query.record().value(0)
+        rows = results['sold']
+        if rows:
+            count_sold = rows[0][0]
             if count_sold > 0:
                 lines.append(self.tr("Count sales: %d") % count_sold)
 
-        sql = "SELECT count(*) FROM coins WHERE status='bidding'"
-        sql = self.makeSql(sql, filter_)
-        query = QSqlQuery(sql, model.database())
-        if query.first():
-            count = query.record().value(0)
+        rows = results['bidding']
+        if rows:
+            count = rows[0][0]
             if count > 0:
                 lines.append(self.tr("Count biddings: %d") % count)
 
-        sql = "SELECT count(*) FROM coins WHERE status='missing'"
-        sql = self.makeSql(sql, filter_)
-        query = QSqlQuery(sql, model.database())
-        if query.first():
-            count = query.record().value(0)
+        rows = results['missing']
+        if rows:
+            count = rows[0][0]
             if count > 0:
                 lines.append(self.tr("Count missing: %d") % count)
 
         paid = 0
         commission = ""
-        sql = "SELECT SUM(totalpayprice) FROM coins WHERE status IN ('owned', 'ordered', 'sale', 'sold', 'missing', 'duplicate', 'replacement') AND totalpayprice<>'' AND totalpayprice IS NOT NULL"
-        sql = self.makeSql(sql, filter_)
-        query = QSqlQuery(sql, model.database())
-        if query.first():
-            paid = query.record().value(0)
+        rows = results['paid']
+        if rows:
+            paid = rows[0][0]
             if paid:
-                sql = "SELECT SUM(payprice) FROM coins WHERE status IN ('owned', 'ordered', 'sale', 'sold', 'missing', 'duplicate', 'replacement') AND payprice<>'' AND payprice IS NOT NULL"
-                sql = self.makeSql(sql, filter_)
-                query = QSqlQuery(sql, model.database())
-                if query.first():
-                    paid_without_commission = query.record().value(0)
+                rows = results['paid_without_commission']
+                if rows:
+                    paid_without_commission = rows[0][0]
                     if paid_without_commission:
                         commission = self.tr("(commission %d%%)") % ((paid - paid_without_commission) / paid_without_commission * 100)
                 paid_str = locale.toString(float(paid), 'f', precision=2)
@@ -165,17 +194,13 @@ class SummaryDialog(QDialog):
 
         earned = 0
         commission = ""
-        sql = "SELECT SUM(totalsaleprice) FROM coins WHERE status='sold' AND totalsaleprice<>'' AND totalsaleprice IS NOT NULL"
-        sql = self.makeSql(sql, filter_)
-        query = QSqlQuery(sql, model.database())
-        if query.first():
-            earned = query.record().value(0)
+        rows = results['earned']
+        if rows:
+            earned = rows[0][0]
             if earned:
-                sql = "SELECT SUM(saleprice) FROM coins WHERE status='sold' AND saleprice<>'' AND saleprice IS NOT NULL"
-                sql = self.makeSql(sql, filter_)
-                query = QSqlQuery(sql, model.database())
-                if query.first():
-                    earn_without_commission = query.record().value(0)
+                rows = results['earn_without_commission']
+                if rows:
+                    earn_without_commission = rows[0][0]
                     if earn_without_commission:
                         commission = self.tr("(commission %d%%)") % ((earn_without_commission - earned) / earn_without_commission * 100)
                 earned_str = locale.toString(float(earned), 'f', precision=2)
@@ -191,29 +216,23 @@ class SummaryDialog(QDialog):
             total_str = locale.toString(float(total), 'f', precision=2)
             lines.append(self.tr("Total (paid - earned): %s") % total_str)
 
-        sql = "SELECT paydate FROM coins WHERE status IN ('owned', 'ordered', 'sale', 'sold', 'missing', 'duplicate', 'replacement') AND paydate<>'' AND paydate IS NOT NULL ORDER BY paydate LIMIT 1"
-        sql = self.makeSql(sql, filter_)
-        query = QSqlQuery(sql, model.database())
-        if query.first():
-            date = QDate.fromString(query.record().value(0), Qt.ISODate)
+        rows = results['first_purchase']
+        if rows:
+            date = QDate.fromString(rows[0][0], Qt.ISODate)
             paydate = locale.toString(date, QLocale.ShortFormat)
             lines.append(self.tr("First purchase: %s") % paydate)
 
-        sql = "SELECT UPPER(grade), price1, price2, price3, price4, quantity FROM coins WHERE status IN ('owned', 'ordered', 'sale', 'duplicate', 'replacement') AND (ifnull(price1,'')<>'' OR ifnull(price2,'')<>'' OR ifnull(price3,'')<>'' OR ifnull(price4,'')<>'')"
-        sql = self.makeSql(sql, filter_)
-        query = QSqlQuery(sql, model.database())
         est_owned = 0
         count = 0
         coins_quantity = 0
         comment = ""
-        while query.next():
-            record = query.record()
-            grade = record.value(0)
-            price1 = record.value(1)
-            price2 = record.value(2)
-            price3 = record.value(3)
-            price4 = record.value(4)
-            quantity = int(record.value(5) or 1)
+        for record in results['est_owned']:
+            grade = record[0]
+            price1 = record[1]
+            price2 = record[2]
+            price3 = record[3]
+            price4 = record[4]
+            quantity = int(record[5] or 1)
 
             try:
                 if grade[:2] in ('UN', 'MS'):
@@ -249,18 +268,14 @@ class SummaryDialog(QDialog):
 
         lines.append(' '.join((self.tr("Estimation owned: %d") % est_owned, comment)))
 
-        sql = "SELECT price1, price2, price3, price4 FROM coins WHERE status='wish' AND (ifnull(price1,'')<>'' OR ifnull(price2,'')<>'' OR ifnull(price3,'')<>'' OR ifnull(price4,'')<>'')"
-        sql = self.makeSql(sql, filter_)
-        query = QSqlQuery(sql, model.database())
         est_wish = 0
         count = 0
         comment = ""
-        while query.next():
-            record = query.record()
-            price1 = record.value(0)
-            price2 = record.value(1)
-            price3 = record.value(2)
-            price4 = record.value(3)
+        for record in results['est_wish']:
+            price1 = record[0]
+            price2 = record[1]
+            price3 = record[2]
+            price4 = record[3]
 
             price = price4 if price4 else price3 if price3 else price2 if price2 else price1 if price1 else 0
 
@@ -276,11 +291,9 @@ class SummaryDialog(QDialog):
 
         lines.append(' '.join((self.tr("Estimation wish: %d") % est_wish, comment)))
 
-        sql = "SELECT count(*) FROM photos"
-        sql = self.makeSql(sql, filter_)
-        query = QSqlQuery(sql, model.database())
-        if query.first():
-            count = query.record().value(0)
+        rows = results['images']
+        if rows:
+            count = rows[0][0]
             lines.append(self.tr("Count images: %d") % count)
 
         return lines
@@ -293,35 +306,31 @@ class SummaryDialog(QDialog):
 
         return 'material IN (%s)' % ','.join(filters)
 
-    def materialCount(self, materials, model, filter_):
+    def materialCountSql(self, material_filter):
+        return "SELECT quantity FROM coins WHERE status IN ('owned', 'ordered', 'sale', 'duplicate', 'replacement') AND " \
+                "%s" % material_filter
+
+    def materialCount(self, rows):
         material_count = 0
         material_quantity = 0
-        material_filter = self.materialFilter(*materials)
-        sql = "SELECT quantity FROM coins WHERE status IN ('owned', 'ordered', 'sale', 'duplicate', 'replacement') AND " \
-                "%s" % material_filter
-        sql = self.makeSql(sql, filter_)
-        query = QSqlQuery(sql, model.database())
-        while query.next():
-            record = query.record()
-            quantity = int(record.value('quantity') or 1)
+        for record in rows:
+            quantity = int(record[0] or 1)
             material_count += 1
             material_quantity += quantity
 
         return material_count, material_quantity
 
-    def materialWeight(self, materials, model, filter_):
-        material_filter = self.materialFilter(*materials)
-        sql = "SELECT fineness, weight, quantity FROM coins WHERE status IN ('owned', 'ordered', 'sale', 'duplicate', 'replacement') AND " \
+    def materialWeightSql(self, material_filter):
+        return "SELECT fineness, weight, quantity FROM coins WHERE status IN ('owned', 'ordered', 'sale', 'duplicate', 'replacement') AND " \
                 "%s AND " \
                 "ifnull(fineness,'')<>'' AND ifnull(weight,'')<>''" % material_filter
-        sql = self.makeSql(sql, filter_)
-        query = QSqlQuery(sql, model.database())
+
+    def materialWeight(self, rows):
         material_weight = 0
         material_count = 0
         material_quantity = 0
-        while query.next():
-            record = query.record()
-            fineness = record.value('fineness')
+        for record in rows:
+            fineness = record[0]
             if isinstance(fineness, str):
                 fineness = stringToMoney(fineness)
             if isinstance(fineness, float):
@@ -329,10 +338,10 @@ class SummaryDialog(QDialog):
                     fineness = str(fineness).replace('.', '')
                 else:
                     fineness = str(fineness).replace('0.', '')
-            weight = record.value('weight')
+            weight = record[1]
             if isinstance(weight, str):
                 weight = stringToMoney(weight)
-            quantity = int(record.value('quantity') or 1)
+            quantity = int(record[2] or 1)
             material_weight += weight * float("0.%s" % fineness) * quantity
             material_count += 1
             material_quantity += quantity
@@ -435,6 +435,21 @@ class EditTagsTreeWidget(QTreeWidget):
             self.execForItem(func, child)
 
 
+def updateTagsClosure(db):
+    # Each tag with itself and all its descendants
+    sql = "DELETE FROM tags_closure"
+    QSqlQuery(sql, db)
+
+    sql = """INSERT INTO tags_closure (ancestor_id, descendant_id)
+        WITH RECURSIVE subtree (ancestor_id, descendant_id) AS (
+            SELECT id, id FROM tags
+            UNION
+            SELECT subtree.ancestor_id, tags.id FROM tags
+            INNER JOIN subtree ON tags.parent_id=subtree.descendant_id)
+        SELECT ancestor_id, descendant_id FROM subtree"""
+    QSqlQuery(sql, db)
+
+
 @storeDlgSizeDecorator
 class TagsDialog(QDialog):
 
@@ -488,6 +503,8 @@ class TagsDialog(QDialog):
         self.setLayout(layout)
 
     def accept(self):
+        updateTagsClosure(self.db)
+
         if not self.db.commit():
             QMessageBox.critical(self.parent(),
                             self.tr("Save tags"),
@@ -64,22 +64,10 @@ class TagsView(QTreeWidget):
             self.scrollToItem(current)
             self.resizeColumnToContents(0)
 
+            # Coins of selected tag and all its subtags
             tag_id = current.data(0, Qt.UserRole)
-            sql = f"SELECT coin_id FROM coins_tags WHERE tag_id={tag_id}"
-            query = QSqlQuery(self.db)
-            query.exec(sql)
-            coin_ids = []
-            while query.next():
-                record = query.record()
-
-                coin_id = record.value(0)
-                coin_ids.append(str(coin_id))
-
-            if coin_ids:
-                # TODO: Use INNER JOIN instead filtering by id
-                filter_ = f"id IN ({','.join(coin_ids)})"
-            else:
-                filter_ = "FALSE"
+            filter_ = f"""id IN (SELECT coin_id FROM coins_tags WHERE tag_id IN
+                (SELECT descendant_id FROM tags_closure WHERE ancestor_id={tag_id}))"""
             self.model.setAdditionalFilter(filter_)
 
     def tagsChanged(self):
@@ -0,0 +1,77 @@
+import io
+
+import cv2
+import imagehash
+import numpy as np
+from PIL import Image
+
+
+def imageHash(image, method):
+    # Squaring
+    if method != 'crop_resistant_hash':
+        w, h = image.size
+        if w > h:
+            offset = (w - h) // 2
+            image = image.crop((offset, 0, w - offset, h))
+        else:
+            offset = (h - w) // 2
+            image = image.crop((0, offset, w, h - offset))
+
+    # Resize
+    # image = image.resize((256, 256), Image.Resampling.LANCZOS)
+
+    # Filter
+    if method == 'phash_orb':
+        image = img2orientedBRIEF(image)
+
+    # Compute hash
+    if method == 'ahash':
+        return imagehash.average_hash(image)
+    elif method == 'phash' or method == 'phash_orb':
+        return imagehash.phash(image)
+    elif method == 'dhash':
+        return imagehash.dhash(image)
+    elif method == 'whash':
+        return imagehash.whash(image)
+    elif method == 'colorhash':
+        return imagehash.colorhash(image)
+    elif method == 'crop_resistant_hash':
+        return imagehash.crop_resistant_hash(image)
+
+
+def imageDataHash(data, method):
+    # Entry point for worker processes: takes raw image data and returns
+    # hash as string
+    try:
+        image = Image.open(io.BytesIO(data))
+        return str(imageHash(image, method))
+    except Exception:
+        return None
+
+
+def img2orientedBRIEF(image, nfeatures=2000):
+    if isinstance(image, Image.Image):  # convert PIL to cv2
+        image = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
+
+    if len(image.shape) == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+    # https://www.geeksforgeeks.org/feature-detection-and-matching-with-opencv-python/
+    orb = cv2.ORB_create(nfeatures=nfeatures)
+    kp = orb.detect(image)
+
+    height, width = image.shape
+    img = np.zeros([height, width, 1], dtype=np.uint8)
+    img.fill(255)
+
+    # Drawing the keypoints
+    if width <= 512:
+        for i in kp:
+            x = int(i.pt[0])
+            y = int(i.pt[1])
+            cv2.circle(img, (x, y), 2, (0, 0, 255), -1)
+    else:
+        img = cv2.drawKeypoints(img, kp, 0, color=(0, 255, 0))
+
+    image = Image.fromarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))  # convert cv2 to PIL
+    return image
@@ -0,0 +1,85 @@
+from PySide6.QtCore import Qt, QBuffer, QCryptographicHash, QIODevice, QRectF
+from PySide6.QtGui import QImage, QPainter
+
+# Functions in this module don't touch widgets and DB, so they can be
+# called from worker threads (QImage and QPainter on QImage are reentrant)
+
+
+def encodeImage(image, sideLen, format_, quality):
+    # Resize big images for storing in DB
+    if sideLen > 0:
+        if image.width() > sideLen or image.height() > sideLen:
+            image = image.scaled(sideLen, sideLen,
+                                 Qt.KeepAspectRatio, Qt.SmoothTransformation)
+
+    buffer = QBuffer()
+    buffer.open(QIODevice.WriteOnly)
+    image.save(buffer, format_, quality)
+
+    return buffer.data()
+
+
+def previewImage(obverse, reverse, height):
+    # Compose preview image for list from obverse and reverse data
+    if not obverse and not reverse:
+        return None
+
+    obverseImage = QImage()
+    reverseImage = QImage()
+
+    if obverse:
+        obverseImage.loadFromData(obverse)
+        obverseImage = obverseImage.scaledToHeight(height,
+                                                   Qt.SmoothTransformation)
+    if reverse:
+        reverseImage.loadFromData(reverse)
+        reverseImage = reverseImage.scaledToHeight(height,
+                                                   Qt.SmoothTransformation)
+
+    if obverseImage.hasAlphaChannel() or reverseImage.hasAlphaChannel():
+        image = QImage(obverseImage.width() + reverseImage.width(),
+                       height, QImage.Format_ARGB32)
+        image.fill(Qt.transparent)
+    else:
+        image = QImage(obverseImage.width() + reverseImage.width(),
+                       height, QImage.Format_RGB32)
+        image.fill(Qt.white)
+
+    paint = QPainter(image)
+    if obverse:
+        paint.drawImage(QRectF(0, 0, obverseImage.width(), height), obverseImage,
+                        QRectF(0, 0, obverseImage.width(), height))
+    if reverse:
+        paint.drawImage(QRectF(obverseImage.width(), 0, reverseImage.width(), height), reverseImage,
+                        QRectF(0, 0, reverseImage.width(), height))
+    paint.end()
+
+    buffer = QBuffer()
+    buffer.open(QIODevice.WriteOnly)
+
+    # Store as lossless WebP for better view
+    image.save(buffer, 'webp', 100)
+
+    return buffer.data()
+
+
+def processImages(images, sideLen, previewHeight, format_, quality,
+                  preview=True):
+    # Takes dict of image field -> QImage or already encoded data and
+    # returns dict of encoded data with preview image under 'image' key
+    result = {}
+    for field, image in images.items():
+        if isinstance(image, QImage):
+            image = encodeImage(image, sideLen, format_, quality)
+        result[field] = image
+
+    if preview:
+        result['image'] = previewImage(result.get('obverseimg'),
+                                       result.get('reverseimg'), previewHeight)
+
+    return result
+
+
+def imageDigest(data):
+    # Content address of stored image
+    return QCryptographicHash.hash(data, QCryptographicHash.Sha1).toHex().data().decode()
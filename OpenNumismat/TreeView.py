@@ -16,6 +16,7 @@ from OpenNumismat.CustomizeTreeDialog import CustomizeTreeDialog
 from OpenNumismat.Tools.Gui import statusIcon
 from OpenNumismat.Tools.Converters import numberWithFraction, compareYears
 from OpenNumismat.Collection.CollectionFields import Statuses
+from OpenNumismat.Collection.FilterCompiler import Blank, Equal, filterToSql
 from OpenNumismat.Settings import Settings
 
 
@@ -94,6 +95,7 @@ class TreeView(QTreeWidget):
     ParamChildRole = Qt.UserRole + 3
     SortDataRole = Qt.UserRole + 4
     TextRole = Qt.UserRole + 5
+    ValuesRole = Qt.UserRole + 6
 
     def __init__(self, treeParam, parent=None):
         super().__init__(parent)
@@ -120,6 +122,13 @@ class TreeView(QTreeWidget):
 
         self.setItemDelegate(AutoToolTipDelegate())
 
+        # Children of tree nodes by (parent fields, fields, node values)
+        self._childsCache = {}
+        # Tree should be refilled on next model changing
+        self._dirty = True
+        # Counters of all tree levels by values of all tree fields
+        self._prefetched = None
+
     def setModel(self, model, reference):
         self.db = model.database()
         self.model = model
@@ -130,13 +139,25 @@ class TreeView(QTreeWidget):
         rootItem.setData(0, self.ParamRole, 0)
         rootItem.setData(0, self.ParamChildRole, 1)
         rootItem.setData(0, self.FiltersRole, '')
+        rootItem.setData(0, self.ValuesRole, ())
 
         self.addTopLevelItem(rootItem)
 
+        model.collection.coinsChanged.connect(self.coinsChangedEvent)
+        model.collection.watchColumns(self, self.treeParam.usedFieldNames())
+
     def modelChanged(self):
         if self.changingEnabled:
-            self.collapseAll()
+            # Tree isn't changed when only filter of list changed
+            if not self._dirty:
+                return
+            self._dirty = False
+
             rootItem = self.topLevelItem(0)
+            expandedPaths = self.__expandedPaths(rootItem)
+            scrollPos = self.verticalScrollBar().value()
+
+            self.collapseAll()
 
             self.currentItemChanged.disconnect(self.itemActivatedEvent)
             rootItem.takeChildren()  # remove all children
@@ -148,6 +169,55 @@ class TreeView(QTreeWidget):
             self.__fillRoot(rootItem)
             self.expandItem(rootItem)
 
+            self.__restoreExpanded(rootItem, (), expandedPaths)
+            self.verticalScrollBar().setValue(scrollPos)
+
+    def coinsChangedEvent(self, old, new):
+        if old is None and new is None:
+            self._childsCache.clear()
+            self._prefetched = None
+            self._dirty = True
+            return
+
+        fields = self.treeParam.usedFieldNames()
+        if old and new and all(self.__valueText(old[field]) == self.__valueText(new[field])
+                               for field in fields):
+            return
+
+        # Patch counters of cached nodes by removing old and adding new coin
+        for key, child_items in self._childsCache.items():
+            parent_fields, cur_fields, values = key
+            for record, delta in ((old, -1), (new, 1)):
+                if record and self.__isMatched(record, values):
+                    self.__mergeChild(child_items, record,
+                                      parent_fields, cur_fields, delta)
+
+        if self._prefetched is not None:
+            for record, delta in ((old, -1), (new, 1)):
+                if record:
+                    self.__mergePrefetched(record, fields, delta)
+
+        self._dirty = True
+
+    def __expandedPaths(self, item, path=()):
+        paths = set()
+        for i in range(item.childCount()):
+            child = item.child(i)
+            if child.isExpanded():
+                child_path = path + (child.data(0, self.TextRole),)
+                paths.add(child_path)
+                paths |= self.__expandedPaths(child, child_path)
+
+        return paths
+
+    def __restoreExpanded(self, item, path, paths):
+        for i in range(item.childCount()):
+            child = item.child(i)
+            child_path = path + (child.data(0, self.TextRole),)
+            if child_path in paths:
+                self.expandItem(child)
+                self.__restoreExpanded(child, child_path, paths)
+
     def expandedEvent(self, item):
         paramChildIndex = item.data(0, self.ParamChildRole)
 
@@ -234,38 +304,33 @@ class TreeView(QTreeWidget):
         dialog = CustomizeTreeDialog(self.model, self.treeParam, self)
         if dialog.exec() == QDialog.Accepted:
             self.treeParam.save()
+            self.model.collection.watchColumns(self, self.treeParam.usedFieldNames())
+            self._prefetched = None
+            self._dirty = True
             self.modelChanged()
         dialog.deleteLater()
 
     def _addCoin(self):
         self.changingEnabled = False
-        storedFilter = self.model.intFilter
+        storedFilter = (self.model.intFilter, self.model.intParams)
         # TODO: This change ListView!
         self.model.setFilter('')
         self.changingEnabled = True
 
-        newRecord = self.model.record()
-        # Fill new record with values of first record
-        for j in range(newRecord.count()):
-            newRecord.setValue(j, self.model.record(0).value(j))
-        tag_ids = self.model.record(0).value('tags')
-
-        for i in range(self.model.rowCount()):
-            record = self.model.record(i)
-            for j in range(newRecord.count()):
-                value = record.value(j)
-                if newRecord.value(j) != value or not value:
-                    newRecord.setNull(j)
-            tag_ids = list([tag_id for tag_id in tag_ids if tag_id in record.value('tags')])
+        # Fill new record with values common for all records
+        newRecord, _usedFields = self.model.multiRecord()
+        tags = newRecord.value('tags')
+        tag_ids = [tag_id for tag_id, state in tags.items()
+                   if state == Qt.Checked]
         newRecord.setValue('tags', tag_ids)
 
         self.model.addCoin(newRecord, self)
 
-        self.model.setFilter(storedFilter)
+        self.model.setFilter(*storedFilter)
 
     def _multiEdit(self):
         self.changingEnabled = False
-        storedFilter = self.model.intFilter
+        storedFilter = (self.model.intFilter, self.model.intParams)
         self.model.setFilter('')
         self.changingEnabled = True
 
@@ -278,7 +343,7 @@ class TreeView(QTreeWidget):
             self.model.setMultiRecord(multiRecord, dialog.getUsedFields(), parent=self)
 
         dialog.deleteLater()
-        self.model.setFilter(storedFilter)
+        self.model.setFilter(*storedFilter)
 
     def __value2label(self, field, text):
         if field == 'status':
@@ -298,7 +363,7 @@ class TreeView(QTreeWidget):
         label_parts = []
 
         for field in fields:
-            text = str(record.value(field))
+            text = str(record[field])
             if text:
                 label = self.__value2label(field, text)
                 label_parts.append(label)
@@ -308,51 +373,156 @@ class TreeView(QTreeWidget):
         else:
             return ''
 
-    def __processChilds(self, parent_fields, cur_fields, filters):
+    @staticmethod
+    def __value(value):
+        # Same as COALESCE(NULLIF(field, ''), '') in SQL
+        if value is None:
+            return ''
+        return value
+
+    def __valueText(self, value):
+        return str(self.__value(value))
+
+    def __isMatched(self, record, values):
+        for field, text in values:
+            if self.__valueText(record[field]) != text:
+                return False
+
+        return True
+
+    def __makeChild(self, record, cur_fields, count):
+        child_label = self.__record2label(record, cur_fields)
+
+        orig_data = []
+        child_filters = []
+        for field in cur_fields:
+            value = record[field]
+
+            orig_data.append(value)
+            text = str(value)
+            if text:
+                child_filters.append(filterToSql(Equal(field, text)))
+            else:
+                child_filters.append(filterToSql(Blank(field)))
+
+        return ChildItem(child_label, orig_data, child_filters, count)
+
+    def __mergeChild(self, child_items, record, parent_fields, cur_fields, delta):
+        record = {field: self.__value(record[field])
+                  for field in cur_fields + parent_fields}
+
+        label = self.__record2label(record, parent_fields)
+        if label not in child_items:
+            child_items[label] = []
+        items = child_items[label]
+
+        datas = [str(record[field]) for field in cur_fields]
+        for child_item in items:
+            if [str(data) for data in child_item.datas] == datas:
+                child_item.count += delta
+                if child_item.count <= 0:
+                    items.remove(child_item)
+                break
+        else:
+            if delta > 0:
+                items.append(self.__makeChild(record, cur_fields, delta))
+
+        if not items:
+            del child_items[label]
+
+    def __processChilds(self, parent_fields, cur_fields, filters, values):
+        key = (tuple(parent_fields), tuple(cur_fields), values)
+        if key in self._childsCache:
+            return self._childsCache[key]
+
+        if self.showCounter:
+            child_items = self.__prefetchedChilds(parent_fields, cur_fields, values)
+            self._childsCache[key] = child_items
+            return child_items
+
         child_items = {}
 
+        # Counter is needed for patching cache even if it not shown
         fields = cur_fields + parent_fields
         coalse_fields = [f"COALESCE(NULLIF({field}, ''), '') AS {field}" for field in fields]
         sql_fields = ','.join(coalse_fields)
-        if self.showCounter:
-            sql = f"SELECT {sql_fields}, COUNT(*) counter FROM coins"
-            if filters:
-                sql += f" WHERE {filters}"
-            sql_group_fields = ','.join(fields)
-            sql += f" GROUP BY {sql_group_fields}"
-        else:
-            sql = f"SELECT DISTINCT {sql_fields} FROM coins"
-            if filters:
-                sql += f" WHERE {filters}"
+        sql = f"SELECT {sql_fields}, COUNT(*) counter FROM coins"
+        if filters:
+            sql += f" WHERE {filters}"
+        sql_group_fields = ','.join(fields)
+        sql += f" GROUP BY {sql_group_fields}"
         query = QSqlQuery(sql, self.db)
         while query.next():
             record = query.record()
+            record = {field: record.value(field) for field in fields + ['counter']}
 
             label = self.__record2label(record, parent_fields)
             if label not in child_items:
                 child_items[label] = []
 
-            child_label = self.__record2label(record, cur_fields)
+            child_item = self.__makeChild(record, cur_fields, record['counter'])
+            child_items[label].append(child_item)
 
-            orig_data = []
-            child_filters = []
-            for field in cur_fields:
-                value = record.value(field)
+        self._childsCache[key] = child_items
 
-                orig_data.append(value)
-                text = str(value)
-                if text:
-                    escapedText = text.replace("'", "''")
-                    child_filters.append(f"{field}='{escapedText}'")
-                else:
-                    child_filters.append(f"ifnull({field},'')=''")
+        return child_items
 
-            if self.showCounter:
-                count = record.value('counter')
-            else:
-                count = 0
-            child_item = ChildItem(child_label, orig_data, child_filters, count)
+    def __prefetch(self):
+        # Count coins for all combinations of tree fields in one pass,
+        # counters of any tree node are summed up from it
+        self._prefetched = {}
+
+        fields = self.treeParam.usedFieldNames()
+        if not fields:
+            return
+
+        # NULL and empty values are grouped together as blank
+        coalse_exprs = [f"COALESCE(NULLIF({field}, ''), '')" for field in fields]
+        sql_fields = ','.join(f"{expr} AS {field}"
+                              for expr, field in zip(coalse_exprs, fields))
+        sql_group_fields = ','.join(coalse_exprs)
+        sql = f"SELECT {sql_fields}, COUNT(*) counter FROM coins GROUP BY {sql_group_fields}"
+        query = QSqlQuery(sql, self.db)
+        while query.next():
+            record = query.record()
+            row = {field: record.value(field) for field in fields}
+            key = tuple(str(row[field]) for field in fields)
+            self._prefetched[key] = [row, record.value('counter')]
+
+    def __mergePrefetched(self, record, fields, delta):
+        row = {field: self.__value(record[field]) for field in fields}
+        key = tuple(str(row[field]) for field in fields)
+        if key in self._prefetched:
+            self._prefetched[key][1] += delta
+            if self._prefetched[key][1] <= 0:
+                del self._prefetched[key]
+        elif delta > 0:
+            self._prefetched[key] = [row, delta]
+
+    def __prefetchedChilds(self, parent_fields, cur_fields, values):
+        if self._prefetched is None:
+            self.__prefetch()
+
+        child_items = {}
+        groups = {}
+
+        fields = cur_fields + parent_fields
+        for row, count in self._prefetched.values():
+            if not self.__isMatched(row, values):
+                continue
+
+            group = tuple(str(row[field]) for field in fields)
+            if group in groups:
+                groups[group].count += count
+                continue
+
+            label = self.__record2label(row, parent_fields)
+            if label not in child_items:
+                child_items[label] = []
+
+            child_item = self.__makeChild(row, cur_fields, count)
             child_items[label].append(child_item)
+            groups[group] = child_item
 
         return child_items
 
@@ -376,12 +546,13 @@ class TreeView(QTreeWidget):
     def __fillRoot(self, item):
         paramIndex = item.data(0, self.ParamRole)
         filters = item.data(0, self.FiltersRole)
+        values = item.data(0, self.ValuesRole)
 
         fields = self.treeParam.fieldNames(paramIndex)
         if not fields:
             return
 
-        child_items = self.__processChilds([], fields, filters)
+        child_items = self.__processChilds([], fields, filters, values)
         if self.__isEmptyChilds(child_items):
             paramIndex += 1
             item.setData(0, self.ParamRole, paramIndex)
@@ -396,6 +567,7 @@ class TreeView(QTreeWidget):
     def __fillChilds(self, item, paramChildIndex):
         paramIndex = item.data(0, self.ParamRole)
         filters = item.data(0, self.FiltersRole)
+        values = item.data(0, self.ValuesRole)
 
         fields = self.treeParam.fieldNames(paramIndex)
         if not fields:
@@ -405,7 +577,7 @@ class TreeView(QTreeWidget):
         if not fields_child:
             return
 
-        child_items = self.__processChilds(fields, fields_child, filters)
+        child_items = self.__processChilds(fields, fields_child, filters, values)
 
         good_children = []
         has_empty_children = False
@@ -428,6 +600,7 @@ class TreeView(QTreeWidget):
 
     def __addChilds(self, item, child_items):
         filter_ = item.data(0, self.FiltersRole)
+        values = item.data(0, self.ValuesRole)
         paramIndex = item.data(0, self.ParamRole)
         paramChildIndex = item.data(0, self.ParamChildRole)
         fields = self.treeParam.fieldNames(paramIndex)
@@ -476,11 +649,14 @@ class TreeView(QTreeWidget):
 
             combined_filter = []
             if child_item.filters:
-                combined_filter = child_item.filters
+                combined_filter = list(child_item.filters)
             if filter_:
                 combined_filter.append(filter_)
             newFilters = ' AND '.join(combined_filter)
             child.setData(0, self.FiltersRole, newFilters)
+            child_values = tuple((field, str(data)) for field, data
+                                 in zip(fields, child_item.datas))
+            child.setData(0, self.ValuesRole, values + child_values)
 
             if fields[0] == 'status':
                 icon = statusIcon(child_item.datas[0])
@@ -503,7 +679,7 @@ class TreeView(QTreeWidget):
             text = self.tr("Other")
             if self.showCounter:
                 text = f"{text} [{countEmpty}]"
-            newFilters = f"ifnull({fields[0]},'')=''"
+            newFilters = filterToSql(Blank(fields[0]))
             if filter_:
                 newFilters = f"{filter_} AND {newFilters}"
 
@@ -512,6 +688,7 @@ class TreeView(QTreeWidget):
             child.setData(0, self.ParamRole, paramChildIndex)
             child.setData(0, self.ParamChildRole, paramChildIndex + 1)
             child.setData(0, self.FiltersRole, newFilters)
+            child.setData(0, self.ValuesRole, values + ((fields[0], ''),))
             child.setData(0, self.FieldsRole, fields)
             item.addChild(child)
 
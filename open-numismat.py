@@ -16,5 +16,8 @@
 # along with OpenNumismat; If not, see <https://www.gnu.org/licenses/>.
 
 if __name__ == "__main__":
+    import multiprocessing
+    multiprocessing.freeze_support()
+
     from OpenNumismat import run
     run()